@@ -76,6 +76,11 @@ class Buffer (DiagHacks,ExternOutput,FSTD_Compat,netCDF_IO,netCDF_Atts,PruneAxes
   """
   def __init__ (self, filename, *args, **kwargs):
     super(Buffer,self).__init__(filename, *args,**kwargs)
+    # All the mixins are done setting up the headers, so can now store them
+    # in a more compact form.
+    # Note: the compacted columns are read-only from here on.  Any changes
+    # to them must be done by assigning new arrays into the table.
+    self._headers.compact(keep=self._hot_columns())
 
 # Dynamically generate final init docstring from the mixins.
 def _docstring ():
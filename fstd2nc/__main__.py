@@ -63,7 +63,7 @@ def _fstdump (buffer_type=Buffer):
     error (_("problem opening one or more input files."))
 
   # Get the metadata in a netCDF-like structure.
-  buf._makevars()
+  buf._makevars_cached()
   print ("fstd98 %s {"%basename(infile))
   print ("dimensions:")
   for axis in buf._iter_axes():
@@ -100,7 +100,7 @@ def _fstdump (buffer_type=Buffer):
           values = var.array
         elif hasattr(var,'record_id'):
           import numpy as np
-          values = np.array([buf._read_record(rec) for rec in var.record_id.flatten()])
+          values = buf._read_records(var.record_id.flatten())
         elif hasattr(var,'chunks'):
           import numpy as np
           values = np.zeros(var.shape,var.dtype)
@@ -154,6 +154,8 @@ def _fstd2nc_cmdline (buffer_type=Buffer):
   parser.add_argument('--turbo', action='store_true', help=SUPPRESS)#_('Throw more resources at the writer, to make it go faster.'))
   parser.add_argument('--no-history', action='store_true', help=_("Don't put the command-line invocation in the netCDF metadata."))
   parser.add_argument('-q', '--quiet', action='store_true', help=_("Don't display any information except for critical error messages.  Implies --no-progress."))
+  parser.add_argument('--profile-report', metavar='FILE', help=_("Write timing information and counters for the conversion to the specified file (in JSON format)."))
+  parser.add_argument('--trace-file', metavar='FILE', help=_("Write a trace of the conversion (reading, decoding and writing of the records) to the specified file, in Chrome trace-event format.  This can be viewed in about://tracing or Perfetto."))
   parser.add_argument('--pandas', action='store_true', help=SUPPRESS)
   args = parser.parse_args()
   buffer_type._check_args(parser, args)
@@ -168,7 +170,10 @@ def _fstd2nc_cmdline (buffer_type=Buffer):
   no_history = args.pop('no_history')
   compression = args.pop('compression')
   quiet = args.pop('quiet')
-  use_pandas = args.pop('pandas')
+  profile_report = args.pop('profile_report')
+  trace_file = args.pop('trace_file')
+  # Note: --pandas is no longer needed, but is still accepted.
+  args.pop('pandas')
   if quiet:
     fstopt ('MSGLVL',6)
     fstd2nc.stdout.streams = ('error',)
@@ -176,8 +181,6 @@ def _fstd2nc_cmdline (buffer_type=Buffer):
   else:
     fstd2nc.stdout.streams = ('info','warn','error',)
   progress = args.get('progress',False)
-  if use_pandas:
-    fstd2nc.mixins._pandas_needed = True
 
   # Apply message level criteria.
   try:
@@ -189,6 +192,12 @@ def _fstd2nc_cmdline (buffer_type=Buffer):
   # Turn off Python warning / exception handling, use stdio for communication.
   fstd2nc.stdout._python = False
 
+  # Collect timing information?
+  if profile_report is not None:
+    fstd2nc.stats.enable(buffer_type)
+  if trace_file is not None:
+    fstd2nc.stats.start_trace()
+
   try:
     buf = buffer_type(infiles, **args)
   except FSTDError:
@@ -229,6 +238,11 @@ def _fstd2nc_cmdline (buffer_type=Buffer):
 
   buf.to_netcdf(outfile, nc_format=nc_format, global_metadata=global_metadata, zlib=zlib, compression=compression, progress=progress, turbo=turbo)
 
+  if profile_report is not None:
+    fstd2nc.stats.write_report(profile_report)
+  if trace_file is not None:
+    fstd2nc.stats.write_trace(trace_file)
+
 #################################################
 # Command-line invocation with error trapping.
 # Hides the Python stack trace when the user aborts the command.
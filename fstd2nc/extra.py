@@ -23,23 +23,39 @@ Optional helper functions.
 These functions provide information about the FST files using alternative
 approaches (not the standard librmn/rpnpy functions).
 This is solely for performance considerations.
+
+Records can be decoded from several threads at once: each thread has its
+own work arrays, and librmn releases the GIL.  This assumes the global
+settings of librmn are not changed while decoding.  In particular, the
+missing value handling is turned off once when fstd2nc.mixins.masks is
+imported, and should not be toggled while other threads are decoding.
+
+Packed integers (datyp 2 and 4), packed floats (datyp 1 and 6) and
+uncompressed 32-bit IEEE data are unpacked with numpy.  librmn is used for
+the other encodings, and to check the numpy version against the first
+record of each encoding.
 """
 
-from rpnpy.librmn import librmn
 import ctypes as ct
 import numpy as np
 import numpy.ctypeslib as npc
-librmn.compact_float.argtypes = (npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.POINTER(ct.c_double))
-librmn.compact_double.argtypes = (npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.POINTER(ct.c_double))
-librmn.compact_integer.argtypes = (npc.ndpointer(dtype='int32'), ct.c_void_p, npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int)
-librmn.ieeepak_.argtypes = (npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), ct.POINTER(ct.c_int), ct.POINTER(ct.c_int), ct.POINTER(ct.c_int), ct.POINTER(ct.c_int), ct.POINTER(ct.c_int))
-librmn.compact_char.argtypes = (npc.ndpointer(dtype='int32'), ct.c_void_p, npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int)
-librmn.c_armn_uncompress32.argtypes = (npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int)
-librmn.c_armn_compress_setswap.argtypes = (ct.c_int,)
-librmn.armn_compress.argtypes = (npc.ndpointer(dtype='int32'),ct.c_int,ct.c_int,ct.c_int,ct.c_int,ct.c_int)
-librmn.c_float_unpacker.argtypes = (npc.ndpointer(dtype='int32'),npc.ndpointer(dtype='int32'),npc.ndpointer(dtype='int32'),ct.c_int,ct.POINTER(ct.c_int))
-
-def decode (data):
+# librmn is only needed for the encodings that aren't handled in numpy.
+try:
+  from rpnpy.librmn import librmn
+except ImportError:
+  librmn = None
+if librmn is not None:
+  librmn.compact_float.argtypes = (npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.POINTER(ct.c_double))
+  librmn.compact_double.argtypes = (npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.POINTER(ct.c_double))
+  librmn.compact_integer.argtypes = (npc.ndpointer(dtype='int32'), ct.c_void_p, npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int)
+  librmn.ieeepak_.argtypes = (npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), ct.POINTER(ct.c_int), ct.POINTER(ct.c_int), ct.POINTER(ct.c_int), ct.POINTER(ct.c_int), ct.POINTER(ct.c_int))
+  librmn.compact_char.argtypes = (npc.ndpointer(dtype='int32'), ct.c_void_p, npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int)
+  librmn.c_armn_uncompress32.argtypes = (npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), ct.c_int, ct.c_int, ct.c_int, ct.c_int)
+  librmn.c_armn_compress_setswap.argtypes = (ct.c_int,)
+  librmn.armn_compress.argtypes = (npc.ndpointer(dtype='int32'),ct.c_int,ct.c_int,ct.c_int,ct.c_int,ct.c_int)
+  librmn.c_float_unpacker.argtypes = (npc.ndpointer(dtype='int32'),npc.ndpointer(dtype='int32'),npc.ndpointer(dtype='int32'),ct.c_int,ct.POINTER(ct.c_int))
+
+def decode (data, out=None, view=False):
   '''
   Decodes the raw FSTD data into the final 2D array of values.
   Similar to fstluk, but here the data is already loaded in memory.
@@ -50,80 +66,359 @@ def decode (data):
   ----------
   data : array
       The encoded data
+  out : array, optional
+      An array to put the decoded values in.  It must have the same number
+      of elements as the record, but can have a different shape or dtype
+      (the values are cast as needed).
+  view : bool, optional
+      For uncompressed 32-bit IEEE data (datyp 5), return the values as a
+      big-endian ('>f4') view over the input array, instead of copying them
+      to native byte order.  Ignored if an output array is given.
+  '''
+  data = data.view('>i4')
+  # Without an output array, the result is a view of the work arrays, so
+  # they can't be re-used.
+  if out is None:
+    return _Unpacker(*_encoding(data)).unpack(data, view=view)
+  return _get_unpacker(_encoding(data)).unpack(data, out=out)
+
+def decode_many (buffers, out=None):
+  '''
+  Decodes a list of raw FSTD records into a single 3D array of values, with
+  shape (nrecs, nj, ni).
+  Records with the same encoding (datyp, nbits, ni, nj, nk) share the same
+  work arrays, so this is faster than calling decode on each record.
+
+  Parameters
+  ----------
+  buffers : list of arrays
+      The encoded data for each record (including the header information).
+  out : array, optional
+      An array of shape (nrecs, nj, ni) to put the decoded values in.
+      The values are cast to the dtype of this array as needed.
   '''
-  import rpnpy.librmn.all as rmn
   import numpy as np
   from fstd2nc.mixins.fstd import dtype_fst2numpy
-  data = data.view('>i4').astype('i4')
-  ni, nj, nk = data[3]>>8, data[4]>>8, data[5]>>12
-  nelm = ni*nj*nk
+  buffers = [data.view('>i4') for data in buffers]
+  encodings = [_encoding(data) for data in buffers]
+  if out is None:
+    shapes = set((nj,ni) for datyp, nbits, ni, nj, nk in encodings)
+    if len(shapes) > 1:
+      raise ValueError("Records have different shapes.")
+    shape = shapes.pop() if len(shapes) > 0 else (0,0)
+    dtypes = [dtype_fst2numpy(datyp,nbits) for datyp, nbits, ni, nj, nk in set(encodings)]
+    dtype = np.result_type(*dtypes) if len(dtypes) > 0 else 'float32'
+    out = np.empty((len(buffers),)+shape, dtype=dtype)
+  for i, (data, encoding) in enumerate(zip(buffers, encodings)):
+    _get_unpacker(encoding).unpack(data, out=out[i])
+  return out
+
+# Helper method - get the encoding of a record, from its header.
+def _encoding (data):
+  ni, nj, nk = int(data[3])>>8, int(data[4])>>8, int(data[5])>>12
   datyp = int(data[4]%256) & 191  # Ignore +64 mask.
-  if datyp == 8: nelm = nelm * 2  # For complex, have double the elements.
   nbits = int(data[2]%256)
-  dtype = dtype_fst2numpy (datyp, nbits)
-  if nbits <= 32:
-    work = np.empty(nelm,'int32')
-  else:
-    work = np.empty(nelm,'int64').view('int32')
-  # Strip header
-  data = data[20:]
-  # Extend data buffer for in-place decompression.
-  if datyp in (129,130,134):
-    d = np.empty(nelm + 100, dtype='int32')
-    d[:len(data)] = data
-    data = d
-  shape = (nj,ni)
-  ni = ct.c_int(ni)
-  nj = ct.c_int(nj)
-  nk = ct.c_int(nk)
-  nelm = ct.c_int(nelm)
-  npak = ct.c_int(-nbits)
-  nbits = ct.c_int(nbits)
-  zero = ct.c_int(0)
-  one = ct.c_int(1)
-  two = ct.c_int(2)
-  tempfloat = ct.c_double(99999.0)
-
-  #print (ni, nj, nk, nbits, datyp, dtype)
-  if datyp == 0:
-    work = data
-  elif datyp == 1:
-    if nbits.value <= 32:
-      librmn.compact_float(work, data, data[3:], nelm, nbits, 24, 1, 2, 0, ct.byref(tempfloat))
+  return datyp, nbits, ni, nj, nk
+
+# Get work arrays for decoding a record of the given encoding.
+# Each thread keeps its own work arrays, so records can be decoded in
+# parallel.  Only the most recently used ones are kept, to limit the
+# memory use.
+from threading import local
+_scratch = local()
+del local
+def _get_unpacker (encoding, maxsize=2):
+  from collections import OrderedDict
+  unpackers = getattr(_scratch,'unpackers',None)
+  if unpackers is None:
+    unpackers = _scratch.unpackers = OrderedDict()
+  if encoding in unpackers:
+    unpackers.move_to_end(encoding)
+    return unpackers[encoding]
+  unpacker = unpackers[encoding] = _Unpacker(*encoding)
+  while len(unpackers) > maxsize:
+    unpackers.popitem(last=False)
+  return unpacker
+
+# Pure numpy version of the bit unpacking from compact_integer.
+# The values are packed in a continuous stream of bits, starting from the
+# most significant bit of each 32-bit word.
+# The pattern of word / bit offsets repeats every gcd(nbits,32) bits, so the
+# values are extracted one column of this pattern at a time.
+def _unpack_bits (words, nbits, count):
+  import numpy as np
+  from math import gcd
+  g = gcd(nbits,32)
+  k = 32//g     # Values per group of words.
+  m = nbits//g  # Words per group.
+  ngroups = -(-count//k)
+  n = min(len(words),ngroups*m)
+  w = np.zeros(ngroups*m, dtype='uint64')
+  w[:n] = words[:n]
+  w = w.reshape(ngroups,m)
+  mask = (1<<nbits) - 1
+  out = np.empty((ngroups,k), dtype='uint32')
+  for j in range(k):
+    i, o = divmod(j*nbits, 32)
+    if o + nbits <= 32:
+      out[:,j] = (w[:,i] >> (32-o-nbits)) & mask
+    # Value is split over two words.
+    else:
+      out[:,j] = (((w[:,i] << 32) | w[:,i+1]) >> (64-o-nbits)) & mask
+  return out.reshape(-1)[:count]
+
+# Keeps track of which encodings can be unpacked with the numpy versions
+# below.
+# The first record of each encoding is also unpacked with librmn, to make
+# sure the numpy version gives the same result.  If it doesn't, librmn is
+# used for that encoding from then on.
+# The check is done under a lock, so only one thread does it per encoding.
+class _NumpyCheck (object):
+  def __init__ (self):
+    from threading import Lock
+    self._ok = {}
+    self._lock = Lock()
+  # Result of the check for the given encoding (None if not checked yet).
+  def status (self, key):
+    return self._ok.get(key)
+  def reset (self):
+    with self._lock:
+      self._ok.clear()
+  # Unpack a record into the work array.
+  # 'unpack' is the numpy version, which returns False if it can't handle
+  # that particular record.  'reference' is the librmn version.
+  def unpack (self, key, work, nelm, unpack, reference):
+    import numpy as np
+    from fstd2nc import stats
+    if librmn is None:
+      if unpack(work) is False:
+        raise ValueError("Need librmn to decode this record.")
+      return
+    if self._ok.get(key) is False or unpack(work) is False:
+      reference(work)
+      return
+    if key not in self._ok:
+      with self._lock:
+        if key not in self._ok:
+          check = np.empty_like(work)
+          reference(check)
+          self._ok[key] = np.array_equal(check[:nelm], work[:nelm])
+          if not self._ok[key]:
+            stats.count('numpy_unpack_mismatches')
+    # Another thread may have found a mismatch while this one was unpacking.
+    if self._ok[key] is False:
+      reference(work)
+_numpy_check = _NumpyCheck()
+
+# Unpack integer data (datyp 2 or 4) into the given work array.
+# Signed values are stored with an offset of 2**(nbits-1).
+def _unpack_integers (work, data, nelm, nbits, datyp):
+  def unpack (work):
+    import numpy as np
+    values = _unpack_bits (data.view('uint32'), nbits.value, nelm.value)
+    if datyp == 4:
+      values = values.astype('int64') - (1<<(nbits.value-1))
+    work[:nelm.value] = values.astype('int32')
+  def reference (work):
+    librmn.compact_integer(work, None, data, nelm, nbits, 0, 1, datyp)
+  _numpy_check.unpack ((datyp,nbits.value), work, nelm.value, unpack, reference)
+
+# Unpack floating-point data from compact_float (datyp 1, up to 32 bits).
+# Header (3 words):
+#   0x7ff:12, count:20
+#   shift+4096:16, minimum exponent:12, minimum sign:4
+#   minimum mantissa:32 (with the leading 1 bit)
+# The values start 24 bits into the next word, and are
+#   minimum + token * 2**shift
+# rounded to float32 (with ties rounded away from zero).
+# Records with denormal minimums or steps are left for librmn.
+def _unpack_float (work, data, nelm, nbits):
+  def unpack (work):
+    import numpy as np
+    n = nelm.value
+    h = [int(x) for x in data[:3].view('uint32')]
+    if h[0]>>20 != 0x7ff or h[1]&15 > 1: return False
+    shift = (h[1]>>16) - 4096
+    minimum = np.ldexp(float(h[2]), ((h[1]>>4)&0xfff)-1007)
+    if h[1]&15: minimum = -minimum
+    if (minimum != 0 and abs(minimum) < 2.**-126) or shift < -126: return False
+    if abs(minimum) + np.ldexp(2.**nbits.value, shift) >= 2.**128: return False
+    # Line up the values with the start of the words.
+    nwords = -(-(24+n*nbits.value)//32)
+    words = np.zeros(nwords+1, dtype='uint64')
+    words[:nwords] = data[3:3+nwords].view('uint32')
+    words = ((words[:-1] << 24) | (words[1:] >> 8)) & 0xffffffff
+    tokens = _unpack_bits (words, nbits.value, n)
+    values = minimum + np.ldexp(tokens.astype('float64'), shift)
+    # Round to float32, with ties going away from zero.
+    bits = values.view('uint64')
+    sign = bits & np.uint64(1<<63)
+    bits = ((bits & np.uint64((1<<63)-1)) + np.uint64(1<<28)) & ~np.uint64((1<<29)-1)
+    work[:n] = (bits | sign).view('float64').astype('float32').view('int32')
+  def reference (work):
+    tempfloat = ct.c_double(99999.0)
+    librmn.compact_float(work, data, data[3:], nelm, nbits, 24, 1, 2, 0, ct.byref(tempfloat))
+  _numpy_check.unpack ((1,nbits.value), work, nelm.value, unpack, reference)
+
+# Unpack floating-point data from float_packer (datyp 6).
+# Header (3 words):
+#   0xeff:12, nbits-1:4, maximum exponent:8, shift:8
+#   offset:32 (signed)
+#   count:32
+# The values are 16-bit tokens (2 per word, most significant half first),
+# and are
+#   (token << shift) + offset
+# taken as a 24-bit magnitude with the maximum exponent (saturating at the
+# largest mantissa).
+def _unpack_float16 (work, data, nelm, nbits):
+  def unpack (work):
+    import numpy as np
+    n = nelm.value
+    h = [int(x) for x in data[:3].view('uint32')]
+    if h[0]>>20 != 0xeff or h[2] != n: return False
+    maxexp = (h[0]>>8) & 255
+    if maxexp == 255: return False
+    if maxexp == 0:
+      work[:n] = 0
+      return
+    words = data[3:3+(n+1)//2].view('uint32')
+    tokens = np.empty((len(words),2), dtype='uint32')
+    tokens[:,0] = words >> 16
+    tokens[:,1] = words & 0xffff
+    values = ((tokens.reshape(-1)[:n] << np.uint32(h[0]&31)) + np.uint32(h[1])).view('int32')
+    negative = values < 0
+    magnitude = np.abs(values.astype('int64'))
+    # Note: librmn gives 0 for the most negative integer.
+    magnitude[magnitude == 2**31] = 0
+    negative &= magnitude > 0
+    result = np.ldexp(magnitude.astype('float64'), maxexp-150)
+    result[negative] *= -1
+    result = result.astype('float32').view('int32')
+    saturated = (negative.astype('uint32') << np.uint32(31)) | np.uint32((maxexp<<23)|0x7fffff)
+    work[:n] = np.where(magnitude > 0xffffff, saturated.view('int32'), result)
+  def reference (work):
+    librmn.c_float_unpacker(work, data, data[3:], nelm, ct.byref(ct.c_int(nbits.value)))
+  _numpy_check.unpack ((6,nbits.value), work, nelm.value, unpack, reference)
+
+# Work arrays for decoding records of a particular encoding.
+# Can be re-used for many records, as long as they have the same encoding.
+# Note: the decoded values are only valid until the next record is unpacked,
+# unless an output array is given.
+# If the output array already has the right type, the values are unpacked
+# directly into it.
+class _Unpacker (object):
+  def __init__ (self, datyp, nbits, ni, nj, nk):
+    import numpy as np
+    from fstd2nc.mixins.fstd import dtype_fst2numpy
+    nelm = ni*nj*nk
+    if datyp == 8: nelm = nelm * 2  # For complex, have double the elements.
+    self.datyp = datyp
+    self.dtype = dtype_fst2numpy (datyp, nbits)
+    if nbits <= 32:
+      self.work = np.empty(nelm,'int32')
+    else:
+      self.work = np.empty(nelm,'int64').view('int32')
+    # Scratch space for the (byte-swapped) data.
+    # Extended for in-place decompression.
+    if datyp in (129,130,134):
+      self.data = np.empty(nelm + 100, dtype='int32')
     else:
+      self.data = np.empty(0, dtype='int32')
+    self.shape = (nj,ni)
+    self.ni = ct.c_int(ni)
+    self.nj = ct.c_int(nj)
+    self.nk = ct.c_int(nk)
+    self.nelm = ct.c_int(nelm)
+    self.npak = ct.c_int(-nbits)
+    self.nbits = ct.c_int(nbits)
+    self.zero = ct.c_int(0)
+    self.one = ct.c_int(1)
+    self.two = ct.c_int(2)
+    self.tempfloat = ct.c_double(99999.0)
+  def unpack (self, data, out=None, view=False):
+    import numpy as np
+    from fstd2nc.mixins import _copy_to
+    # Fast path for uncompressed 32-bit IEEE data.
+    # The values are already there (big-endian), so no need for the work
+    # arrays.  The byte swapping is done while copying the values out,
+    # unless a big-endian view was requested.
+    if self.datyp == 5 and self.nbits.value == 32:
+      values = data[20:20+self.nelm.value].view('>f4').reshape(self.shape)
+      if out is None:
+        return values if view else values.astype('float32')
+      return _copy_to (out, values)
+    # Strip header
+    data = data[20:]
+    if len(data) > len(self.data):
+      self.data = np.empty(len(data), dtype='int32')
+    self.data[:len(data)] = data
+    if self.datyp in (129,130,134):
+      data = self.data
+    else:
+      data = self.data[:len(data)]
+    datyp = self.datyp
+    if librmn is None and datyp not in (1,2,4,6):
+      raise ImportError("librmn is needed to decode datyp %d."%datyp)
+    work = self.work
+    direct = out is not None and out.dtype == self.dtype and out.flags.c_contiguous and out.nbytes == work.nbytes and datyp not in (0,7)
+    if direct:
+      work = out.reshape(-1).view('int32')
+    ni, nj, nk = self.ni, self.nj, self.nk
+    nelm, npak, nbits = self.nelm, self.npak, self.nbits
+    zero, one, two = self.zero, self.one, self.two
+    tempfloat = self.tempfloat
+
+    #print (ni, nj, nk, nbits, datyp, dtype)
+    if datyp == 0:
+      work = data
+    elif datyp == 1:
+      if 0 < nbits.value <= 32:
+        _unpack_float (work, data, nelm, nbits)
+      elif nbits.value <= 32:
+        librmn.compact_float(work, data, data[3:], nelm, nbits, 24, 1, 2, 0, ct.byref(tempfloat))
+      else:
+        raise Exception
+        librmn.compact_double(work, data, data[3:], nelm, nbits, 24, 1, 2, 0, ct.byref(tempfloat))
+    elif datyp in (2,4) and 0 < nbits.value <= 32:
+      _unpack_integers (work, data, nelm, nbits, datyp)
+    elif datyp == 2:
+      librmn.compact_integer(work, None, data, nelm, nbits, 0, 1, 2)
+    elif datyp == 3:
       raise Exception
-      librmn.compact_double(work, data, data[3:], nelm, nbits, 24, 1, 2, 0, ct.byref(tempfloat))
-  elif datyp == 2:
-    librmn.compact_integer(work, None, data, nelm, nbits, 0, 1, 2)
-  elif datyp == 3:
-    raise Exception
-  elif datyp == 4:
-    librmn.compact_integer(work, None, data, nelm, nbits, 0, 1, 4)
-  elif datyp == 5:
-    librmn.ieeepak_(work, data, ct.byref(nelm), ct.byref(one), ct.byref(npak), ct.byref(zero), ct.byref(two))
-  elif datyp == 6:
-    librmn.c_float_unpacker(work, data, data[3:], nelm, ct.byref(nbits));
-  elif datyp == 7:
-    ier = librmn.compact_char(work, None, data, nelm, 8, 0, 1, 10)
-    work = work.view('B')[:len(work)] #& 127
-  elif datyp == 8:
-    librmn.ieeepak_(work, data, ct.byref(nelm), ct.byref(one), ct.byref(npak), ct.byref(zero), ct.byref(two))
-  elif datyp == 129:
-    librmn.armn_compress(data[5:],ni,nj,nk,nbits,2)
-    librmn.compact_float(work,data[1:],data[5:],nelm,nbits.value+64*max(16,nbits.value),0,1,2,0,ct.byref(tempfloat))
-  elif datyp == 130:
-    #librmn.c_armn_compress_setswap(0)
-    librmn.armn_compress(data[1:],ni,nj,nk,nbits,2)
-    #librmn.c_armn_compress_setswap(1)
-    work[:] = data[1:].astype('>i4').view('>H')[:nelm.value]
-  elif datyp == 133:
-    librmn.c_armn_uncompress32(work, data[1:], ni, nj, nk, nbits)
-  elif datyp == 134:
-    librmn.armn_compress(data[4:],ni,nj,nk,nbits,2);
-    librmn.c_float_unpacker(work,data[1:],data[4:],nelm,ct.byref(nbits))
-  else:
-    raise Exception(datyp)
-  return work.view(dtype)[:nelm.value].reshape(shape)
+    elif datyp == 4:
+      librmn.compact_integer(work, None, data, nelm, nbits, 0, 1, 4)
+    elif datyp == 5:
+      librmn.ieeepak_(work, data, ct.byref(nelm), ct.byref(one), ct.byref(npak), ct.byref(zero), ct.byref(two))
+    elif datyp == 6:
+      _unpack_float16 (work, data, nelm, nbits)
+    elif datyp == 7:
+      ier = librmn.compact_char(work, None, data, nelm, 8, 0, 1, 10)
+      work = work.view('B')[:len(work)] #& 127
+    elif datyp == 8:
+      librmn.ieeepak_(work, data, ct.byref(nelm), ct.byref(one), ct.byref(npak), ct.byref(zero), ct.byref(two))
+    elif datyp == 129:
+      librmn.armn_compress(data[5:],ni,nj,nk,nbits,2)
+      librmn.compact_float(work,data[1:],data[5:],nelm,nbits.value+64*max(16,nbits.value),0,1,2,0,ct.byref(tempfloat))
+    elif datyp == 130:
+      # Note: the swap setting is global in librmn, so changing it here would
+      # not be thread-safe.
+      #librmn.c_armn_compress_setswap(0)
+      librmn.armn_compress(data[1:],ni,nj,nk,nbits,2)
+      #librmn.c_armn_compress_setswap(1)
+      work[:] = data[1:].astype('>i4').view('>H')[:nelm.value]
+    elif datyp == 133:
+      librmn.c_armn_uncompress32(work, data[1:], ni, nj, nk, nbits)
+    elif datyp == 134:
+      librmn.armn_compress(data[4:],ni,nj,nk,nbits,2);
+      librmn.c_float_unpacker(work,data[1:],data[4:],nelm,ct.byref(nbits))
+    else:
+      raise Exception(datyp)
+    if direct:
+      return out
+    values = work.view(self.dtype)[:nelm.value].reshape(self.shape)
+    if out is None:
+      return values
+    return _copy_to (out, values)
 
 
 def decode_headers (raw):
@@ -133,110 +428,164 @@ def decode_headers (raw):
   vectorized over all records instead of 1 record at a time.
   NOTE: This includes deleted records as well.  You can filter them out using
         the 'dltf' flag.
+  NOTE: The entries are decoded the first time they are accessed, so there is
+        no extra cost for entries that are never used.
 
   Parameters
   ----------
   raw : numpy array (dtype='B')
       The raw array of headers to decode.
   '''
-  import numpy as np
   raw = raw.view('>i4').astype('uint32').reshape(-1,9,2)
-  # Start unpacking the pieces.
-  # Reference structure (from qstdir.h):
-  # 0      word deleted:1, select:7, lng:24, addr:32;
-  # 1      word deet:24, nbits: 8, ni:   24, gtyp:  8;
-  # 2      word nj:24,  datyp: 8, nk:   20, ubc:  12;
-  # 3      word npas: 26, pad7: 6, ig4: 24, ig2a:  8;
-  # 4      word ig1:  24, ig2b:  8, ig3:  24, ig2c:  8;
-  # 5      word etik15:30, pad1:2, etik6a:30, pad2:2;
-  # 6      word etikbc:12, typvar:12, pad3:8, nomvar:24, pad4:8;
-  # 7      word ip1:28, levtyp:4, ip2:28, pad5:4;
-  # 8      word ip3:28, pad6:4, date_stamp:32;
-  nrecs = raw.shape[0]
-  out = {}
-  out['lng'] = np.empty(nrecs, dtype='int32')
-  out['dltf'] = np.empty(nrecs, dtype='ubyte')
-  out['swa'] =  np.empty(nrecs, dtype='uint64')
-  out['deet'] = np.empty(nrecs, dtype='int32')
-  out['nbits'] = np.empty(nrecs, dtype='byte')
-  out['grtyp'] = np.empty(nrecs, dtype='|S1')
-  out['ni'] = np.empty(nrecs, dtype='int32')
-  out['nj'] = np.empty(nrecs, dtype='int32')
-  out['datyp'] = np.empty(nrecs, dtype='ubyte')
-  out['nk'] = np.empty(nrecs, dtype='int32')
-  out['ubc'] = np.empty(nrecs, dtype='uint16')
-  out['npas'] = np.empty(nrecs, dtype='int32')
-  out['ig1'] = np.empty(nrecs, dtype='int32')
-  out['ig2'] = np.empty(nrecs, dtype='int32')
-  out['ig3'] = np.empty(nrecs, dtype='int32')
-  out['ig4'] = np.empty(nrecs, dtype='int32')
-  out['etiket'] = np.empty(nrecs,dtype='|S12')
-  out['typvar'] = np.empty(nrecs,dtype='|S2')
-  out['nomvar'] = np.empty(nrecs,dtype='|S4')
-  out['ip1'] = np.empty(nrecs, dtype='int32')
-  out['ip2'] = np.empty(nrecs, dtype='int32')
-  out['ip3'] = np.empty(nrecs, dtype='int32')
-  out['datev'] = np.empty(nrecs, dtype='int32')
-  out['dateo'] = np.empty(nrecs, dtype='int32')
-  out['xtra1'] = np.empty(nrecs, dtype='uint32')
-  out['xtra2'] = np.empty(nrecs, dtype='uint32')
-  out['xtra3'] = np.empty(nrecs, dtype='uint32')
-
-  temp8 = np.empty(nrecs, dtype='ubyte')
-  temp32 = np.empty(nrecs, dtype='int32')
-
-  np.divmod(raw[:,0,0],2**24, temp8, out['lng'])
-  out['lng'] *= 2 # Convert from 8-byte to 4-byte units.
-  np.divmod(temp8,128, out['dltf'], temp8)
-  out['swa'][:] = raw[:,0,1]
-  np.divmod(raw[:,1,0],256, out['deet'], out['nbits'])
-  np.divmod(raw[:,1,1],256, out['ni'], out['grtyp'].view('ubyte'))
-  np.divmod(raw[:,2,0],256, out['nj'], out['datyp'])
-  np.divmod(raw[:,2,1],4096, out['nk'], out['ubc'])
-  out['npas'][:] = raw[:,3,0]//64
-  np.divmod(raw[:,3,1],256, out['ig4'], temp32)
-  out['ig2'][:] = (temp32 << 16) # ig2a
-  np.divmod(raw[:,4,0],256, out['ig1'], temp32)
-  out['ig2'] |= (temp32 << 8) # ig2b
-  np.divmod(raw[:,4,1],256, out['ig3'], temp32)
-  out['ig2'] |= temp32 # ig2c
+  return _DecodedHeaders(raw)
+
+# Decoders for each entry of the record headers.
+# Each one takes the packed header words, and returns the decoded values.
+# Reference structure (from qstdir.h):
+# 0      word deleted:1, select:7, lng:24, addr:32;
+# 1      word deet:24, nbits: 8, ni:   24, gtyp:  8;
+# 2      word nj:24,  datyp: 8, nk:   20, ubc:  12;
+# 3      word npas: 26, pad7: 6, ig4: 24, ig2a:  8;
+# 4      word ig1:  24, ig2b:  8, ig3:  24, ig2c:  8;
+# 5      word etik15:30, pad1:2, etik6a:30, pad2:2;
+# 6      word etikbc:12, typvar:12, pad3:8, nomvar:24, pad4:8;
+# 7      word ip1:28, levtyp:4, ip2:28, pad5:4;
+# 8      word ip3:28, pad6:4, date_stamp:32;
+# (Based on fstd98.c)
+def _decode_chars (packed, nchars):
+  import numpy as np
+  nrecs = len(packed)
+  chars = np.empty((nrecs,nchars),dtype='ubyte')
+  for i in range(nchars):
+    chars[:,i] = ((packed >> ((nchars-1-i)*6)) & 0x3f) + 32
+  return chars.flatten().view('|S%d'%nchars)
+def _decode_etiket (raw, columns):
+  import numpy as np
   etik15 = raw[:,5,0]//4
   etik6a = raw[:,5,1]//4
-  et = raw[:,6,0]//256
-  etikbc, _typvar = divmod(et, 4096)
-  _nomvar = raw[:,6,1]//256
-  np.divmod(raw[:,7,0],16, out['ip1'], temp8)
-  out['ip2'][:] = raw[:,7,1]//16
-  out['ip3'][:] = raw[:,8,0]//16
-  date_stamp = raw[:,8,1]
-  # Reassemble and decode.
-  # (Based on fstd98.c)
-  etiket_bytes = np.empty((nrecs,12),dtype='ubyte')
-  for i in range(5):
-    etiket_bytes[:,i] = ((etik15 >> ((4-i)*6)) & 0x3f) + 32
-  for i in range(5,10):
-    etiket_bytes[:,i] = ((etik6a >> ((9-i)*6)) & 0x3f) + 32
-  etiket_bytes[:,10] = ((etikbc >> 6) & 0x3f) + 32
-  etiket_bytes[:,11] = (etikbc & 0x3f) + 32
-  out['etiket'][:] = etiket_bytes.flatten().view('|S12')
-  nomvar_bytes = np.empty((nrecs,4),dtype='ubyte')
-  for i in range(4):
-    nomvar_bytes[:,i] = ((_nomvar >> ((3-i)*6)) & 0x3f) + 32
-  out['nomvar'][:] = nomvar_bytes.flatten().view('|S4')
-  typvar_bytes = np.empty((nrecs,2),dtype='ubyte')
-  typvar_bytes[:,0] = ((_typvar >> 6) & 0x3f) + 32
-  typvar_bytes[:,1] = ((_typvar & 0x3f)) + 32
-  out['typvar'][:] = typvar_bytes.flatten().view('|S2')
-  out['datev'][:] = (date_stamp >> 3) * 10 + (date_stamp & 0x7)
+  etikbc = (raw[:,6,0]//256) // 4096
+  etiket_bytes = np.empty((len(raw),12),dtype='ubyte')
+  etiket_bytes[:,0:5] = _decode_chars(etik15,5)[:,None].view('ubyte')
+  etiket_bytes[:,5:10] = _decode_chars(etik6a,5)[:,None].view('ubyte')
+  etiket_bytes[:,10:12] = _decode_chars(etikbc,2)[:,None].view('ubyte')
+  return etiket_bytes.flatten().view('|S12')
+# Convert raw date stamps.
+def _decode_stamp (date_stamp):
+  return (date_stamp >> 3) * 10 + (date_stamp & 0x7)
+def _decode_dateo (raw, columns):
   # Note: this dateo calculation is based on my assumption that
   # the raw stamps increase in 5-second intervals.
   # Doing it this way to avoid a gazillion calls to incdat.
-  date_stamp = date_stamp - (out['deet']*out['npas'])//5
-  out['dateo'][:] = (date_stamp >> 3) * 10 + (date_stamp & 0x7)
-  out['xtra1'][:] = out['datev']
-  out['xtra2'][:] = 0
-  out['xtra3'][:] = 0
-  return out
+  date_stamp = raw[:,8,1] - (columns['deet']*columns['npas'])//5
+  return _decode_stamp(date_stamp)
+def _decode_ig2 (raw, columns):
+  ig2 = (raw[:,3,1]%256) << 16  # ig2a
+  ig2 |= (raw[:,4,0]%256) << 8  # ig2b
+  ig2 |= raw[:,4,1]%256         # ig2c
+  return ig2
+def _zeros (raw, columns):
+  import numpy as np
+  return np.zeros(len(raw),dtype='uint32')
+_header_decoders = (
+  ('lng', 'int32', lambda raw, columns: (raw[:,0,0]%2**24) * 2), # Convert from 8-byte to 4-byte units.
+  ('dltf', 'ubyte', lambda raw, columns: raw[:,0,0]//2**31),
+  ('swa', 'uint64', lambda raw, columns: raw[:,0,1]),
+  ('deet', 'int32', lambda raw, columns: raw[:,1,0]//256),
+  ('nbits', 'byte', lambda raw, columns: raw[:,1,0]%256),
+  ('grtyp', '|S1', lambda raw, columns: (raw[:,1,1]%256).astype('ubyte').view('|S1')),
+  ('ni', 'int32', lambda raw, columns: raw[:,1,1]//256),
+  ('nj', 'int32', lambda raw, columns: raw[:,2,0]//256),
+  ('datyp', 'ubyte', lambda raw, columns: raw[:,2,0]%256),
+  ('nk', 'int32', lambda raw, columns: raw[:,2,1]//4096),
+  ('ubc', 'uint16', lambda raw, columns: raw[:,2,1]%4096),
+  ('npas', 'int32', lambda raw, columns: raw[:,3,0]//64),
+  ('ig1', 'int32', lambda raw, columns: raw[:,4,0]//256),
+  ('ig2', 'int32', _decode_ig2),
+  ('ig3', 'int32', lambda raw, columns: raw[:,4,1]//256),
+  ('ig4', 'int32', lambda raw, columns: raw[:,3,1]//256),
+  ('etiket', '|S12', _decode_etiket),
+  ('typvar', '|S2', lambda raw, columns: _decode_chars((raw[:,6,0]//256)%4096, 2)),
+  ('nomvar', '|S4', lambda raw, columns: _decode_chars(raw[:,6,1]//256, 4)),
+  ('ip1', 'int32', lambda raw, columns: raw[:,7,0]//16),
+  ('ip2', 'int32', lambda raw, columns: raw[:,7,1]//16),
+  ('ip3', 'int32', lambda raw, columns: raw[:,8,0]//16),
+  ('datev', 'int32', lambda raw, columns: _decode_stamp(raw[:,8,1])),
+  ('dateo', 'int32', _decode_dateo),
+  ('xtra1', 'uint32', lambda raw, columns: columns['datev']),
+  ('xtra2', 'uint32', _zeros),
+  ('xtra3', 'uint32', _zeros),
+)
+_header_decoders = dict((key,(dtype,decoder)) for key,dtype,decoder in _header_decoders)
+
+# Container for decoded record headers.
+# Acts like a dictionary, but each entry is decoded from the packed header
+# words on first access.
+try:
+  from collections.abc import MutableMapping
+except ImportError:  # Python 2
+  from collections import MutableMapping
+class _DecodedHeaders (MutableMapping):
+  def __init__ (self, raw, columns=()):
+    self._raw = raw
+    self._keys = list(_header_decoders.keys())
+    self._columns = {}
+    self._assigned = set()
+    for key, value in dict(columns).items():
+      self[key] = value
+  def __len__ (self):
+    return len(self._keys)
+  def __iter__ (self):
+    return iter(list(self._keys))
+  def __contains__ (self, key):
+    return key in self._keys
+  def __getitem__ (self, key):
+    import numpy as np
+    if key not in self._columns:
+      if key not in self._keys or key not in _header_decoders:
+        raise KeyError(key)
+      dtype, decoder = _header_decoders[key]
+      self._columns[key] = np.asarray(decoder(self._raw,self),dtype=dtype)
+    return self._columns[key]
+  def __setitem__ (self, key, value):
+    if key not in self._keys:
+      self._keys.append(key)
+    self._columns[key] = value
+    self._assigned.add(key)
+  def __delitem__ (self, key):
+    self._keys.remove(key)
+    self._columns.pop(key,None)
+    self._assigned.discard(key)
+  def __getstate__ (self):
+    return {'_raw':self._raw, '_keys':self._keys, '_columns':self._columns, '_assigned':self._assigned}
+  def __setstate__ (self, state):
+    self.__dict__.update(state)
+  # Number of records.
+  @property
+  def nrecs (self):
+    return len(self._raw)
+  # Check if an entry was already decoded (or assigned).
+  def decoded (self, key):
+    return key in self._columns
+  # Decode an entry, without keeping the result (or any other entries that
+  # were needed for it).
+  def decode (self, key):
+    if key in self._columns:
+      return self._columns[key]
+    return _DecodedHeaders(self._raw)[key]
+  # Get a subset of the records.
+  def select (self, index):
+    out = _DecodedHeaders(self._raw[index])
+    out._keys = list(self._keys)
+    for key, value in self._columns.items():
+      out._columns[key] = value[index]
+    out._assigned = set(self._assigned)
+    return out
+  # Get the packed header words, along with the columns that can't be
+  # decoded from them.  The headers can be re-created from these with
+  # _DecodedHeaders(raw, columns).
+  def packed (self):
+    columns = dict((key,self._columns[key]) for key in self._keys if key in self._assigned)
+    return self._raw, columns
 
 
 def raw_headers (filename):
@@ -251,33 +600,89 @@ def raw_headers (filename):
   filename : string
       The file to scan for headers.
   '''
-  import numpy as np
   import os
+  import mmap
   if not os.path.exists(filename):
     return None
-  f = open(filename,'rb')
-  # Use same check as maybeFST
-  magic = f.read(16)
-  if len(magic) < 16 or magic[12:] != b'STDR':
-    f.close()
-    return None
-  # Get the raw (packed) parameters.
-  pageaddr = 27; pageno = 0
+  with open(filename,'rb') as f:
+    # Use same check as maybeFST
+    magic = f.read(16)
+    if len(magic) < 16 or magic[12:] != b'STDR':
+      return None
+    # Map the file into memory, so the directory pages can be accessed
+    # without any extra reads / copies.
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  with buf:
+    raw, position = _scan_pages(buf)
+  return raw.view('B').reshape(-1,72)
+
+
+def raw_headers_since (filename, nrecs, position=None):
+  '''
+  Extract record headers that were appended to the specified file since an
+  earlier scan.
+  Returns a raw byte array with shape (nnew,72), along with the position of
+  the last directory page (which can be passed to the next call).
+  NOTE: Only new records are returned.  Changes to the existing records
+        (such as records being erased) are not detected.
+
+  Parameters
+  ----------
+  filename : string
+      The file to scan for headers.
+  nrecs : int
+      The number of records found in the earlier scan.
+  position : tuple, optional
+      The position returned from the previous call to this function.
+  '''
+  import os
+  import mmap
+  if not os.path.exists(filename):
+    return None, position
+  with open(filename,'rb') as f:
+    magic = f.read(16)
+    if len(magic) < 16 or magic[12:] != b'STDR':
+      return None, position
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  # Start from the last known directory page (if available).
+  if position is None:
+    pageaddr, before = 27, 0
+  else:
+    pageaddr, before = position
+  with buf:
+    raw, (pageaddr, count) = _scan_pages(buf, pageaddr, nrecs-before)
+  return raw.view('B').reshape(-1,72), (pageaddr, before+count)
+
+# Helper method - follow the chain of directory pages in a memory-mapped FST
+# file, and collect the raw (packed) parameters.
+# The first 'skip' entries (starting from the given page) are ignored.
+# Also returns the address of the last page, and the number of entries
+# before that page, so a later scan can pick up from there.
+# The pages are only viewed in place, and copied once at the end.
+# Note: the views into the mapped file must all be released before returning,
+# otherwise the mapping can't be closed.
+def _scan_pages (buf, pageaddr=27, skip=0):
+  import numpy as np
+  pagesize = (8+256*18)*4
   raw = []
-  pageno_list = []
-  recno_list = []
-  while pageaddr > 0:
-    f.seek(pageaddr*8-8, 0)
-    page = np.fromfile(f, '>i4', 8+256*18)
-    params = page[8:].reshape(256,9,2)
-    nent = page[5]
-    raw.append(params[:nent].view('B').flatten())
-    recno_list.extend(list(range(nent)))
-    pageno_list.extend([pageno]*nent)
-    pageaddr = page[4]; pageno += 1
-  raw = np.concatenate(raw)
-  f.close()
-  return raw.reshape(-1,72)
+  visited = set()
+  last = (pageaddr, 0)
+  count = 0
+  while pageaddr > 0 and pageaddr not in visited:
+    visited.add(pageaddr)
+    offset = pageaddr*8-8
+    # Stop at a truncated page (file still being written?)
+    if offset + pagesize > len(buf): break
+    page = np.frombuffer(buf, '>i4', 8+256*18, offset)
+    nent = int(page[5])
+    start = min(max(skip-count,0),nent)
+    raw.append(page[8+start*18:8+nent*18])
+    last = (pageaddr, count)
+    count += nent
+    pageaddr = int(page[4])
+  # Note: np.concatenate gives native byte order, so convert back.
+  raw = np.concatenate(raw).astype('>i4',copy=False) if len(raw) > 0 else np.empty(0,'>i4')
+  return raw, last
 
 
 # Return the given arrays as a single structured array.
@@ -286,7 +691,7 @@ def raw_headers (filename):
 def structured_array (data):
   import numpy as np
   dtype = [(key,value.dtype) for key,value in data.items()]
-  n = len(list(data.values())[0])
+  n = len(next(iter(data.values())))
   out = np.ma.empty(n, dtype=dtype)
   for key in data.keys():
     out[key] = data[key]
@@ -27,19 +27,12 @@
 
 
 from fstd2nc.stdout import _, info, warn, error
-
-# Indicate if pandas should be used or not.
-_pandas_needed = False
-def _use_pandas ():
-  if not _pandas_needed: return False
-  try:
-    import pandas
-    return True
-  except ImportError:
-    return False
+from fstd2nc import stats
 
 # Decorator for efficiently converting a scalar function to a vectorized
 # function.
+# The scalar function is only evaluated once for each unique input value,
+# and the results are broadcast back using the inverse of the unique mapping.
 def vectorize (f):
   from functools import wraps
   import numpy as np
@@ -49,26 +42,848 @@ def vectorize (f):
     return cache[x]
   @wraps(f)
   def vectorized_f (x):
-    if _use_pandas():
-      from pandas import Series, unique
-      # If we're given a scalar value, then simply return it.
-      if not hasattr(x,'__len__'):
-        return f(x)
-      # Get unique values
-      x = np.array(x,copy=True)
-      inputs = unique(x)
-      outputs = map(f,inputs)
-      table = dict(zip(inputs,outputs))
-      result = Series(x).map(table)
-      return result.values
-    else:
-      # If we're given a scalar value, then simply return it.
-      if not hasattr(x,'__len__'):
-        return cached_f(x)
+    # If we're given a scalar value, then simply return it.
+    if not hasattr(x,'__len__'):
+      return cached_f(x)
+    # Masked values can't be passed through np.unique, so fall back to
+    # evaluating each element.
+    if np.ma.isMaskedArray(x) and np.ma.is_masked(x):
       return list(map(cached_f,x))
+    x = np.asarray(x)
+    try:
+      inputs, inverse = np.unique(x.ravel(), return_inverse=True)
+    except TypeError:
+      # Unorderable inputs (e.g. mixed object types).
+      return list(map(cached_f,x))
+    outputs = [cached_f(i) for i in inputs.tolist()]
+    # Use a regular array for simple (numeric / string / record) outputs.
+    # Anything else (tuples, dtypes, None, ...) goes into an object array,
+    # filled one element at a time to avoid numpy broadcasting sequences.
+    # Ragged array outputs also end up in an object array.
+    table = None
+    if all(isinstance(o,(np.ndarray,np.generic,int,float,str,bytes)) for o in outputs):
+      try:
+        table = np.array(outputs)
+      except ValueError:
+        pass
+    if table is None:
+      table = np.empty(len(outputs),dtype=object)
+      for i, o in enumerate(outputs):
+        table[i] = o
+    result = table[inverse.reshape(-1)]
+    return result.reshape(x.shape+table.shape[1:])
   return vectorized_f
 
 
+# Version of the on-disk header cache.
+_header_cache_version = 2
+
+# Wrapper for scanning the raw headers of a file, with an on-disk cache of
+# the result.
+# Each input file gets its own cache file, which is only used if the size,
+# modification time and inode of the input file are unchanged.
+# Files that didn't contain any headers are also remembered, so they don't
+# need to be opened again.
+def _cached_raw_headers (raw_headers, cache_dir, filename):
+  import numpy as np
+  import os
+  from hashlib import sha1
+  from tempfile import mkstemp
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return raw_headers(filename)
+  stamp = np.array([st.st_size, st.st_mtime_ns, st.st_ino], dtype='int64')
+  # Key on the full path, and also on the scanning method (so FSTD and CCC
+  # headers for the same file are kept separate).
+  # The version is bumped whenever the cached contents change, so older
+  # entries are ignored.
+  key = '%s.%s:%s:%d'%(raw_headers.__module__, raw_headers.__qualname__, os.path.abspath(filename), _header_cache_version)
+  key = sha1(key.encode('utf-8','surrogateescape')).hexdigest()
+  cachefile = os.path.join(cache_dir, key)
+  # Cache file format:
+  # size, mtime, inode, number of columns (-1 if no headers), raw headers.
+  try:
+    with open(cachefile,'rb') as f:
+      entry = np.fromfile(f,'int64',4)
+      if len(entry) == 4 and np.all(entry[:3] == stamp):
+        stats.count('header_cache_hits')
+        if entry[3] < 0: return None
+        return np.fromfile(f,'B').reshape(-1,entry[3])
+  except (OSError,ValueError):
+    pass
+  stats.count('header_cache_misses')
+  raw = raw_headers(filename)
+  # Write the new cache entry.
+  # Use a temporary file, so other processes never see a partial entry.
+  try:
+    fd, tmpfile = mkstemp(dir=cache_dir)
+  except OSError:
+    return raw
+  try:
+    with os.fdopen(fd,'wb') as f:
+      ncols = -1 if raw is None else raw.shape[1]
+      np.concatenate([stamp,[ncols]]).astype('int64').tofile(f)
+      if raw is not None:
+        np.ascontiguousarray(raw).view('B').tofile(f)
+    os.replace(tmpfile, cachefile)
+  except OSError:
+    os.remove(tmpfile)
+  return raw
+
+
+# Get a stamp for detecting when a file has been modified.
+# Returns None if the file can't be accessed.
+def _file_stamp (filename):
+  import os
+  try:
+    st = os.stat(filename)
+  except (OSError,TypeError):
+    return None
+  return [st.st_size, st.st_mtime_ns]
+
+# Helper method - convert other values for storing as JSON.
+def _json_default (value):
+  from pathlib import PurePath
+  if isinstance(value,PurePath):
+    return str(value)
+  if hasattr(value,'tolist'):  # numpy values
+    return value.tolist()
+  if isinstance(value,(set,frozenset)):
+    return sorted(value)
+  raise TypeError("Can't store %s as JSON."%type(value).__name__)
+
+# Helper class for storing the state of a Buffer in an index file, without
+# pickling.
+# Values are converted to JSON-compatible structures, with numpy arrays
+# collected separately (to be stored as .npy entries).
+# Anything other than plain JSON values is tagged with its type, so it can be
+# re-created the same way by _StateDecoder.
+class _StateEncoder (object):
+  def __init__ (self, obj):
+    self._obj = obj
+    self.arrays = dict()
+    self._packed = dict()
+  def _array (self, array):
+    import numpy as np
+    array = np.asarray(array)
+    if array.dtype.hasobject:
+      return {'__type__':'objects', 'shape':list(array.shape), 'items':[self.encode(v) for v in array.reshape(-1)]}
+    name = 'state_%d'%len(self.arrays)
+    self.arrays[name] = array
+    return {'__type__':'array', 'name':name}
+  def encode (self, value):
+    from collections import OrderedDict
+    from pathlib import PurePath
+    from types import MethodType
+    import numpy as np
+    # Note: numpy scalars are checked first, since some of them are also
+    # subclasses of the Python types.
+    if isinstance(value,np.generic):
+      return {'__type__':'scalar', 'value':self._array(value)}
+    if value is None or isinstance(value,(bool,int,float,str)):
+      return value
+    if isinstance(value,list):
+      return [self.encode(v) for v in value]
+    if isinstance(value,tuple):
+      return {'__type__':'tuple', 'items':[self.encode(v) for v in value]}
+    if isinstance(value,(set,frozenset)):
+      return {'__type__':'set', 'items':[self.encode(v) for v in value]}
+    if isinstance(value,dict):
+      return {'__type__':'odict' if isinstance(value,OrderedDict) else 'dict', 'items':[[self.encode(k),self.encode(v)] for k,v in value.items()]}
+    if isinstance(value,bytes):
+      return {'__type__':'bytes', 'value':value.decode('latin-1')}
+    if isinstance(value,PurePath):
+      return str(value)
+    if isinstance(value,np.dtype):
+      return {'__type__':'dtype', 'descr':self.encode(value.descr if value.names else value.str)}
+    if isinstance(value,type) and issubclass(value,np.generic):
+      return {'__type__':'scalar_type', 'descr':np.dtype(value).str}
+    if value is np.ma.masked:
+      return {'__type__':'masked_constant'}
+    if isinstance(value,np.ma.MaskedArray):
+      return {'__type__':'masked', 'data':self._array(np.ma.getdata(value)), 'mask':self._array(np.ma.getmaskarray(value))}
+    if isinstance(value,np.ndarray):
+      return self._array(value)
+    if isinstance(value,MethodType) and value.__self__ is self._obj:
+      cls = type(self._obj)
+      for name in dir(cls):
+        if getattr(cls,name,None) is value.__func__:
+          return {'__type__':'method', 'name':name}
+    if isinstance(value,_HeaderTable):
+      return {'__type__':'table', 'compacted':value._compacted, 'columns':[[key,self.encode(column)] for key,column in value._columns.items()]}
+    if isinstance(value,_CategoricalColumn):
+      return {'__type__':'categorical', 'codes':self.encode(value.codes), 'categories':self.encode(value.categories)}
+    if isinstance(value,_DowncastColumn):
+      return {'__type__':'downcast', 'data':self.encode(value.data), 'dtype':self.encode(value.dtype)}
+    if isinstance(value,_ConstantColumn):
+      return {'__type__':'constant', 'value':self.encode(value.constant), 'n':value.n}
+    if isinstance(value,_AliasColumn):
+      return {'__type__':'alias', 'key':value.key, 'dtype':self.encode(value.dtype), 'n':value.n}
+    if isinstance(value,_DerivedColumn) and value.func.__module__.startswith('fstd2nc'):
+      return {'__type__':'derived', 'module':value.func.__module__, 'func':value.func.__name__, 'keys':self.encode(value.keys), 'n':value.n}
+    if isinstance(value,_LazyColumn):
+      return {'__type__':'lazy', 'headers':self.encode(value.headers), 'key':value.key}
+    if hasattr(value,'packed'):
+      # Only store each set of packed headers once.
+      if id(value) not in self._packed:
+        self._packed[id(value)] = len(self._packed)
+        raw, columns = value.packed()
+        return {'__type__':'packed', 'id':self._packed[id(value)], 'raw':self._array(raw), 'columns':self.encode(dict(columns))}
+      return {'__type__':'packed', 'id':self._packed[id(value)]}
+    raise TypeError("Can't store %s in an index file."%type(value).__name__)
+
+# Re-create the values that were stored with _StateEncoder.
+# The packed headers are unpacked with the given function.
+class _StateDecoder (object):
+  def __init__ (self, obj, arrays, unpack):
+    self._obj = obj
+    self._arrays = arrays
+    self._unpack = unpack
+    self._packed = dict()
+  def decode (self, value):
+    from collections import OrderedDict
+    from importlib import import_module
+    import numpy as np
+    if isinstance(value,list):
+      return [self.decode(v) for v in value]
+    if not isinstance(value,dict):
+      return value
+    t = value['__type__']
+    if t == 'array':
+      return self._arrays[value['name']]
+    if t == 'objects':
+      array = np.empty(len(value['items']), dtype=object)
+      for i, v in enumerate(value['items']):
+        array[i] = self.decode(v)
+      return array.reshape(value['shape'])
+    if t == 'tuple':
+      return tuple(self.decode(v) for v in value['items'])
+    if t == 'set':
+      return set(self.decode(v) for v in value['items'])
+    if t in ('dict','odict'):
+      items = [(self.decode(k),self.decode(v)) for k,v in value['items']]
+      return OrderedDict(items) if t == 'odict' else dict(items)
+    if t == 'bytes':
+      return value['value'].encode('latin-1')
+    if t == 'dtype':
+      descr = self.decode(value['descr'])
+      if isinstance(descr,list):
+        descr = [tuple(d) for d in descr]
+      return np.dtype(descr)
+    if t == 'scalar_type':
+      return np.dtype(value['descr']).type
+    if t == 'masked_constant':
+      return np.ma.masked
+    if t == 'masked':
+      return np.ma.MaskedArray(self.decode(value['data']), mask=self.decode(value['mask']))
+    if t == 'scalar':
+      return self.decode(value['value'])[()]
+    if t == 'method':
+      return getattr(self._obj, value['name'])
+    if t == 'table':
+      table = _HeaderTable()
+      for key, column in value['columns']:
+        table._columns[key] = self.decode(column)
+      table._compacted = value['compacted']
+      return table
+    if t == 'categorical':
+      return _CategoricalColumn(self.decode(value['codes']), self.decode(value['categories']))
+    if t == 'downcast':
+      return _DowncastColumn(self.decode(value['data']), self.decode(value['dtype']))
+    if t == 'constant':
+      return _ConstantColumn(self.decode(value['value']), value['n'])
+    if t == 'alias':
+      return _AliasColumn(value['key'], self.decode(value['dtype']), value['n'])
+    if t == 'derived':
+      if not value['module'].startswith('fstd2nc'):
+        raise ValueError("Unexpected function for derived column.")
+      func = getattr(import_module(value['module']), value['func'])
+      return _DerivedColumn(func, self.decode(value['keys']), value['n'])
+    if t == 'lazy':
+      return _LazyColumn(self.decode(value['headers']), value['key'])
+    if t == 'packed':
+      if value['id'] not in self._packed:
+        self._packed[value['id']] = self._unpack(self.decode(value['raw']), self.decode(value['columns']))
+      return self._packed[value['id']]
+    raise ValueError("Unknown type '%s' in index file."%t)
+
+
+# Group records that have the same values in all the given columns.
+# Returns a list of record indices for each group.
+# The groups are sorted by their values (first column being the most
+# significant), and the indices within each group are in ascending order.
+def _group_records (columns):
+  import numpy as np
+  n = len(columns[0])
+  if n == 0: return []
+  # Combine the columns into a single integer key.
+  key = np.zeros(n, dtype='int64')
+  nkeys = 1
+  for column in columns:
+    values, codes = np.unique(column, return_inverse=True)
+    codes = codes.reshape(-1)
+    # Re-number the combined keys if they would get too large.
+    if nkeys * len(values) >= 2**62:
+      _, key = np.unique(key, return_inverse=True)
+      key = key.reshape(-1).astype('int64')
+      nkeys = int(key.max())+1
+    key *= len(values)
+    key += codes
+    nkeys *= len(values)
+  # Split into groups.
+  order = np.argsort(key, kind='stable')
+  key = key[order]
+  bounds = np.where(key[1:] != key[:-1])[0] + 1
+  return np.split(order, bounds)
+
+# Helper method - find which groups of records have a consistent value for
+# a column.
+# The column must already be sorted by group, with group_ids giving the
+# (non-decreasing) group number of each record.
+# Missing (masked) values are ignored.
+# Returns a boolean array indicating which groups are consistent, and the
+# index of a representative record for each of those groups.
+def _consistent_values (column, group_ids, ngroups):
+  import numpy as np
+  keep = np.where(~np.ma.getmaskarray(column))[0]
+  values = np.ma.getdata(column)[keep]
+  group_ids = group_ids[keep]
+  present = np.bincount(group_ids, minlength=ngroups) > 0
+  # Look for any change of value within a group.
+  changed = (values[1:] != values[:-1]) & (group_ids[1:] == group_ids[:-1])
+  differs = np.bincount(group_ids[1:][changed], minlength=ngroups) > 0
+  first = np.searchsorted(group_ids, np.arange(ngroups))
+  first = keep[np.minimum(first,len(keep)-1)] if len(keep) > 0 else first
+  return present & ~differs, first
+
+
+# Helper method - find a way to split an array of record ids into pieces
+# with better coverage.
+# E.g., if a field has surface-level output for some times, and 3D output
+# for other times.
+# The slices along one of the axes are grouped by their pattern of available
+# records, then each group is trimmed to the values of the other axes that
+# have records.  The axis that leaves the fewest missing records is used,
+# as long as it doesn't need more than max_pieces pieces.
+# Returns a list of pieces, where each piece is a list of indices (one for
+# each axis).
+def _split_coverage (record_id, max_pieces=4):
+  import numpy as np
+  have = (record_id >= 0)
+  everything = [[np.arange(n) for n in have.shape]]
+  if have.ndim == 0: return everything
+  best = (have.size - np.count_nonzero(have), 1)
+  pieces = everything
+  for dim in range(have.ndim):
+    patterns = np.moveaxis(have,dim,0).reshape(have.shape[dim],-1)
+    _, codes = np.unique(patterns, axis=0, return_inverse=True)
+    codes = codes.reshape(-1)
+    candidate = []
+    missing = 0
+    for c in np.unique(codes):
+      index = [np.arange(n) for n in have.shape]
+      index[dim] = np.where(codes==c)[0]
+      sub = have[np.ix_(*index)]
+      # Only keep the values of the other axes that have any records.
+      for d in range(have.ndim):
+        if d == dim: continue
+        keep = np.any(sub, axis=tuple(x for x in range(have.ndim) if x != d))
+        index[d] = index[d][keep]
+      sub = have[np.ix_(*index)]
+      if sub.size == 0: continue
+      missing += sub.size - np.count_nonzero(sub)
+      candidate.append(index)
+    if len(candidate) > max_pieces: continue
+    if (missing,len(candidate)) < best:
+      best = (missing,len(candidate))
+      pieces = sorted(candidate, key=lambda index: index[dim][0])
+  return pieces
+
+# Helper class for collecting columns of header information, when the final
+# number of records isn't known in advance.
+# The columns are stored in arrays that grow as needed, and are trimmed to
+# their final size at the end.
+# Headers that can be decoded from packed words (i.e. they have a packed()
+# method, like fstd2nc.extra._DecodedHeaders) are collected in packed form,
+# and only get decoded when the final columns are accessed.
+class _ColumnBuilder (object):
+  def __init__ (self):
+    self._columns = dict()
+    self._nrecs = 0
+    self._packed_type = None
+  def __len__ (self):
+    return self._nrecs
+  # Append a chunk of records.
+  # Scalar values are broadcast over all the new records.
+  def append (self, columns):
+    import numpy as np
+    if hasattr(columns,'packed'):
+      self._packed_type = type(columns)
+      raw, columns = columns.packed()
+      columns = dict(columns, _packed=raw)
+    n = max(len(v) for v in columns.values() if np.ndim(v) > 0)
+    if len(self._columns) > 0 and set(columns.keys()) != set(self._columns.keys()):
+      raise ValueError("Inconsistent header columns")
+    start, end = self._nrecs, self._nrecs + n
+    for key, value in columns.items():
+      value = np.asarray(value)
+      if key not in self._columns:
+        self._columns[key] = np.empty((n,)+value.shape[1:], dtype=value.dtype)
+      column = self._columns[key]
+      if end > len(column):
+        # Note: nothing else has a reference to these arrays, so they can be
+        # resized in place.
+        column.resize((max(end,len(column)*3//2),)+column.shape[1:], refcheck=False)
+      column[start:end] = value
+    self._nrecs = end
+  # Return the final columns.
+  def finish (self):
+    for column in self._columns.values():
+      column.resize((self._nrecs,)+column.shape[1:], refcheck=False)
+    columns = self._columns
+    self._columns = dict()
+    if '_packed' in columns:
+      raw = columns.pop('_packed')
+      return self._packed_type(raw, columns)
+    return columns
+
+
+# Compact storage for columns of the header table.
+# Each of these encodings holds the information for one column, and
+# can reconstruct the full column on demand.
+
+# Dictionary encoding (for columns with many repeated values).
+class _CategoricalColumn (object):
+  def __init__ (self, codes, categories):
+    self.codes = codes
+    self.categories = categories
+  def __len__ (self):
+    return len(self.codes)
+  def materialize (self, table):
+    return self.categories[self.codes]
+  def value (self, table, rec):
+    return self.categories[self.codes[rec]]
+
+# Integer values stored in a smaller integer type.
+class _DowncastColumn (object):
+  def __init__ (self, data, dtype):
+    self.data = data
+    self.dtype = dtype
+  def __len__ (self):
+    return len(self.data)
+  def materialize (self, table):
+    return self.data.astype(self.dtype)
+  def value (self, table, rec):
+    return self.dtype.type(self.data[rec])
+
+# Same value for all records.
+class _ConstantColumn (object):
+  def __init__ (self, value, n):
+    self.constant = value
+    self.n = n
+  def __len__ (self):
+    return self.n
+  def materialize (self, table):
+    import numpy as np
+    return np.full(self.n, self.constant, dtype=self.constant.dtype)
+  def value (self, table, rec):
+    return self.constant[()]
+
+# Same values as another column (possibly with a different dtype).
+class _AliasColumn (object):
+  def __init__ (self, key, dtype, n):
+    self.key = key
+    self.dtype = dtype
+    self.n = n
+  def __len__ (self):
+    return self.n
+  def sources (self):
+    return (self.key,)
+  def materialize (self, table):
+    return table[self.key].astype(self.dtype)
+  def value (self, table, rec):
+    return self.dtype.type(table.value(self.key,rec))
+
+# Computed from other columns when needed.
+# Note: the function should be defined at module level, so the table can
+# still be pickled.
+class _DerivedColumn (object):
+  def __init__ (self, func, keys, n):
+    self.func = func
+    self.keys = keys
+    self.n = n
+  def __len__ (self):
+    return self.n
+  def sources (self):
+    return self.keys
+  def materialize (self, table):
+    return self.func(*[table[key] for key in self.keys])
+  def value (self, table, rec):
+    import numpy as np
+    return np.asarray(self.func(*[table.value(key,rec) for key in self.keys]))[()]
+
+# Decoded from the packed header words when it's first needed (see
+# fstd2nc.extra._DecodedHeaders).
+class _LazyColumn (object):
+  def __init__ (self, headers, key):
+    self.headers = headers
+    self.key = key
+  def __len__ (self):
+    return self.headers.nrecs
+  def materialize (self, table):
+    return self.headers.decode(self.key)
+  def value (self, table, rec):
+    return table[self.key][rec]
+
+# Table of record headers.
+# Acts like a dictionary of numpy arrays (one entry per record), but
+# can store the columns in a more compact form.
+# Headers that can be decoded on demand (like fstd2nc.extra._DecodedHeaders)
+# are only decoded one column at a time, when the column is first accessed.
+# The decoded values then replace the packed form of that column.
+# Columns that are stored in compact form are reconstructed when they are
+# accessed, and are returned as read-only arrays.  To modify them, assign a
+# new array into the table.
+# Only the most recently used reconstructed columns are cached, so columns
+# that are accessed for each record should be kept as regular arrays (see the
+# 'keep' argument of compact()).
+# The table keeps a version counter, which is increased whenever a column is
+# assigned or removed.  Code that modifies a column in place should call
+# touch() afterwards.
+try:
+  from collections.abc import MutableMapping
+except ImportError:  # Python 2
+  from collections import MutableMapping
+class _HeaderTable (MutableMapping):
+  # Number of reconstructed columns to keep around.
+  _cache_size = 16
+  def __init__ (self, columns=()):
+    from collections import OrderedDict
+    from threading import RLock
+    self._columns = OrderedDict()
+    self._cache = OrderedDict()
+    self._lock = RLock()
+    self.version = 0
+    self._compacted = False
+    if hasattr(columns,'decoded'):
+      for key in columns:
+        if columns.decoded(key):
+          self._columns[key] = columns[key]
+        else:
+          self._columns[key] = _LazyColumn(columns, key)
+    else:
+      self.update(columns)
+  def __getstate__ (self):
+    return {'_columns':self._columns, '_compacted':self._compacted}
+  def __setstate__ (self, state):
+    from collections import OrderedDict
+    from threading import RLock
+    self._columns = state['_columns']
+    self._cache = OrderedDict()
+    self._lock = RLock()
+    self.version = 0
+    self._compacted = state.get('_compacted',False)
+  def __len__ (self):
+    return len(self._columns)
+  def __iter__ (self):
+    return iter(self._columns)
+  def __contains__ (self, key):
+    return key in self._columns
+  def __getitem__ (self, key):
+    column = self._columns[key]
+    if not hasattr(column,'materialize'):
+      return column
+    if isinstance(column,_LazyColumn):
+      return self._decode_column(key, column)
+    if isinstance(column,_AliasColumn) and column.dtype == self._dtype(column.key):
+      return self[column.key]
+    with self._lock:
+      if key in self._cache:
+        self._cache.move_to_end(key)
+        stats.count('column_cache_hits')
+        return self._cache[key]
+      stats.count('column_cache_misses')
+      array = column.materialize(self)
+      array.flags.writeable = False
+      self._cache[key] = array
+      while len(self._cache) > self._cache_size:
+        self._cache.popitem(last=False)
+      return array
+  def __setitem__ (self, key, value):
+    with self._lock:
+      self._release(key)
+      self._columns[key] = value
+      self.version += 1
+  def __delitem__ (self, key):
+    with self._lock:
+      self._release(key)
+      del self._columns[key]
+      self.version += 1
+  def touch (self):
+    """
+    Indicate that a column was modified in place.
+    """
+    with self._lock:
+      self.version += 1
+  # Decode a column that's still in packed form, and keep the result.
+  # If the table was already compacted, then the result is compacted too.
+  def _decode_column (self, key, column):
+    with self._lock:
+      if self._columns.get(key) is column:
+        array = column.materialize(self)
+        if self._compacted:
+          array = self._compact_column(key, array, dict())
+        self._columns[key] = array
+    return self[key]
+  # Prepare for a column to be replaced or removed.
+  # Any columns that depend on it are converted to regular arrays.
+  def _release (self, key):
+    for other, column in list(self._columns.items()):
+      if key in getattr(column,'sources',tuple)():
+        self._columns[other] = column.materialize(self)
+    self._cache.pop(key,None)
+  def _dtype (self, key):
+    column = self._columns[key]
+    if isinstance(column,_CategoricalColumn):
+      return column.categories.dtype
+    if isinstance(column,_ConstantColumn):
+      return column.constant.dtype
+    if isinstance(column,(_DerivedColumn,_LazyColumn)):
+      return self[key].dtype
+    return column.dtype
+  def copy (self):
+    table = type(self)()
+    table._columns.update(self._columns)
+    table._compacted = self._compacted
+    return table
+  @property
+  def nrecs (self):
+    """
+    Number of records in the table.
+    """
+    return max([len(column) for column in self._columns.values()]+[0])
+  def value (self, key, rec):
+    """
+    Get a single value from the table, without reconstructing the whole
+    column.
+    """
+    column = self._columns[key]
+    if not hasattr(column,'value'):
+      return column[rec]
+    with self._lock:
+      if key in self._cache:
+        return self._cache[key][rec]
+    return column.value(self,rec)
+  def row (self, rec):
+    """
+    Get all the values for a single record, as a dictionary.
+    """
+    return dict((key,self.value(key,rec)) for key in self._columns.keys())
+  def merge (self, other, index, headers=None, defaults=None, keep=()):
+    """
+    Combine with the records from another table, and return the result.
+    The first len(index) records of the other table are updated versions of
+    the records at the given positions in this table, and the rest of them
+    are appended at the end.
+    Compact columns stay compact where the new values allow it.
+    Columns that weren't decoded yet (in either table) are taken from
+    'headers', which should contain the packed headers for all the records.
+    Columns that are only in one of the tables are filled in from
+    'defaults', or raise a ValueError if there is no default.
+    The columns listed in 'keep' are stored as regular arrays.
+    """
+    import numpy as np
+    defaults = defaults or {}
+    index = np.asarray(index,dtype=int)
+    n = self.nrecs + other.nrecs - len(index)
+    keys = list(self._columns.keys())
+    keys.extend(key for key in other._columns.keys() if key not in self._columns)
+    for key in keys:
+      if key not in defaults and (key not in self._columns or key not in other._columns):
+        raise ValueError("Inconsistent header columns")
+    table = type(self)()
+    table._compacted = self._compacted
+    with self._lock:
+      for key in keys:
+        table._columns[key] = self._merge_column(key, other, index, n, headers, defaults.get(key), key in keep)
+    return table
+  def _merge_column (self, key, other, index, n, headers, default, keep):
+    import numpy as np
+    k = len(index)
+    if key in self._columns:
+      column = self._columns[key]
+    else:
+      column = _ConstantColumn(np.array(default,dtype=other._dtype(key)), self.nrecs)
+    if key in other._columns:
+      update = other._columns[key]
+      values = other[key]
+    else:
+      update = _ConstantColumn(np.array(default,dtype=self._dtype(key)), other.nrecs)
+      values = update.materialize(other)
+    # Columns that are defined in terms of other columns stay that way.
+    if not keep:
+      if isinstance(column,_DerivedColumn) and isinstance(update,_DerivedColumn) and (column.func,column.keys) == (update.func,update.keys):
+        return _DerivedColumn(column.func, column.keys, n)
+      if isinstance(column,_AliasColumn) and isinstance(update,_AliasColumn) and column.key == update.key:
+        return _AliasColumn(column.key, column.dtype, n)
+      if isinstance(column,_LazyColumn) and isinstance(update,_LazyColumn) and headers is not None and headers.nrecs == n:
+        return _LazyColumn(headers, key)
+    # Check if the updated records have different values.
+    changed = not _same_values(self._take(column,index), values[:k])
+    encoded = hasattr(column,'materialize')
+    if not changed and not keep and encoded:
+      merged = _append_compact(column, values[k:], n)
+      if merged is not None:
+        return merged
+    array = column.materialize(self) if encoded else column
+    array = _concatenate([array, values[k:]])
+    array[index] = values[:k]
+    if encoded and self._compacted and not keep:
+      return self._compact_column(key, array, dict())
+    return array
+  # Get the values of a column at the given positions.
+  def _take (self, column, index):
+    import numpy as np
+    if not hasattr(column,'materialize'):
+      return column[index]
+    if isinstance(column,_CategoricalColumn):
+      return column.categories[column.codes[index]]
+    if isinstance(column,_DowncastColumn):
+      return column.data[index].astype(column.dtype)
+    if isinstance(column,_ConstantColumn):
+      return np.full(len(index), column.constant, dtype=column.constant.dtype)
+    return column.materialize(self)[index]
+  def derive (self, key, func, *keys):
+    """
+    Define a column that gets computed from other columns when it's needed.
+    """
+    n = len(self._columns[keys[0]])
+    self[key] = _DerivedColumn(func, keys, n)
+  def compact (self, keep=()):
+    """
+    Convert the columns into a more compact form, where possible.
+      - Object and string columns are dictionary-encoded.
+      - Integer columns are stored in the smallest type that fits the values.
+      - Constant columns are stored as a single value.
+      - Duplicate columns are stored as references to the original column.
+    Masked arrays are left as-is.
+    Columns that were never decoded are left in packed form, and get
+    compacted once they're decoded.
+    The columns listed in 'keep' are stored as regular arrays (even if they
+    were derived from other columns).
+    NOTE: The compacted columns are read-only after this.
+    """
+    import numpy as np
+    with self._lock:
+      for key in keep:
+        if hasattr(self._columns.get(key),'materialize'):
+          self._columns[key] = self._columns[key].materialize(self)
+      self._cache.clear()
+      seen = dict()
+      signatures = dict()
+      for key, column in list(self._columns.items()):
+        if type(column) is not np.ndarray: continue
+        if key in keep:
+          seen.setdefault(id(column), key)
+          continue
+        if column.ndim != 1 or len(column) == 0: continue
+        # Check if this is the same array as a previous column.
+        if id(column) in seen:
+          self._columns[key] = _AliasColumn(seen[id(column)], column.dtype, len(column))
+          continue
+        seen[id(column)] = key
+        self._columns[key] = self._compact_column(key, column, signatures)
+      self._compacted = True
+  def _compact_column (self, key, column, signatures):
+    import numpy as np
+    n = len(column)
+    if column.dtype.kind in 'iu':
+      lo, hi = column.min(), column.max()
+      if lo == hi:
+        return _ConstantColumn(np.array(lo,dtype=column.dtype), n)
+      # Check for duplicate of another integer column.
+      for other, (array, signature) in signatures.items():
+        if signature == (lo,hi) and np.array_equal(array,column):
+          return _AliasColumn(other, column.dtype, n)
+      signatures[key] = (column, (lo,hi))
+      dtype = np.result_type(np.min_scalar_type(lo),np.min_scalar_type(hi))
+      if dtype.itemsize < column.dtype.itemsize:
+        return _DowncastColumn(column.astype(dtype), column.dtype)
+      return column
+    if column.dtype.kind == 'S':
+      categories, codes = np.unique(column, return_inverse=True)
+    elif column.dtype.kind == 'O':
+      index = dict()
+      try:
+        codes = np.fromiter((index.setdefault(v,len(index)) for v in column), dtype='int64', count=n)
+      except TypeError:  # Unhashable values
+        return column
+      categories = np.empty(len(index), dtype=object)
+      for v, i in index.items():
+        categories[i] = v
+    else:
+      return column
+    if len(categories) > n//2:
+      return column
+    return _CategoricalColumn(codes.astype(np.min_scalar_type(len(categories)-1)), categories)
+
+# Helper functions for combining header columns (see _HeaderTable.merge).
+
+# Check if two columns have the same values (including any masks).
+def _same_values (a, b):
+  import numpy as np
+  if len(a) != len(b): return False
+  if len(a) == 0: return True
+  mask = np.ma.getmaskarray(a)
+  if not np.array_equal(mask, np.ma.getmaskarray(b)):
+    return False
+  return bool(np.all((np.ma.getdata(a) == np.ma.getdata(b)) | mask))
+
+# Join columns together, keeping any masks.
+def _concatenate (arrays):
+  import numpy as np
+  if any(isinstance(array,np.ma.MaskedArray) for array in arrays):
+    return np.ma.concatenate(arrays)
+  return np.concatenate(arrays)
+
+# Append values to a compact column, without reconstructing it.
+# Returns None if the values don't fit in the same encoding.
+def _append_compact (column, values, n):
+  import numpy as np
+  values = np.asarray(values)
+  if len(values) == 0:
+    if isinstance(column,_ConstantColumn):
+      return _ConstantColumn(column.constant, n)
+    return column
+  if isinstance(column,_ConstantColumn):
+    if np.all(values == column.constant):
+      return _ConstantColumn(column.constant, n)
+    return None
+  if isinstance(column,_DowncastColumn):
+    if values.dtype.kind not in 'iu': return None
+    dtype = column.data.dtype
+    if not np.can_cast(np.min_scalar_type(values.min()),dtype) or not np.can_cast(np.min_scalar_type(values.max()),dtype):
+      return None
+    return _DowncastColumn(np.concatenate([column.data,values.astype(dtype)]), column.dtype)
+  if isinstance(column,_CategoricalColumn):
+    categories = column.categories
+    if categories.dtype.kind == 'O':
+      lookup = dict((v,i) for i,v in enumerate(categories))
+      try:
+        codes = np.array([lookup.get(v,-1) for v in values])
+      except TypeError:  # Unhashable values
+        return None
+    else:
+      if values.dtype.kind != categories.dtype.kind: return None
+      codes = np.searchsorted(categories, values)
+      codes[codes == len(categories)] = 0
+      codes[categories[codes] != values] = -1
+    if np.any(codes < 0): return None
+    return _CategoricalColumn(np.concatenate([column.codes,codes.astype(column.codes.dtype)]), categories)
+  return None
+
+
 class _base_type (object):
   @property
   def shape(self):
@@ -140,12 +955,244 @@ class _chunk_type (_base_type):
     self.record_id = record_id
     self.deps = []
 
+# Registry of unique axes and coordinates.
+# Objects are identified by their name and a hash of their contents, so
+# duplicates can be found without converting the values to tuples.
+# Since the objects may get modified after they're registered, a match is
+# double-checked against the current contents before it's used.
+class _Registry (object):
+  def __init__ (self):
+    self._objects = dict()
+  # Get a key for the object, based on its contents.
+  @staticmethod
+  def _key (obj):
+    from hashlib import blake2b
+    import numpy as np
+    if isinstance(obj,_dim_type):
+      return (type(obj), obj.name, len(obj))
+    array = np.asarray(obj.array)
+    digest = blake2b(digest_size=16)
+    if array.dtype.hasobject:
+      digest.update(repr(array.tolist()).encode())
+    else:
+      digest.update(np.ascontiguousarray(array).reshape(-1).view('uint8'))
+    # Coordinates also need to be defined on the same axes.
+    axes = () if isinstance(obj,_axis_type) else tuple(map(id,obj.axes))
+    return (type(obj), obj.name, array.dtype.str, array.shape, axes, digest.digest())
+  # Check if two objects (with the same key) are really the same.
+  @staticmethod
+  def _same (obj1, obj2):
+    import numpy as np
+    if obj1 is obj2: return True
+    if isinstance(obj1,_dim_type): return True
+    a1 = np.asarray(obj1.array)
+    a2 = np.asarray(obj2.array)
+    if a1.dtype.hasobject: return a1.tolist() == a2.tolist()
+    return a1.tobytes() == a2.tobytes()
+  def intern (self, obj):
+    """
+    Get the canonical version of an axis / coordinate.
+    If no equivalent object was registered yet, then obj itself is
+    registered and returned.
+    """
+    key = self._key(obj)
+    existing = self._objects.get(key)
+    if existing is not None and existing.name == obj.name and self._key(existing) == key and self._same(existing,obj):
+      return existing
+    self._objects[key] = obj
+    return obj
+
+# Index of the data objects that can be reached from a list of variables
+# (through their axes, attributes and dependencies).
+# The direct links of each object are only looked up once, so the objects
+# can be traversed many times without going through all the attributes
+# again.
+# The graph is not aware of any changes made to the objects.  Axes can be
+# swapped out with replace_axis(), otherwise a new graph is needed.
+class _ObjectGraph (object):
+  _data_types = (_iter_type,_chunk_type,_var_type,_axis_type,_dim_type)
+  _plain_types = (str,bytes,int,float)
+  def __init__ (self, roots):
+    self._roots = self._find_links((roots,))
+    self._links = dict()
+    self._objects = None
+    self._axis_users = None
+  def __getstate__ (self):
+    return {'_roots':self._roots}
+  def __setstate__ (self, state):
+    self.__init__(state['_roots'])
+  # Find the data objects directly referenced from the given items,
+  # in the order they would be encountered.
+  @classmethod
+  def _find_links (cls, items):
+    from itertools import chain
+    out = []
+    stack = [iter(items)]
+    while len(stack) > 0:
+      for item in stack[-1]:
+        if isinstance(item,cls._plain_types):
+          continue
+        if isinstance(item,cls._data_types):
+          out.append(item)
+          continue
+        if isinstance(item,list):
+          stack.append(iter(item))
+          break
+        if isinstance(item,dict):
+          stack.append(chain.from_iterable(item.items()))
+          break
+        members = [getattr(item,n) for n in ('axes','atts','deps') if hasattr(item,n)]
+        if len(members) > 0:
+          stack.append(iter(members))
+          break
+      else:
+        stack.pop()
+    return out
+  # Get the data objects directly referenced by the given object.
+  def links (self, obj):
+    if id(obj) not in self._links:
+      members = [getattr(obj,n) for n in ('axes','atts','deps') if hasattr(obj,n)]
+      # Keep a reference to the object, so its id stays valid.
+      self._links[id(obj)] = (obj, self._find_links(members))
+    return self._links[id(obj)][1]
+  def walk (self, obj, handled):
+    """
+    Iterate over all data objects that can be reached from obj (depth-first),
+    skipping the ones that are already in handled.
+    """
+    stack = [iter(self._find_links((obj,)))]
+    while len(stack) > 0:
+      for o in stack[-1]:
+        if id(o) in handled: continue
+        handled.add(id(o))
+        yield o
+        stack.append(iter(self.links(o)))
+        break
+      else:
+        stack.pop()
+  @property
+  def objects (self):
+    """
+    List of all the data objects in the graph.
+    """
+    if self._objects is None:
+      self._objects = list(self.walk(self._roots,set()))
+    return self._objects
+  def axis_users (self):
+    """
+    Dictionary of the axes in the graph, along with the objects using them.
+    Keyed by id(axis), with values of (axis, list of objects).
+    """
+    from collections import OrderedDict
+    if self._axis_users is None:
+      users = OrderedDict()
+      for obj in self.objects:
+        for axis in getattr(obj,'axes',()):
+          users.setdefault(id(axis),(axis,[]))[1].append(obj)
+      self._axis_users = users
+    return self._axis_users
+  def replace_axis (self, obj, index, axis):
+    """
+    Replace an axis of an object, and update the graph.
+    """
+    obj.axes[index] = axis
+    self._links.pop(id(obj),None)
+    self._objects = None
+    self._axis_users = None
+
+# List the contents of a directory.
+# Returns the files, and the (path, real path) of the subdirectories, sorted
+# by name.
+def _list_directory (path):
+  import os
+  files = []
+  subdirs = []
+  try:
+    with os.scandir(path) as entries:
+      for entry in entries:
+        try:
+          is_dir = entry.is_dir()  # Note: follows symlinks.
+        except OSError:
+          is_dir = False
+        if is_dir:
+          subdirs.append((entry.path,os.path.realpath(entry.path)))
+        else:
+          files.append(entry.path)
+  except OSError:
+    pass  # Unreadable directory (same as os.walk).
+  return sorted(files), sorted(subdirs)
+
+# Walk through a directory tree, yielding the files that are found.
+# The directory listings are done in parallel, with the subdirectories
+# being listed as soon as they are discovered.
+# The files are generated in a depth-first order (files first, then
+# subdirectories), similar to os.walk.
+# With only 1 worker, the directories are listed in the current thread.
+def _walk_directory (top, nworkers=8):
+  import os
+  from multiprocessing.pool import ThreadPool
+  if nworkers <= 1:
+    stack = [(top,(os.path.realpath(top),))]
+    while len(stack) > 0:
+      path, parents = stack.pop()
+      files, subdirs = _list_directory(path)
+      pending = [(subdir,parents+(realpath,)) for subdir, realpath in subdirs if realpath not in parents]
+      stack.extend(reversed(pending))
+      for f in files:
+        yield f
+    return
+  with ThreadPool(nworkers) as pool:
+    # Directory listings that are in progress, along with the real paths
+    # of their parent directories (to detect symlink loops).
+    stack = [(pool.apply_async(_list_directory,(top,)),(os.path.realpath(top),))]
+    while len(stack) > 0:
+      listing, parents = stack.pop()
+      files, subdirs = listing.get()
+      pending = []
+      for subdir, realpath in subdirs:
+        if realpath in parents: continue
+        pending.append((pool.apply_async(_list_directory,(subdir,)),parents+(realpath,)))
+      stack.extend(reversed(pending))
+      for f in files:
+        yield f
+
+# Helper for scanning a single (input entry, filename) pair.
+def _scan_entry (raw_headers, entry):
+  return entry, raw_headers(entry[1])
+
+# Helper method - copy decoded values into an output array.
+# The output array only needs to have the same number of elements, the
+# values are reshaped and cast as needed.
+def _copy_to (out, values):
+  import numpy as np
+  if out.flags.c_contiguous:
+    np.copyto(out.reshape(values.shape), values, casting='unsafe')
+  else:
+    np.copyto(out, values.reshape(out.shape), casting='unsafe')
+  return out
+
+# Helper method - decode records one at a time, using the _decode method
+# from the given mixin (and the mixins after it).
+# Used by _decode_many when the records can't be decoded in bulk.
+def _decode_each (mixin, cls, records, out=None):
+  import numpy as np
+  decode = mixin._decode.__func__
+  for i, kwargs in enumerate(records):
+    if out is None:
+      d = decode(cls, **kwargs)
+      out = np.empty((len(records),)+d.shape, dtype=d.dtype)
+      out[i] = d
+    else:
+      decode(cls, out=out[i], **kwargs)
+  return out
+
 # Fake progress bar - does nothing.
 class _FakeBar (object):
   def __init__ (self, *args, **kwargs): pass
   def iter(self, it):
     for i in it: yield i
   def __next__(self): pass
+  def next(self, n=1): pass
   def finish(self): pass
 
 # Try importing progress module.
@@ -206,6 +1253,14 @@ class BufferBase (object):
   # variable.
   _maybe_meta_records = ()
 
+  # Whether to split variables with partial coverage into separate pieces.
+  _split_partial_coverage = False
+
+  # Columns from the decoded headers that have their final values at scan
+  # time (not modified by any mixins), so they can be used for selecting
+  # records early.
+  _prefilter_columns = ()
+
   # Attributes which could potentially be used as outer axes.
   # The values from the attribute will become the axis values.
   _outer_axes = ()
@@ -249,6 +1304,32 @@ class BufferBase (object):
   def _decoder_scalar_args (self):
     return {}
 
+  # Header columns that are looked up one record at a time when reading the
+  # data.  These are kept as regular arrays when the table is compacted.
+  def _hot_columns (self):
+    columns = ['file_id']
+    for key, cols in self._decoder_data:
+      columns.extend(cols)
+    columns.extend(self._decoder_extra_args)
+    return columns
+
+  # Default values for header columns that mixins only create when some
+  # records need them (e.g. mask information).
+  # Used for combining the new records with the existing ones in refresh().
+  _default_columns = ()
+
+  # Set for the temporary Buffer that refresh() uses for processing only the
+  # new records (and any earlier records they depend on).  Checks that are
+  # about the whole set of records should be skipped in that case.
+  _partial = False
+
+  # Indicates if scanning the raw headers is mostly I/O-bound, so it can be
+  # done in threads instead of separate processes.
+  _raw_headers_io_bound = False
+
+  # Number of records to accumulate before decoding the raw headers.
+  _decode_batch_size = 2**16
+
   # Define any command-line arguments for reading FSTD files.
   @classmethod
   def _cmdline_args (cls, parser):
@@ -261,10 +1342,13 @@ class BufferBase (object):
     group.add_argument('--progress', action='store_true', default=stdout.isatty(), help=SUPPRESS)
     group.add_argument('--no-progress', action='store_false', dest='progress', help=_('Disable the progress bar.'))
     parser.add_argument('--serial', action='store_true', help=_('Disables multithreading/multiprocessing.  Useful for resource-limited machines.'))
+    parser.add_argument('--scan-workers', type=int, metavar='N', help=_('Number of workers to use for scanning the input files.  The default depends on the number of CPUs.'))
+    parser.add_argument('--header-cache', metavar='DIR', help=_('Directory for caching the record headers of the input files.  Speeds up the scanning of files that were already seen.'))
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--minimal-metadata', action='store_true', default=True, help=_("Don't include internal record attributes and other internal information in the output metadata.")+" "+_("This is the default behaviour."))
     group.add_argument('--internal-metadata','--rpnstd-metadata', action='store_false', dest='minimal_metadata', help=_("Include all internal record attributes in the output metadata."))
     group.add_argument('--metadata-list','--rpnstd-metadata-list', metavar='nomvar,...', help=_("Specify a minimal set of internal record attributes to include in the output file."))
+    parser.add_argument('--split-partial-coverage', action='store_true', help=_("Split fields that only have partial coverage (e.g. surface output at some times, 3D output at other times) into separate variables, instead of padding them with missing values."))
 
   # Do some checks on the command-line arguments after parsing them.
   @classmethod
@@ -289,11 +1373,18 @@ class BufferBase (object):
   def __setstate__ (self, state):
     self.__dict__.update(state)
 
+  # Keep track of the arguments used to create the Buffer, so it can be
+  # re-initialized later on (see refresh).
+  def __new__ (cls, *args, **kwargs):
+    obj = super(BufferBase,cls).__new__(cls)
+    obj._init_args = (args, kwargs)
+    return obj
+
 
   ###############################################
   # Basic flow for reading data
 
-  def __init__ (self, filename, progress=False, serial=False, **kwargs):
+  def __init__ (self, filename, progress=False, serial=False, scan_workers=None, header_cache=None, **kwargs):
     """
     Read raw records from FSTD files, into the buffer.
     Multiple files can be read simultaneously.
@@ -308,52 +1399,49 @@ class BufferBase (object):
     serial : bool, optional
         Disables multithreading/multiprocessing.  Useful for resource-limited
         machines.
+    scan_workers : int, optional
+        Number of workers to use for scanning the input files.  The default
+        depends on the number of CPUs.
+    header_cache : str, optional
+        Directory for caching the record headers of the input files.
+        Speeds up the scanning of files that were already seen.
     internal_metadata : bool, optional
         Include all internal record attributes in the output metadata.
     metadata_list : str or list, optional
         Specify a minimal set of internal record attributes to include in the
         output file.
+    split_partial_coverage : bool, optional
+        Split fields that only have partial coverage (e.g. surface output at
+        some times, 3D output at other times) into separate variables,
+        instead of padding them with missing values.
     """
     from collections import Counter
     import numpy as np
-    from glob import glob, has_magic
+    from glob import has_magic
     import os
-    from multiprocessing import Pool
-    from pathlib import Path
-    try:
-      from itertools import imap  # Python 2
-    except ImportError:
-      imap = map
-
-    # Set up a progress bar for scanning the input files.
-    Bar = _ProgressBar if progress is True else _FakeBar
 
     self._serial = serial
+    self._scan_workers = scan_workers
+
+    # Check if the headers were already scanned by refresh().
+    rescan = self.__dict__.pop('_rescan',None)
 
     # Detect if an existing Buffer object was provided.
     if hasattr(filename,'_headers') and hasattr(filename,'_files'):
       existing_buffer = filename
       filename = []
+      # Don't hold on to the other Buffer.
+      self._init_args = None
     else:
       existing_buffer = None
 
-    if isinstance(filename,(str,Path)):
-      infiles = [filename]
-    else:
-      infiles = list(filename)
-
     # Apply wildcard and directory expansion to filenames.
-    expanded_infiles = []
-    for infile in infiles:
-      if isinstance(infile,Path):
-        infile = str(infile)
-      for f in sorted(glob(infile)) or [infile]:
-        if os.path.isdir(f):
-          for dirpath, dirnames, filenames in os.walk(f,followlinks=True):
-            for filename in filenames:
-              expanded_infiles.append((infile,os.path.join(dirpath,filename)))
-        else:
-          expanded_infiles.append((infile,f))
+    # Note: the expansion is done on the fly, so the first files can be
+    # scanned while still looking for the rest of them.
+    if rescan is None:
+      expanded_infiles = self._iter_inputs(filename, self._walk_workers())
+    else:
+      expanded_infiles = []
 
     # How to handle internal metadata.
     internal_metadata = kwargs.pop('internal_metadata',None)
@@ -381,50 +1469,48 @@ class BufferBase (object):
       metadata_list = tuple(metadata_list)
     self._metadata_list = metadata_list
 
+    self._split_partial_coverage = kwargs.pop('split_partial_coverage',False)
+
     # Should not have any unprocessed keyword arguments after this.
     if len(kwargs) > 0:
       error(_("Unexpected arguments: %s"%(kwargs.keys())))
 
-    # Extract headers from the files.
-    if len(expanded_infiles) == 1: Bar = _FakeBar
-    bar = Bar(_("Inspecting input files"), suffix='%(percent)d%% (%(index)d/%(max)d)', max=len(expanded_infiles))
-
-    if len(expanded_infiles) > 1 and not self._serial:
-      with Pool() as p:
-        headers = p.imap (self._raw_headers, [f for (infile,f) in expanded_infiles])
-        headers = bar.iter(headers)
-        headers = list(headers) # Start scanning.
-    else:
-      headers = imap (self._raw_headers, [f for (infile,f) in expanded_infiles])
-      headers = bar.iter(headers)
-      headers = list(headers) # Start scanning.
-
-    bar.finish()
+    # Set up the cache for the raw headers.
+    self._header_cache = header_cache
+    if header_cache is not None:
+      os.makedirs(header_cache, exist_ok=True)
 
-    # Check which files had headers used, report on the results.
+    # Extract headers from the files.
+    # The headers are decoded in batches as they come in, to keep the memory
+    # usage down when there are many records.
     matches = Counter()
     self._files = []
-    file_ids = []
-    for i, (infile, f) in enumerate(expanded_infiles):
-      if headers[i] is not None:
-        matches[infile] += 1
-        filenum = len(self._files)
-        self._files.append(f)
-        file_ids.extend([filenum]*len(headers[i]))
-      else:
+    self._scan_state = []
+    headers = _ColumnBuilder()
+    batch = []
+    batch_file_ids = []
+    nbatch = 0
+    for (infile, f), raw in self._scan_inputs(expanded_infiles, progress=progress):
+      if raw is None:
         matches[infile] += 0
-
-    # Decode all the headers
-    headers = [h for h in headers if h is not None and len(h) > 0]
-    # Remember indices in the headers (needed for reconstructing keys)
-    indices = [range(len(h)) for h in headers]
-    if len(headers) > 0:
-      headers = np.concatenate(headers)
-      indices = np.concatenate(indices)
-      headers = self._decode_headers(headers)
-      # Encode the keys without the file index info.
-      headers['file_id'] = np.array(file_ids, dtype='int32')
-      headers['selected'] = np.ones(len(file_ids),'bool')
+        continue
+      matches[infile] += 1
+      filenum = len(self._files)
+      self._files.append(f)
+      self._scan_state.append((len(raw),None))
+      if len(raw) > 0:
+        batch.append(raw)
+        batch_file_ids.append(np.full(len(raw),filenum,'int32'))
+        nbatch += len(raw)
+      if nbatch >= self._decode_batch_size:
+        headers.append(self._decode_batch(batch, batch_file_ids))
+        batch = []
+        batch_file_ids = []
+        nbatch = 0
+    if nbatch > 0:
+      headers.append(self._decode_batch(batch, batch_file_ids))
+    del batch, batch_file_ids
+    headers = headers.finish()
 
     # Check if the input entries actually matched anything.
     for infile, count in matches.items():
@@ -440,32 +1526,461 @@ class BufferBase (object):
         else:
           warn(_("Problem with input file '%s'")%infile)
 
+    # Use headers that were scanned by refresh().
+    if rescan is not None:
+      self._files, headers, self._scan_state = rescan
+
     # Use existing Buffer object data, if that was provided instead of files.
     if existing_buffer is not None:
       self._files = list(existing_buffer._files)
       headers = {k:v.copy() for k,v in existing_buffer._headers.items()}
+      # Can't pick up new records for this case.
+      self._scan_state = None
+
+    # Keep the headers as they were scanned from the files, so refresh() can
+    # add new records to them.
+    # Only the packed header words (and file ids) are kept where possible,
+    # which is much smaller than the decoded columns.
+    # Note: mixins should not modify these columns in place, they should
+    # assign new arrays into _headers instead.
+    if len(headers) > 0 and existing_buffer is None:
+      if hasattr(headers,'packed'):
+        self._scanned_headers = type(headers)(*headers.packed())
+      else:
+        self._scanned_headers = dict(headers)
+      headers['selected'] = np.ones(len(headers['file_id']),'bool')
 
     nfiles = len(self._files)
     if nfiles == 0 and existing_buffer is None:
       error(_("no input files found!"))
-    elif nfiles > 10:
-      global _pandas_needed
-      _pandas_needed = True
     info(_("Found %d %s"%(nfiles,self._format_plural)))
 
-    self._headers = headers
-    self._nrecs = max(len(self._headers[key]) for key in self._headers.keys())
+    self._headers = _HeaderTable(headers)
+    self._nrecs = self._headers.nrecs
 
+  # Apply wildcard and directory expansion to filenames.
+  # Generates the (input entry, filename) pairs as they're found.
+  # Directories are walked with the given number of threads.
+  @staticmethod
+  def _iter_inputs (filename, nworkers=8):
+    from glob import glob
+    import os
+    from pathlib import Path
+    if isinstance(filename,(str,Path)):
+      infiles = [filename]
+    else:
+      infiles = list(filename)
+    for infile in infiles:
+      if isinstance(infile,Path):
+        infile = str(infile)
+      for f in sorted(glob(infile)) or [infile]:
+        if os.path.isdir(f):
+          for filename in _walk_directory(f, nworkers):
+            yield (infile, filename)
+        else:
+          yield (infile, f)
+
+  # Number of threads to use for I/O-bound work.
+  # Only uses the current thread if running in serial mode.
+  def _walk_workers (self):
+    from multiprocessing import cpu_count
+    if self._serial:
+      return 1
+    return self._scan_workers or min(32, cpu_count()+4)
+
+  # Scan the raw headers from the given (input entry, filename) pairs.
+  # Generates ((input entry, filename), raw headers) for each file, with the
+  # raw headers set to None for files that aren't in the right format.
+  # The pairs can be given as a list or as an iterator.
+  def _scan_inputs (self, expanded_infiles, progress=False):
+    from functools import partial
+    from itertools import islice, chain
+    from multiprocessing import Pool, cpu_count
+    try:
+      from itertools import imap  # Python 2
+    except ImportError:
+      imap = map
 
-  # Generate structured variables from the data records.
+    raw_headers = self._raw_headers
+    if self._header_cache is not None:
+      raw_headers = partial(_cached_raw_headers, raw_headers, self._header_cache)
+    scan = partial(_scan_entry, raw_headers)
+
+    # Keep track of how many files were found so far, for the progress bar.
+    if hasattr(expanded_infiles,'__len__'):
+      nfiles = [len(expanded_infiles)]
+      inputs = iter(expanded_infiles)
+    else:
+      nfiles = [0]
+      def counted (entries):
+        for entry in entries:
+          nfiles[0] += 1
+          yield entry
+      inputs = counted(expanded_infiles)
+    # Check if there's more than one file.
+    first = list(islice(inputs,2))
+    inputs = chain(first, inputs)
+
+    # Set up a progress bar for scanning the input files.
+    Bar = _ProgressBar if progress is True else _FakeBar
+    if len(first) == 1: Bar = _FakeBar
+    bar = Bar(_("Inspecting input files"), suffix='%(percent)d%% (%(index)d/%(max)d)', max=max(nfiles[0],1))
+
+    if len(first) > 1 and not self._serial:
+      # Use threads if the scanning is mostly I/O.  Otherwise, need separate
+      # processes to get around the GIL.
+      if self._raw_headers_io_bound:
+        from multiprocessing.pool import ThreadPool as Pool
+        nworkers = self._walk_workers()
+      else:
+        nworkers = self._scan_workers or cpu_count()
+      # Send the files to the workers in batches, to reduce the overhead
+      # when there are many small files.
+      if hasattr(expanded_infiles,'__len__'):
+        chunksize = max(1, min(64, len(expanded_infiles)//(4*nworkers)))
+      else:
+        chunksize = 8
+      # Note: the headers are passed back as they become available, so the
+      # caller can process them while the remaining files are being scanned.
+      with Pool(nworkers) as p:
+        headers = p.imap (scan, inputs, chunksize)
+        for h in bar.iter(headers):
+          bar.max = max(nfiles[0],1)
+          yield h
+    else:
+      headers = imap (scan, inputs)
+      for h in bar.iter(headers):
+        bar.max = max(nfiles[0],1)
+        yield h
+
+    bar.finish()
+
+  def refresh (self):
+    """
+    Check the input files for any new records since they were last scanned.
+    Useful for files that are still being written to (e.g. by a running
+    model).
+    Only the new records are scanned and processed (along with any earlier
+    records they depend on, such as vertical coordinates), then they are
+    added to the existing header table.
+    New files matching the original input paths are also picked up.
+    Options that work on the whole set of records at once (like grid
+    interpolation or cropping) cause the Buffer to be re-initialized from
+    all the records instead.
+
+    Returns
+    -------
+    True if new records were found, False otherwise.
+    """
+    import numpy as np
+    if getattr(self,'_scan_state',None) is None or self._init_args is None:
+      error(_("Unable to refresh this Buffer (it was not created from input files)."))
+    args, kwargs = self._init_args
+    filename = args[0] if len(args) > 0 else kwargs.get('filename')
+    files = list(self._files)
+    scan_state = list(self._scan_state)
+    new_headers = []
+    file_ids = []
+    # Look for new records in the known files.
+    for file_id, f in enumerate(files):
+      nrecs, position = scan_state[file_id]
+      raw, position = self._raw_headers_since(f, nrecs, position)
+      if raw is None: continue
+      scan_state[file_id] = (nrecs+len(raw), position)
+      new_headers.append(raw)
+      file_ids.append(np.full(len(raw),file_id,'int32'))
+    # Look for new files.
+    known = set(files)
+    expanded_infiles = self._iter_inputs(filename, self._walk_workers())
+    expanded_infiles = ((infile,f) for (infile,f) in expanded_infiles if f not in known)
+    for (infile, f), raw in self._scan_inputs(expanded_infiles):
+      if raw is None: continue
+      files.append(f)
+      scan_state.append((len(raw),None))
+      new_headers.append(raw)
+      file_ids.append(np.full(len(raw),len(files)-1,'int32'))
+    new_headers = [h for h in new_headers if len(h) > 0]
+    if len(new_headers) == 0:
+      return False
+    # Decode the new headers, and append to the previously scanned ones.
+    new_headers = self._decode_batch(new_headers, file_ids)
+    headers = _ColumnBuilder()
+    headers.append(self._scanned_headers)
+    headers.append(new_headers)
+    headers = headers.finish()
+    nscanned = len(self._scanned_headers['file_id'])
+    nnew = len(new_headers['file_id'])
+    # All the new records may have been filtered out.
+    if nnew == 0:
+      self._files, self._scan_state, self._scanned_headers = files, scan_state, headers
+      return False
+    # Find the earlier records that need to be processed again along with
+    # the new ones.
+    context = self._refresh_context()
+    if context is None:
+      context = np.zeros(self._nrecs,'bool')
+    if self._nrecs == 0 or self._nrecs != nscanned or np.all(context):
+      self._reinit(files, headers, scan_state)
+      return True
+    index = np.where(context)[0]
+    if hasattr(self._scanned_headers,'select'):
+      subset = self._scanned_headers.select(index)
+    else:
+      subset = dict((key,value[index]) for key,value in self._scanned_headers.items())
+    subset_headers = _ColumnBuilder()
+    subset_headers.append(subset)
+    subset_headers.append(new_headers)
+    subset_headers = subset_headers.finish()
+    # Process these records with the same options as before.
+    partial = type(self).__new__(type(self), *args, **kwargs)
+    partial._partial = True
+    partial._rescan = (files, subset_headers, scan_state)
+    partial.__init__(*args, **kwargs)
+    # Add them to the existing table.
+    try:
+      table = self._headers.merge(partial._headers, index, headers=headers, defaults=dict(self._default_columns), keep=self._hot_columns())
+    except ValueError:
+      # The new records need different columns (e.g. first time masks were
+      # found), so need to go through all the records after all.
+      self._reinit(files, headers, scan_state)
+      return True
+    for key, value in partial.__dict__.items():
+      if key in ('_headers','_nrecs','_files','_scan_state','_scanned_headers','_init_args','_partial'):
+        continue
+      self.__dict__[key] = value
+    self._files = files
+    self._scan_state = scan_state
+    self._scanned_headers = headers
+    self._headers = table
+    self._nrecs = table.nrecs
+    return True
+
+  # Re-initialize the Buffer from the given headers, with the same options
+  # as before.
+  # Restore the previous state if something goes wrong.
+  def _reinit (self, files, headers, scan_state):
+    args, kwargs = self._init_args
+    state = self.__dict__.copy()
+    self.__dict__.clear()
+    self._init_args = (args, kwargs)
+    self._rescan = (files, headers, scan_state)
+    try:
+      self.__init__(*args, **kwargs)
+    except BaseException:
+      self.__dict__.clear()
+      self.__dict__.update(state)
+      raise
+
+  # Earlier records that need to be processed again when new records are
+  # added by refresh(), because the new records may depend on them (or vice
+  # versa).
+  # Returns a boolean array (or None if no records are needed).
+  # Mixins that use information from other records when processing the
+  # headers should extend this.
+  def _refresh_context (self):
+    return None
+
+  # Decode a batch of raw headers (given as a list of arrays, and the
+  # corresponding file ids).
+  # Records that are rejected by _prefilter_headers are dropped here, before
+  # they get added to the table.
+  def _decode_batch (self, raw, file_ids):
+    import numpy as np
+    headers = self._decode_headers(np.concatenate(raw))
+    headers['file_id'] = np.concatenate(file_ids)
+    keep = self._prefilter_headers(headers)
+    if keep is None:
+      return headers
+    protected = self._protected_headers(headers)
+    if protected is not None:
+      keep = keep | protected
+    if np.all(keep):
+      return headers
+    index = np.where(keep)[0]
+    if hasattr(headers,'select'):
+      return headers.select(index)
+    return dict((key,value[index]) for key,value in headers.items())
+
+  # Quick check of which records will be needed, based on the freshly decoded
+  # headers.  Returns a boolean array (or None if all records are needed).
+  # Mixins that select a subset of records can extend this to avoid keeping
+  # unwanted records around.  Only the columns listed in _prefilter_columns
+  # should be used for this.
+  def _prefilter_headers (self, headers):
+    return None
+
+  # Records that must be kept regardless of the _prefilter_headers result,
+  # because other mixins rely on them (e.g. coordinate records).
+  # Returns a boolean array (or None).
+  def _protected_headers (self, headers):
+    return None
+
+  # Scan a file for records that were added since an earlier scan.
+  # 'nrecs' is the number of records found from the earlier scan, and
+  # 'position' is any extra information returned from that scan (or None).
+  # Returns the raw headers of the new records, and an updated position.
+  # The default is to rescan the whole file and skip over the known records.
+  @classmethod
+  def _raw_headers_since (cls, filename, nrecs, position=None):
+    raw = cls._raw_headers(filename)
+    if raw is None: return None, None
+    return raw[nrecs:], None
+
+  # Arguments that don't affect the contents of the Buffer, so they don't
+  # need to match when loading from an index file.
+  _index_ignored_args = ('progress','serial','scan_workers','header_cache')
+
+  # Get the arguments used to create the Buffer (other than the input files),
+  # as a dictionary of JSON-compatible values.
+  # Positional arguments are matched to their names, so they can be compared
+  # with keyword arguments.
+  @staticmethod
+  def _index_args (args, kwargs):
+    import inspect
+    import json
+    # Note: placeholders are given for self and filename.
+    bound = inspect.signature(BufferBase.__init__).bind(None, None, *args, **kwargs)
+    options = dict(bound.arguments)
+    options.update(options.pop('kwargs',{}))
+    options.pop('self')
+    options.pop('filename')
+    try:
+      return json.loads(json.dumps(options, default=_json_default))
+    except (TypeError,ValueError):
+      error(_("Unable to store the options of this Buffer in an index file."))
+
+  # Attributes that aren't stored in an index file, because they get
+  # generated again when they're needed (or are provided by load_index).
+  _index_skip_state = ('_init_args','_varlist','_registry','_graph','_makevars_key')
+
+  def save_index (self, filename):
+    """
+    Save the state of this Buffer to an index file, so it can be quickly
+    reopened later with load_index() without having to scan and process the
+    input files again.
+
+    Parameters
+    ----------
+    filename : str
+        The index file to write.
+    """
+    import json
+    import os
+    import numpy as np
+    from tempfile import mkstemp
+    from fstd2nc import __version__
+    if getattr(self,'_init_args',None) is None or getattr(self,'_scan_state',None) is None or not hasattr(getattr(self,'_scanned_headers',None),'packed'):
+      error(_("Unable to save an index for this Buffer (it was not created from input files)."))
+    args, kwargs = self._init_args
+    infiles = args[0] if len(args) > 0 else kwargs.get('filename')
+    kwargs = dict(kwargs)
+    kwargs.pop('filename',None)
+    cls = type(self)
+    meta = dict(version=__version__, buffer_type=cls.__module__+'.'+cls.__name__)
+    meta['options'] = self._index_args(args[1:], kwargs)
+    meta['files'] = list(self._files)
+    meta['stamps'] = [_file_stamp(f) for f in self._files]
+    meta['infiles'] = infiles
+    # Store everything that was set up when the Buffer was initialized
+    # (including the processed header table), so it doesn't need to be
+    # re-initialized when it's loaded.
+    encoder = _StateEncoder(self)
+    state = dict((key,value) for key,value in self.__dict__.items() if key not in self._index_skip_state)
+    try:
+      meta['state'] = encoder.encode(state)
+      meta = json.dumps(meta, default=_json_default)
+    except (TypeError,ValueError):
+      error(_("Unable to store the state of this Buffer in an index file."))
+    # Write to a temporary file first, so other processes never see a
+    # partial index.
+    fd, tmpfile = mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+      with os.fdopen(fd,'wb') as f:
+        np.savez(f, meta=np.array(meta), **encoder.arrays)
+      os.replace(tmpfile, filename)
+    except BaseException:
+      os.remove(tmpfile)
+      raise
+
+  @classmethod
+  def load_index (cls, filename, **kwargs):
+    """
+    Reopen a Buffer from an index file that was created by save_index(),
+    without having to scan and process the input files again.
+
+    Parameters
+    ----------
+    filename : str
+        The index file to read.
+    **kwargs
+        The same options that were used for creating the original Buffer.
+        These are checked against the options stored in the index.
+    """
+    import json
+    import numpy as np
+    from fstd2nc import __version__
+    # Note: the index only contains plain arrays and JSON metadata, so
+    # nothing gets executed from reading it.
+    with np.load(filename, allow_pickle=False) as index:
+      meta = json.loads(str(index['meta'][()]))
+      if meta.get('version') != __version__:
+        error(_("Index '%s' was created with a different version of fstd2nc.")%filename)
+      if meta.get('buffer_type') != cls.__module__+'.'+cls.__name__:
+        error(_("Index '%s' was created for a different type of Buffer.")%filename)
+      # Check that the options are consistent.
+      saved = meta['options']
+      options = cls._index_args((), kwargs)
+      keys = (set(options.keys()) | set(saved.keys())) - set(cls._index_ignored_args)
+      different = sorted(key for key in keys if options.get(key) != saved.get(key))
+      if len(different) > 0:
+        error(_("Index '%s' was created with different options: %s")%(filename,', '.join(different)))
+      # Check that the input files haven't changed.
+      for f, stamp in zip(meta['files'], meta['stamps']):
+        if _file_stamp(f) != stamp:
+          error(_("'%s' has changed since index '%s' was created.")%(f,filename))
+      arrays = dict((key,index[key]) for key in index.files if key != 'meta')
+    # Restore the Buffer as it was after it was initialized, with the same
+    # options as before (apart from the ones that are allowed to change).
+    kwargs = dict(saved, **kwargs)
+    obj = cls.__new__(cls, meta['infiles'], **kwargs)
+    state = _StateDecoder(obj, arrays, cls._unpack_headers).decode(meta['state'])
+    obj.__dict__.update(state)
+    for key in cls._index_ignored_args:
+      if key in kwargs and hasattr(obj,'_'+key):
+        setattr(obj, '_'+key, kwargs[key])
+    obj._restore_index()
+    return obj
+
+  # Re-create anything that can't be carried over from the process that
+  # saved the index (see load_index).
+  def _restore_index (self):
+    return
+
+
+  # Generate the variables, unless they were already generated from the
+  # current version of the headers.
+  # Should be used instead of _makevars() by anything that only needs to
+  # read the variables.
+  def _makevars_cached (self):
+    key = getattr(self,'_makevars_key',(None,None))
+    if key[0] is self._headers and key[1] == self._headers.version and hasattr(self,'_varlist'):
+      stats.count('makevars_cache_hits')
+      return
+    stats.count('makevars_cache_misses')
+    self._makevars()
+    self._makevars_key = (self._headers, self._headers.version)
+    self._object_graph()
 
-  # Normal version (without use of pandas).
-  def _makevars_slow (self):
+  # Generate structured variables from the data records.
+  def _makevars (self):
     from collections import OrderedDict
     import numpy as np
-    import warnings
     from fstd2nc.extra import structured_array
 
+    # Anything cached from a previous call is no longer valid.
+    self.__dict__.pop('_makevars_key',None)
+    self._clear_object_graph()
+
     nrecs = self._nrecs
 
     # Degenerate case: no data in buffer
@@ -478,55 +1993,46 @@ class BufferBase (object):
     records = records[valid]
     header_indices = np.where(valid)[0]
 
-    # Determine the variable identifiers.
-    # First, extract the uniquely identifying information from the metadata.
-    # Suppress FutureWarning from numpy about doing this.  Probably benign...
-    with warnings.catch_warnings():
-      warnings.simplefilter("ignore")
-      all_var_ids = records.data[list(self._var_id)]
-
-    # Do a pre-processing step to remove ids that are identical to the one
-    # immediately before it.
-    # This is purely an optimization thing - the np.unique call later on is
-    # O(n log n) so want to prune this array as much as possible beforehand.
-    # TODO: Update this once numpy has an unsorted "unique"-like function that
-    # can run more efficiently when there are relatively few unique elements.
-    # (could get ~O(n) with a hash table).
-    var_ids = all_var_ids
-    if len(var_ids) > 0:
-      flag = np.concatenate(([True], var_ids[1:] != var_ids[:-1]))
-      var_ids = var_ids[flag]
-
-    # Now, find the unique var_ids from this pruned list.
-    var_ids = np.unique(var_ids)
-
-    # Keep track of axes that were generated
-    known_axes = dict()
+    # Determine the variable identifiers, and group the records by variable.
+    groups = _group_records([records.data[n] for n in self._var_id])
+
+    # Determine which columns are consistent within each variable, for all
+    # variables at once.  These can be used as attributes.
+    order = np.concatenate(groups)
+    group_ids = np.repeat(np.arange(len(groups)), list(map(len,groups)))
+    consistent = OrderedDict()
+    for n in records.dtype.names:
+      if n in self._outer_axes or n in self._outer_coords or n in self._ignore_atts:
+        continue
+      column = records[n][order]
+      try:
+        ok, first = _consistent_values(column, group_ids, len(groups))
+      except (TypeError,ValueError):
+        # Can't compare these values elementwise.
+        continue
+      consistent[n] = (ok, np.ma.getdata(column)[first])
+
+    # Keep track of axes that were generated.
+    # This registry is also available to the other mixins.
+    self._registry = _Registry()
 
     # Keep track of any auxiliary coordinates that were generated.
     known_coords = dict()
 
     # Loop over each variable and construct the data & metadata.
     self._varlist = []
-    for var_id in var_ids:
-      selection = (all_var_ids == var_id)
-      var_records = records[selection]
-      var_record_indices = np.where(selection)[0]
+    for g, var_record_indices in enumerate(groups):
+      var_records = records[var_record_indices]
+      var_id = var_records.data[0]
       nomvar = var_id['name'].strip()
       nomvar = str(nomvar.decode()) # Python3: convert bytes to str.
 
       # Get the metadata for each record.
+      # Only use attributes that are consistent across all variable records.
       atts = OrderedDict()
-      for n in records.dtype.names:
-        if n in self._outer_axes or n in self._outer_coords or n in self._ignore_atts:
-          continue
-        v = var_records[n]
-        # Remove missing values before continuing.
-        v = np.ma.compressed(v)
-        if len(v) == 0: continue
-        # Only use attributes that are consistent across all variable records.
-        if len(set(v)) > 1: continue
-        v = v[0]
+      for n, (ok, first) in consistent.items():
+        if not ok[g]: continue
+        v = first[g]
         # Python3: convert bytes to str.
         if isinstance(v,bytes): v = str(v.decode())
         # Trim string attributes (remove whitespace padding).
@@ -537,19 +2043,24 @@ class BufferBase (object):
         atts[n] = v
 
       # Get the axes.
+      # Also keep the unique inverse of each axis column, so it only needs to
+      # be computed once for the record ids and auxiliary coordinates.
       axes = OrderedDict()
+      inverse = dict()
       for n in self._outer_axes:
-        values = var_records[n]
+        column = var_records[n]
         # Remove missing values before continuing.
-        values = np.ma.compressed(values)
+        values = np.ma.compressed(column)
         # Ignore axes that have no actual coordinate values.
         if len(values) == 0: continue
+        u, inverse[n] = np.unique(column, return_inverse=True)
         # Get all unique values (sorted).
-        values = tuple(sorted(set(values)))
-        if (n,values) not in known_axes:
-          known_axes[(n,values)] = _axis_type(name = n, atts = OrderedDict(),
-                                              array = np.array(values))
-        axes[n] = known_axes[(n,values)]
+        if np.ma.is_masked(column):
+          values = np.unique(values)
+        else:
+          values = np.ma.getdata(u)
+        axes[n] = self._registry.intern(_axis_type(name = n, atts = OrderedDict(),
+                                                   array = values))
 
       # Construct a multidimensional array to hold the record keys.
       record_id = np.empty(list(map(len,axes.values())), dtype='int32')
@@ -558,10 +2069,7 @@ class BufferBase (object):
       record_id[()] = -1
 
       # Arrange the record keys in the appropriate locations.
-      indices = []
-      for n in axes.keys():
-        u, ind = np.unique(var_records[n], return_inverse=True)
-        indices.append(ind)
+      indices = [inverse[n] for n in axes.keys()]
       record_id[tuple(indices)] = header_indices[var_record_indices]
 
       # Get the auxiliary coordinates.
@@ -582,10 +2090,7 @@ class BufferBase (object):
         all_coord_values = np.ma.compressed(var_records[n])
         if len(all_coord_values) == 0: continue
         values = np.zeros(shape,dtype=all_coord_values.dtype)
-        indices = []
-        for k in coordaxes.keys():
-          u, ind = np.unique(var_records[k], return_inverse=True)
-          indices.append(ind)
+        indices = [inverse[k] for k in coordaxes.keys()]
         values[tuple(indices)] = all_coord_values
         if key not in known_coords:
           coord = _var_type (name = n, atts = OrderedDict(),
@@ -593,12 +2098,8 @@ class BufferBase (object):
           known_coords[key] = coord
         coords.append(known_coords[key])
 
-      # Check if we have full coverage along all axes.
-      have_data = (record_id.flatten() >= 0)
-      if not np.all(have_data):
-        warn (_("Missing some records for %s.")%nomvar)
-
-      # Add dummy axes for the inner dimensions.
+      # Get the dummy axes for the inner dimensions.
+      inner_axes = OrderedDict()
       for n in self._inner_axes:
         values = var_records[n]
         # Remove missing values before continuing.
@@ -608,238 +2109,73 @@ class BufferBase (object):
         # be encoded into the var_id fields to ensure that.
         if len(values) == 0: continue
         length = values[0]
-        axes[n] = _dim_type(name=n, length = length)
+        inner_axes[n] = _dim_type(name=n, length = length)
 
       # Determine the optimal data type to use.
       dtype_list = var_records['dtype']
       dtype = np.result_type(*dtype_list)
 
-      var = _iter_type( name = nomvar, atts = atts,
-                        axes = list(axes.values()),
-                        dtype = dtype,
-                        record_id = record_id )
-      # Add auxiliary coordinate variables through silent dependency.
-      # Don't want these in the 'coordinates' attribute because they seem to
-      # cause issues with certain netCDF decoders.
-      if len(coords) > 0:
-        var.deps = coords
-      self._varlist.append(var)
-
-      #TODO: Find a minimum set of partial coverages for the data.
-      # (e.g., if we have surface-level output for some times, and 3D output
-      # for other times).
-
-  # Faster version of iterator (using pandas).
-  def _makevars_pandas (self):
+      # Split into pieces with better coverage, if requested.
+      pieces = [(axes, record_id, coords)]
+      if self._split_partial_coverage and not np.all(record_id >= 0):
+        indices = _split_coverage(record_id)
+        if len(indices) > 1:
+          info (_("Splitting %s into %d pieces with different coverage.")%(nomvar,len(indices)))
+          pieces = [self._coverage_piece(axes, record_id, coords, index) for index in indices]
+
+      for i, (axes, record_id, coords) in enumerate(pieces):
+
+        # Check if we have full coverage along all axes.
+        have_data = (record_id.flatten() >= 0)
+        if not np.all(have_data):
+          warn (_("Missing some records for %s.")%nomvar)
+
+        axes = OrderedDict(axes)
+        axes.update(inner_axes)
+
+        var = _iter_type( name = nomvar, atts = atts if i == 0 else atts.copy(),
+                          axes = list(axes.values()),
+                          dtype = dtype,
+                          record_id = record_id )
+        # Add auxiliary coordinate variables through silent dependency.
+        # Don't want these in the 'coordinates' attribute because they seem to
+        # cause issues with certain netCDF decoders.
+        if len(coords) > 0:
+          var.deps = coords
+        self._varlist.append(var)
+
+  # Helper method - extract a piece of a variable (from _split_coverage).
+  # Returns the axes, record ids and auxiliary coordinates for the piece.
+  def _coverage_piece (self, axes, record_id, coords, index):
     from collections import OrderedDict
     import numpy as np
-    import pandas as pd
-    import warnings
-
-    nrecs = self._nrecs
-
-    # Degenerate case: no data in buffer
-    if nrecs == 0: return
-
-    # Convert records to a pandas DataFrame, which is faster to operate on.
-    records = pd.DataFrame.from_dict(self._headers)
-    # Keep track of original dtypes (may need to re-cast later).
-    original_dtypes = dict([(key,value.dtype) for key,value in self._headers.items()])
-
-    # Get the subset of records destined for output.
-    records = records[records['selected']==True]
-
-    # Keep track of any axes that were generated.
-    known_axes = dict()
-
-    # Keep track of any auxiliary coordinates that were generated.
-    known_coords = dict()
-
-    # Iterate over each variable.
-    # Variables are defined by the entries in _var_id.
-    self._varlist = []
-    for var_id, var_records in records.groupby(list(self._var_id)):
-      var_id = OrderedDict(zip(self._var_id, var_id))
-      nomvar = var_id['name'].strip()
-      nomvar = str(nomvar.decode()) # Python3: convert bytes to str.
-
-      # Get the attributes, axes, and corresponding indices of each record.
-      atts = OrderedDict()
-      axes = OrderedDict()
-      indices = OrderedDict()
-      coordnames = []
-      coord_axes = OrderedDict()
-      coord_indices = OrderedDict()
-      for n in records.columns:
-        if n in self._ignore_atts: continue
-        # Ignore columns which are masked out.
-        # https://stackoverflow.com/questions/29530232/python-pandas-check-if-any-value-is-nan-in-dataframe
-        try:
-          if np.isnan(var_records[n].values[0]): continue
-        except TypeError:
-          if var_records[n].values[0] is None: continue
-        # Get the unique values, in order.
-        # Coerce back to original dtype, since masked columns get upcasted to
-        # float64 in pandas.DataFrame.from_records.
-        try:
-          column = var_records[n].astype(original_dtypes[n])
-        except TypeError:
-          # Some types may not be re-castable.
-          # For instance, pandas < 0.23 can't convert between datetime64 with
-          # different increments ([ns] and [s]).
-          column = var_records[n]
-        # Is this column an outer axis?
-        if n in self._outer_axes:
-          values, indices[n] = np.unique(column, return_inverse=True)
-          values = tuple(values)
-          if (n,values) not in known_axes:
-            known_axes[(n,values)] = _axis_type(name = n, atts = OrderedDict(),
-                                   array = np.array(values,dtype=column.dtype))
-          axes[n] = known_axes[(n,values)]
-          # Is this also an axis for an auxiliary coordinate?
-          for coordname,coordaxes in self._outer_coords.items():
-            if n in coordaxes:
-              coordnames.append(coordname)
-              coord_axes.setdefault(coordname,OrderedDict())[n] = axes[n]
-              coord_indices.setdefault(coordname,OrderedDict())[n] = indices[n]
-        # Otherwise, does it have a consistent value?
-        # If so, can add it to the metadata.
-        # Ignore outer coords, since the value is already encoded elsewhere.
-        elif np.all(column.values == column.values[0]) and n not in self._outer_coords:
-          try:
-            v = column.values[0]
-            # Python3: convert bytes to str.
-            if isinstance(v,bytes): v = str(v.decode())
-            # Trim string attributes (remove whitespace padding).
-            if isinstance(v,str): v = v.strip()
-            # Use regular integers for numeric types.
-            elif np.can_cast(v,int):
-              v = int(v)
-            atts[n] = v
-          except (TypeError,ValueError):
-            pass
-
-      # Recover the proper order for the outer axes.
-      # Not necessarily the order of the header table columns.
-      axes = OrderedDict((n,axes[n]) for n in self._outer_axes if n in axes)
-      indices = tuple([indices[n] for n in self._outer_axes if n in indices])
-      for coordname in coord_axes.keys():
-        coord_axes[coordname] = OrderedDict((n,coord_axes[coordname][n]) for n in self._outer_axes if n in coord_axes[coordname])
-        coord_indices[coordname] = [coord_indices[coordname][n] for n in self._outer_axes if n in coord_indices[coordname]]
-
-      # Construct a multidimensional array to hold the record keys.
-      record_id = np.empty(list(map(len,axes.values())), dtype='int32')
-
-      # Assume missing data (nan) unless filled in later.
-      record_id[()] = -1
-
-      # Arrange the record keys in the appropriate locations.
-      record_id[indices] = var_records.index
-
-      # Get the auxiliary coordinates.
-      coords = []
-      for n in coordnames:
-        # Ignore auxiliary coordinates which are masked out.
-        try:
-          if np.isnan(var_records[n].values[0]): continue
-        except TypeError:
-          if var_records[n].values[0] is None: continue
-        # Unique key for this coordinate
-        key = (n,tuple(coord_axes[n].items()))
-        # Arrange the coordinate values in the appropriate location.
-        shape = list(map(len,list(coord_axes[n].values())))
-        values = np.zeros(shape,dtype=var_records[n].dtype)
-        indices = tuple(coord_indices[n])
-        values[indices] = var_records[n]
-        if key not in known_coords:
-          coord = _var_type (name = n, atts = OrderedDict(),
-                           axes = list(coord_axes[n].values()),
-                           array = values )
-          known_coords[key] = coord
-        coords.append(known_coords[key])
-
-
-
-      # Check if we have full coverage along all axes.
-      have_data = (record_id.flatten() >= 0)
-      if not np.all(have_data):
-        warn (_("Missing some records for %s.")%nomvar)
-
-      # Add dummy axes for the inner dimensions.
-      for n in self._inner_axes:
-        # [Note: this code copied from above for dealing with masked data
-        #  in pandas DataFrames]
-        #
-        # Ignore dimensions that are masked out or are inconsistent.
-        # Note: inner dimensions should never be inconsistent.  They should
-        # be encoded into the var_id fields to ensure that.
-        try:
-          if np.isnan(var_records[n].values[0]): continue
-        except TypeError:
-          if var_records[n].values[0] is None: continue
-        # Get the unique values, in order.
-        column = var_records[n].astype(original_dtypes[n])
-        ###
-        values = column.values
-        # Ignore dimensions that are masked out or are inconsistent.
-        # Note: inner dimensions should never be inconsistent.  They should
-        # be encoded into the var_id fields to ensure that.
-        if len(values) == 0: continue
-        length = values[0]
-        axes[n] = _dim_type(name=n, length = length)
-
-      # Determine the optimal data type to use.
-      dtype_list = var_records['dtype']
-      dtype = np.result_type(*dtype_list)
-
-      var = _iter_type( name = nomvar, atts = atts,
-                        axes = list(axes.values()),
-                        dtype = dtype,
-                        record_id = record_id )
-      # Add auxiliary coordinate variables through silent dependency.
-      # Don't want these in the 'coordinates' attribute because they seem to
-      # cause issues with certain netCDF decoders.
-      if len(coords) > 0:
-        var.deps = coords
-      self._varlist.append(var)
-
-      #TODO: Find a minimum set of partial coverages for the data.
-      # (e.g., if we have surface-level output for some times, and 3D output
-      # for other times).
-
-  # Choose which method to iterate over the data
-  # (depending on if pandas is installed).
-  def _makevars (self):
-    if _use_pandas():
-      self._makevars_pandas()
-    else:
-      self._makevars_slow()
+    positions = dict((n,i) for i,n in enumerate(axes.keys()))
+    new_axes = OrderedDict()
+    for (n,axis), ind in zip(axes.items(), index):
+      if len(ind) == len(axis):
+        new_axes[n] = axis
+      else:
+        new_axes[n] = self._registry.intern(_axis_type(name = n, atts = OrderedDict(), array = axis.array[ind]))
+    new_coords = []
+    for coord in coords:
+      names = [a.name for a in coord.axes]
+      ind = [index[positions[n]] for n in names]
+      coord = _var_type (name = coord.name, atts = OrderedDict(),
+                         axes = [new_axes[n] for n in names],
+                         array = coord.array[np.ix_(*ind)])
+      new_coords.append(self._registry.intern(coord))
+    return new_axes, record_id[np.ix_(*index)], new_coords
 
   # Iterate over all unique axes found in the variables.
   # Requires _makevars() to have already been called.
   def _iter_axes (self, name=None, varlist=False):
-    from collections import OrderedDict
-    if not varlist:
-      handled = set()
-      for var in self._iter_objects():
-        if not hasattr(var,'axes'): continue
-        for axis in var.axes:
-          if name is not None and axis.name != name: continue
-          if id(axis) in handled: continue
-          yield axis
-          handled.add(id(axis))
-    else:
-      id_lookup = dict()
-      output = OrderedDict()
-      for var in self._iter_objects():
-        if not hasattr(var,'axes'): continue
-        for axis in var.axes:
-          if name is not None and axis.name != name: continue
-          if id(axis) not in id_lookup:
-            id_lookup[id(axis)] = axis
-          output.setdefault(id(axis),[]).append(var)
-      for axis_id,varlist in output.items():
-        yield id_lookup[axis_id],varlist
+    graph = getattr(self,'_graph',None) or _ObjectGraph(self._varlist)
+    for axis, users in list(graph.axis_users().values()):
+      if name is not None and axis.name != name: continue
+      if varlist:
+        yield axis, users
+      else:
+        yield axis
 
 
   # Iterate over all unique coordinates found in the variables.
@@ -854,48 +2190,52 @@ class BufferBase (object):
 
   # Iterate over all data objects.
   # Requires _makevars() to have already been called.
+  # Uses the object graph from _object_graph(), if one is active.
   def _iter_objects (self, obj=None, handled=None):
+    graph = getattr(self,'_graph',None)
+    if obj is None and handled is None and graph is not None:
+      for o in graph.objects:
+        yield o
+      return
     if obj is None:
       obj = self._varlist
     if handled is None:
       handled = set()
-
-    if id(obj) in handled:
-      return
-
-    if isinstance(obj,(_iter_type,_chunk_type,_var_type,_axis_type,_dim_type)):
-      yield obj
-      handled.add(id(obj))
-
-    if isinstance(obj,list):
-      for var in obj:
-        for o in self._iter_objects(var,handled):
-          yield o
-      return
-
-    if isinstance(obj,dict):
-      for key,value in obj.items():
-        for o in self._iter_objects(key,handled):
-          yield o
-        for o in self._iter_objects(value,handled):
-          yield o
-      return
-
-    if hasattr(obj,'axes'):
-      for o in self._iter_objects(obj.axes,handled):
-        yield o
-    if hasattr(obj,'atts'):
-      for o in self._iter_objects(obj.atts,handled):
-        yield o
-    if hasattr(obj,'deps'):
-      for o in self._iter_objects(obj.deps,handled):
-        yield o
+    if graph is None:
+      graph = _ObjectGraph(())
+    for o in graph.walk(obj,handled):
+      yield o
+
+  # Set up an index of the current data objects, which is used by
+  # _iter_objects() and _iter_axes() until it's cleared again with
+  # _clear_object_graph().
+  # Mixins should only keep it active while the structure of the variables
+  # doesn't change.
+  def _object_graph (self):
+    if getattr(self,'_graph',None) is None:
+      self._graph = _ObjectGraph(self._varlist)
+    return self._graph
+  def _clear_object_graph (self):
+    self.__dict__.pop('_graph',None)
 
   # How to decode the data from a raw binary array.
+  # If an output array is given, the values are written there (with the
+  # dtype of that array).
   @classmethod
-  def _decode (cls, data):
+  def _decode (cls, data, out=None):
     raise NotImplementedError("No decoder found.")
 
+  # How to decode many records at once.
+  # Takes a list of arguments for _decode (one dictionary per record), and
+  # returns an array with the records stacked along the first dimension.
+  # If an output array is given, it must have the records along the first
+  # dimension.
+  # Mixins can override this to handle their arguments in bulk, otherwise
+  # the records are passed through _decode one at a time.
+  @classmethod
+  def _decode_many (cls, records, out=None):
+    return _decode_each (cls, cls, records, out)
+
   # Shortcuts to header decoding functions.
   # Put into the class so they can potentially be overridden for other formats.
   @staticmethod
@@ -904,9 +2244,29 @@ class BufferBase (object):
   @staticmethod
   def _raw_headers (filename):
     raise NotImplementedError("No decoder found.")
+  # Re-create decoded headers from their packed form (see save_index).
+  @staticmethod
+  def _unpack_headers (raw, columns):
+    raise NotImplementedError("No decoder found.")
+
+  def stats (self):
+    """
+    Get the timing information and counters collected for the conversion.
+    The collection needs to be turned on first with fstd2nc.stats.enable()
+    (before the Buffer is created, to include the initialization).
+    """
+    return stats.report()
 
   # Shortcut for reading a record, given a record id.
   def _read_record (self, rec):
+    return self._decode(**self._record_args(rec))
+
+  # Shortcut for reading many records at once.
+  def _read_records (self, recs):
+    return self._decode_many([self._record_args(rec) for rec in recs])
+
+  # Get the arguments for decoding a record.
+  def _record_args (self, rec):
     import numpy as np
     kwargs = {}
     # Add file-based data.
@@ -928,6 +2288,7 @@ class BufferBase (object):
       if address == -1 or length == -1: continue
       f.seek(address,0)
       data = np.fromfile(f,'B',length)
+      stats.count('bytes_read',len(data))
       kwargs[key] = data
     for key in self._decoder_extra_args:
       if key in self._headers:
@@ -936,7 +2297,7 @@ class BufferBase (object):
     kwargs.update(self._decoder_scalar_args())
     if f is not None:
       f.close()
-    return self._decode(**kwargs)
+    return kwargs
 
 
   #
@@ -126,7 +126,7 @@ class FSTD_Compat (BufferBase):
     # immediately, bypassing this list.
     io = []
 
-    self._makevars()
+    self._makevars_cached()
 
     # Define the dimensions.
     for axis in self._iter_axes():
@@ -20,6 +20,7 @@
 
 from fstd2nc.stdout import _, info, warn, error
 from fstd2nc.mixins import BufferBase
+from fstd2nc import stats
 try:
   from collections import Callable
 except ImportError:  # Python 3.10
@@ -86,12 +87,14 @@ def _read_block (filename, offset, length):
     # Skip addresses that are -1 (indicates no data available).
     # E.g. for masked data, if no corresponding mask available
     if offset < 0: return None
-    with open(filename,'rb') as f:
+    with stats.span('read block', cat='io', offset=int(offset)), open(filename,'rb') as f:
       f.seek (offset,0)
-      return np.fromfile(f,'B',length)
+      data = np.fromfile(f,'B',length)
+    stats.count('bytes_read',len(data))
+    return data
   # Vectorized version.
   out = []
-  with open(filename,'rb') as f:
+  with stats.span('read block', cat='io', nblocks=len(offset)), open(filename,'rb') as f:
     for o, l in zip(offset, length):
       # Skip addresses that are -1 (indicates no data available).
       # E.g. for masked data, if no corresponding mask available
@@ -100,6 +103,7 @@ def _read_block (filename, offset, length):
         continue
       f.seek (o,0)
       out.append(np.fromfile(f,'B',l))
+      stats.count('bytes_read',len(out[-1]))
   return out
 
 
@@ -113,16 +117,14 @@ class ExternOutput (BufferBase):
     # Scalar case (decoding single record)
     if not any(isinstance(v,list) for v in values):
       kwargs = dict(zip(keys,values))
-      return cls._decode(**kwargs)
+      with stats.span('decode'):
+        return cls._decode(**kwargs)
     # Vectorized case (decoding multiple records into a single fused array)
     nrec = [len(v) for v in values if isinstance(v,list)][0]
     values = [v if isinstance(v,list) else [v]*nrec for v in values]
-    out = []
-    for i in range(nrec):
-      kwargs = dict((k,v[i]) for k,v in zip(keys,values))
-      out.append(cls._decode(**kwargs))
-    import numpy as np
-    return np.concatenate(out)
+    records = [dict((k,v[i]) for k,v in zip(keys,values)) for i in range(nrec)]
+    with stats.span('decode', nrec=nrec):
+      return cls._decode_many(records)
 
   def _iter_dask (self, include_coords=True, fused=True):
     """
@@ -135,10 +137,11 @@ class ExternOutput (BufferBase):
     from itertools import product
     unique_token = tokenize(self._files,id(self))
     files = np.array(self._files, dtype=object)
-    self._makevars()
+    self._makevars_cached()
+    varlist = set(map(id,self._varlist))
     for var in self._iter_objects():
       if not include_coords:
-        if var not in self._varlist:
+        if id(var) not in varlist:
           continue
       if not isinstance(var,(_iter_type,_chunk_type)):
         yield var
@@ -25,6 +25,20 @@ from fstd2nc.mixins import BufferBase
 #################################################
 # Mixin for pre-filtering the RPN file records.
 
+# Pattern for detecting if a filter uses byte strings.
+_bytestrings_pattern = "b['\"]"
+
+# Convert a column of byte strings to (right-stripped) unicode strings.
+def _to_unicode (value):
+  import numpy as np
+  new_dtype = 'U'+str(value.dtype.itemsize)
+  value = value[:,None].view('B').astype('i4')
+  # rstrip
+  mask = np.cumsum(value[:,::-1]-32, axis=1)[:,::-1] == 0
+  value[mask] = 0
+  value = value.flatten()
+  return value.view(new_dtype)
+
 class FilterRecords (BufferBase):
   @classmethod
   def _cmdline_args (cls, parser):
@@ -52,19 +66,12 @@ class FilterRecords (BufferBase):
     records_with_strings = self._headers.copy()
     for key, value in records_with_strings.items():
       if value.dtype.char == 'S':
-        new_dtype = 'U'+str(value.dtype.itemsize)
-        value = value[:,None].view('B').astype('i4')
-        # rstrip
-        mask = np.cumsum(value[:,::-1]-32, axis=1)[:,::-1] == 0
-        value[mask] = 0
-        value = value.flatten()
-        records_with_strings[key] = value.view(new_dtype)
-    bytestrings_pattern = re.compile("b['\"]")
+        records_with_strings[key] = _to_unicode(value)
     # Loop over each filter and apply.
     for cmd in self._filters:
       try:
         # Check if the filter uses byte strings or standard (unicode) strings.
-        if re.search(bytestrings_pattern, cmd):
+        if re.search(_bytestrings_pattern, cmd):
           flags &= self._do_filter(records_with_bytestrings, cmd)
         else:
           flags &= self._do_filter(records_with_strings, cmd)
@@ -72,6 +79,44 @@ class FilterRecords (BufferBase):
         error (_("unable to apply the filter: %s")%cmd)
     # To filter out unwanted records, unselected in the list.
     self._headers['selected'] = self._headers['selected'] & flags
+
+  # Apply the filters to the freshly decoded headers, so unwanted records
+  # can be dropped right away.
+  # Only filters that use the raw header columns are applied here, the rest
+  # are handled after all the other mixins are done.
+  def _prefilter_headers (self, headers):
+    import numpy as np
+    import ast
+    import re
+    keep = super(FilterRecords,self)._prefilter_headers(headers)
+    for cmd in self._filters:
+      try:
+        tree = ast.parse(cmd.strip(), mode='eval')
+      except SyntaxError:
+        continue  # Will be reported later.
+      names = set(node.id for node in ast.walk(tree) if isinstance(node,ast.Name))
+      names -= set(['numpy','np'])
+      if not all(name in headers and name in self._prefilter_columns for name in names):
+        continue
+      p = dict((name,headers[name]) for name in names)
+      if not re.search(_bytestrings_pattern, cmd):
+        for key, value in p.items():
+          if value.dtype.char == 'S':
+            p[key] = _to_unicode(value)
+      try:
+        flags = eval(cmd, None, dict(p, numpy=np, np=np))
+      except Exception:
+        continue  # Will be reported later.
+      flags = np.asarray(flags)
+      if flags.dtype != bool:
+        continue
+      flags = np.broadcast_to(flags, len(headers['file_id']))
+      if keep is None:
+        keep = flags
+      else:
+        keep = keep & flags
+    return keep
+
   @staticmethod
   def _do_filter (p, cmd):
     # Allow numpy functions to work with the filters.
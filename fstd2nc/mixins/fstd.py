@@ -53,12 +53,23 @@ def fast_dtype_fst2numpy (datyp, nbits):
   args += np.asarray(nbits,'uint64')
   return packed_dtype_fst2numpy(args)
 
+# Get file address and length (in bytes) from the raw header values.
+def _swa_to_address (swa):
+  import numpy as np
+  return np.array(swa,int)*8-8
+def _lng_to_length (lng):
+  import numpy as np
+  return np.array(lng,int)*4
+
 # Define a class for encoding / decoding FSTD data.
 class FSTD (BufferBase):
   _format = _("RPN standard file")
   _format_singular = _("an RPN standard file")
   _format_plural = _("RPN standard file(s)")
 
+  # Raw header columns that can be used for selecting records at scan time.
+  _prefilter_columns = ('nomvar','typvar','etiket','ip1','ip2','ip3','datev','dateo','deet','npas','datyp','nbits','ni','nj','nk','grtyp','ig1','ig2','ig3','ig4')
+
   # Keep a reference to fstd98 so it's available during cleanup.
   try:
     from rpnpy.librmn import fstd98 as _fstd98
@@ -71,6 +82,19 @@ class FSTD (BufferBase):
     parser.add_argument('--ignore-typvar', action='store_true', help=_('Tells the converter to ignore the typvar when deciding if two records are part of the same field.  Default is to split the variable on different typvars.'))
     parser.add_argument('--ignore-etiket', action='store_true', help=_('Tells the converter to ignore the etiket when deciding if two records are part of the same field.  Default is to split the variable on different etikets.'))
 
+  # Keep all coordinate records, since they may be needed for any of the
+  # selected variables.
+  def _protected_headers (self, headers):
+    import numpy as np
+    protected = super(FSTD,self)._protected_headers(headers)
+    meta_names = [(meta_name+b'   ')[:4] for meta_name in self._meta_records+self._maybe_meta_records]
+    if len(meta_names) == 0:
+      return protected
+    is_meta = np.isin(headers['nomvar'], meta_names)
+    if protected is None:
+      return is_meta
+    return protected | is_meta
+
   # Helper method - find all records with the given criteria.
   # Mimics fstinl, but returns table indices instead of record handles.
   def _fstinl (self, **criteria):
@@ -82,7 +106,7 @@ class FSTD (BufferBase):
 
   # Helper method - get metadata of the given record.
   def _fstprm (self, rec):
-    prm = dict((k,v[rec]) for k,v in self._headers.items())
+    prm = self._headers.row(rec)
     for k in ('typvar','nomvar','grtyp','etiket'):
       prm[k] = prm[k].decode()
     return prm
@@ -168,27 +192,44 @@ class FSTD (BufferBase):
     self._headers['name'] = self._headers['nomvar']
     # These two fields may not exist for externally-sourced data
     # (such as from fstpy)
+    # These are computed from the raw headers only when needed.
     if 'swa' in self._headers:
-      self._headers['address'] = np.array(self._headers['swa'],int)*8-8
+      self._headers.derive('address', _swa_to_address, 'swa')
     if 'lng' in self._headers:
-      self._headers['length'] = np.array(self._headers['lng'],int)*4
+      self._headers.derive('length', _lng_to_length, 'lng')
     self._headers['dtype'] = np.array(fast_dtype_fst2numpy(self._headers['datyp'],self._headers['nbits']))
     self._headers['selected'] = (self._headers['dltf']==0) & (self._headers['ismeta'] == False)
 
   # How to decode the data from a raw binary array.
   @classmethod
-  def _decode (cls, data):
+  def _decode (cls, data, out=None):
     from fstd2nc.extra import decode
     # Degenerate case: decoding handled in opaque dask layer, nothing to do.
     if hasattr(data,'dask'):
       import numpy as np
+      if out is not None:
+        from fstd2nc.mixins import _copy_to
+        return _copy_to (out, np.asarray(data.T))
       return np.array(data.T)
+    # Decode directly into the output array.
+    if out is not None:
+      return decode(data, out=out)
     nbits = int(data[0x0b])
     datyp = int(data[0x13])
     dtype = dtype_fst2numpy(datyp, nbits)
     out = decode(data).view(dtype)
     return out
 
+  # How to decode many records from raw binary arrays.
+  @classmethod
+  def _decode_many (cls, records, out=None):
+    from fstd2nc.extra import decode_many
+    from fstd2nc.mixins import _decode_each
+    # Need to go one at a time if some of the data is from dask.
+    if any(hasattr(kwargs['data'],'dask') for kwargs in records):
+      return _decode_each (FSTD, cls, records, out)
+    return decode_many([kwargs['data'] for kwargs in records], out=out)
+
   # Shortcuts to header decoding functions.
   # Put into the class so they can potentially be overridden for other formats.
   @staticmethod
@@ -196,9 +237,19 @@ class FSTD (BufferBase):
     from fstd2nc.extra import decode_headers
     return decode_headers(headers)
   @staticmethod
+  def _unpack_headers (raw, columns):
+    from fstd2nc.extra import _DecodedHeaders
+    return _DecodedHeaders(raw, columns)
+  # Scanning the directory pages is dominated by I/O.
+  _raw_headers_io_bound = True
+  @staticmethod
   def _raw_headers (filename):
     from fstd2nc.extra import raw_headers
     return raw_headers(filename)
+  @classmethod
+  def _raw_headers_since (cls, filename, nrecs, position=None):
+    from fstd2nc.extra import raw_headers_since
+    return raw_headers_since(filename, nrecs, position)
 
   def to_fstd (self, filename):
     """
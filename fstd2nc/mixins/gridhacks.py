@@ -20,6 +20,7 @@
 
 from fstd2nc.stdout import _, info, warn, error
 from fstd2nc.mixins import BufferBase
+from fstd2nc import stats
 
 
 # Define a lock for controlling threaded access to ezscint, etc.
@@ -27,6 +28,22 @@ from threading import RLock
 _lock = RLock()
 del RLock
 
+# Helper method - remove some decoder arguments from a record.
+def _without (kwargs, *keys):
+  return dict((k,v) for k,v in kwargs.items() if k not in keys)
+
+# Helper method - replace the grid descriptors for a subset of records.
+# New columns are assigned into the table (instead of modifying the existing
+# ones in place), so the headers from the original file scan stay intact.
+def _set_grid (headers, mask, grid):
+  import numpy as np
+  for key in ('grtyp','ni','nj','ig1','ig2','ig3','ig4'):
+    column = headers[key]
+    headers[key] = np.where(mask, np.array(grid[key],dtype=column.dtype), column)
+  # Keep the inner dimensions in sync.
+  headers['j'] = headers['nj']
+  headers['i'] = headers['ni']
+
 
 ############################################################
 # Mixin for questionable modifications to the headers table.
@@ -40,6 +57,14 @@ class GridHacks (BufferBase):
       self._read_record = self.__read_record
       self._fstluk = self.__fstluk
 
+  # The records that were hacked in are tied to the existing records, so
+  # everything needs to be processed again when new records are added.
+  def _refresh_context (self):
+    import numpy as np
+    if hasattr(self,'_hacks'):
+      return np.ones(self._nrecs,'bool')
+    return super(GridHacks,self)._refresh_context()
+
   # Hack in record data that doesn't actually exist in the source file.
   def __read_record (self, rec_id):
     if rec_id not in getattr(self,'_hacks',{}):
@@ -166,20 +191,21 @@ def _unpack_grid (grid):
   def _unpack_dict (d):
     return dict(map(_unpack_item,d))
   if grid is None: return -1
-  # Check if grid already handled.
-  for gid, g in _grid_lookup.items():
-    if g is grid: return gid
-  # Otherwise, start unpacking it.
-  packed_grid = grid
-  grid = _unpack_dict(grid)
+  # Note: lock the whole lookup, since this may be called from many threads.
   with _lock:
+    # Check if grid already handled.
+    for gid, g in _grid_lookup.items():
+      if g is grid: return gid
+    # Otherwise, start unpacking it.
+    packed_grid = grid
+    grid = _unpack_dict(grid)
     # Special case: super grid
     if 'subgrid' in grid:
       subgrids = [rmn.encodeGrid(subgrid)['id'] for subgrid in grid['subgrid']]
       gid = rmn.ezgdef_supergrid(grid['ni'], grid['nj'], grid['grtyp'], grid['grref'], grid['version'], subgrids)
     else:
       gid = rmn.encodeGrid(grid)['id']
-  _grid_lookup[gid] = packed_grid
+    _grid_lookup[gid] = packed_grid
   return gid
 
 
@@ -226,16 +252,24 @@ class Interp (BufferBase):
     if not hasattr(self,'_interp_grid'):
       return super(Interp,self)._makevars()
 
+    # Start from the original grid descriptors, in case the variables were
+    # already generated once (e.g. for a Buffer restored from an index file).
+    if hasattr(self,'_source_grid_columns'):
+      for key, column in self._source_grid_columns.items():
+        self._headers[key] = column
+    else:
+      self._source_grid_columns = dict((key,self._headers[key]) for key in ('grtyp','ni','nj','ig1','ig2','ig3','ig4','j','i'))
+
     # Run _makevars chain with original grid descriptors to allow
     # xycoords to give us source grid ids,
     # switch out the grid descriptors in the table, then let xycoords
     # construct the target grid axes for us.
     super(Interp,self)._makevars()
-    self._headers['source_grid'][:] = _pack_grid(self._gids)
+    source_grid = np.empty(self._nrecs,dtype=object)
+    source_grid[:] = _pack_grid(self._gids)
+    self._headers['source_grid'] = source_grid
     # Now, use interpolated grid descriptors.
-    ismeta = self._headers['ismeta']
-    for key in ('grtyp','ni','nj','ig1','ig2','ig3','ig4'):
-      self._headers[key][:] = np.where(ismeta, self._headers[key], self._interp_grid[key])
+    _set_grid (self._headers, ~self._headers['ismeta'], self._interp_grid)
     super(Interp,self)._makevars()
 
     # Add fill value to the data.
@@ -246,6 +280,19 @@ class Interp (BufferBase):
       if isinstance(var,_iter_type):
         var.atts['_FillValue'] = var.dtype.type(self._fill_value)
 
+  # The grid id is only valid in the process that created it, so need to
+  # define the grid again when restoring from an index file.
+  def _restore_index (self):
+    import rpnpy.librmn.all as rmn
+    super(Interp,self)._restore_index()
+    if not hasattr(self,'_interp_grid'):
+      return
+    with _lock:
+      grid = dict((k,v) for k,v in self._interp_grid.items() if k != 'id')
+      self._interp_grid = dict(grid, id=rmn.encodeGrid(grid)['id'])
+    rmn.ezsetopt (rmn.EZ_OPT_EXTRAP_DEGREE, rmn.EZ_EXTRAP_VALUE)
+    rmn.ezsetopt (rmn.EZ_OPT_EXTRAP_VALUE, self._fill_value)
+
   def _decoder_scalar_args (self):
     args = super(Interp,self)._decoder_scalar_args()
     if hasattr(self,'_interp_grid'):
@@ -254,18 +301,19 @@ class Interp (BufferBase):
 
   # Handle grid interpolations from raw binary array.
   @classmethod
-  def _decode (cls, data, source_grid=None, dest_grid=None, **kwargs):
+  def _decode (cls, data, source_grid=None, dest_grid=None, out=None, **kwargs):
     import rpnpy.librmn.all as rmn
     import numpy as np
+    from fstd2nc.mixins import _copy_to
     # If no interpolation requested, nothing to do.
     if source_grid is None or dest_grid is None:
-      return super(Interp,cls)._decode (data, **kwargs)
+      return super(Interp,cls)._decode (data, out=out, **kwargs)
     source_grid = _unpack_grid(source_grid)
     dest_grid = _unpack_grid(dest_grid)
     if source_grid < 0:
       raise ValueError("Source data is not on a recognized grid.  Unable to interpolate.")
     d = super(Interp,cls)._decode (data, **kwargs).T
-    with _lock:
+    with stats.span('interpolate'), stats.acquire(_lock):
       # Propogate any fill values to the interpolated grid.
       fill_value = kwargs.get('fill_value')
       in_mask = np.zeros(d.shape, order='F', dtype='float32')
@@ -274,8 +322,20 @@ class Interp (BufferBase):
       out_mask = rmn.ezsint (dest_grid, source_grid, in_mask)
       d[out_mask!=0] = fill_value
       # Return the data for the interpolated field.
+      if out is not None:
+        return _copy_to (out, d.T)
       return d.T
 
+  # Handle grid interpolations for many records.
+  # Only done in bulk if there is no interpolation.
+  @classmethod
+  def _decode_many (cls, records, out=None):
+    from fstd2nc.mixins import _decode_each
+    if any(kwargs.get('source_grid') is not None and kwargs.get('dest_grid') is not None for kwargs in records):
+      return _decode_each (Interp, cls, records, out)
+    records = [_without(kwargs,'source_grid','dest_grid') for kwargs in records]
+    return super(Interp,cls)._decode_many (records, out=out)
+
 
 #################################################
 # Mixin for yin/yang grid subsetting.
@@ -309,15 +369,8 @@ class YinYang (BufferBase):
     if not self._yin and not self._yang:
       return
 
-    # Run _makevars early to generate grid ids with xycoords mixin.
-    # Silence warnings from makevars, which might not be relevant to the final
-    # state after we make our grid modifications.
-    import fstd2nc
-    streams = fstd2nc.stdout.streams
-    fstd2nc.stdout.streams = ()
-    self._makevars()
-    fstd2nc.stdout.streams = streams
-    gids = self._gids
+    # Get the grid ids of the supergrids (from xycoords mixin).
+    gids = self._grid_ids(('U',))
 
     # Get the Z grid for one half of the YY input.
     if self._yin: yy_ind = 0
@@ -336,8 +389,7 @@ class YinYang (BufferBase):
       ig3 = int(self._headers['ig3'][rec_id])
       ig4 = int(self._headers['ig4'][rec_id])
       submask = mask & (self._headers['ig1'] == ig1) & (self._headers['ig2'] == ig2) & (self._headers['ig3'] == ig3) & (self._headers['ig4'] == ig4)
-      for key in ('grtyp','ni','nj','ig1','ig2','ig3','ig4'):
-        self._headers[key][submask] = dest_grid[key]
+      _set_grid (self._headers, submask, dest_grid)
 
   def _decoder_scalar_args (self):
     kwargs = super(YinYang,self)._decoder_scalar_args()
@@ -347,18 +399,31 @@ class YinYang (BufferBase):
 
   # Handle grid interpolations from raw binary array.
   @classmethod
-  def _decode (cls, data, yin=False, yang=False, **kwargs):
+  def _decode (cls, data, yin=False, yang=False, out=None, **kwargs):
+    from fstd2nc.mixins import _copy_to
     if not yin and not yang:
-      return super(YinYang,cls)._decode (data, **kwargs)
+      return super(YinYang,cls)._decode (data, out=out, **kwargs)
     prm = cls._decode_headers(data[:72])
-    prm = dict((k,v[0]) for k,v in prm.items())
+    prm = dict((k,prm[k][0]) for k in ('grtyp','nj'))
     d = super(YinYang,cls)._decode (data, **kwargs).T
     if prm['grtyp'] == b'U' and yin:
       d = d[:,:prm['nj']//2]
     elif prm['grtyp'] == b'U' and yang:
       d = d[:,prm['nj']//2:]
+    if out is not None:
+      return _copy_to (out, d.T)
     return d.T
 
+  # Handle yin/yang subsetting for many records.
+  # Only done in bulk if there is no subsetting.
+  @classmethod
+  def _decode_many (cls, records, out=None):
+    from fstd2nc.mixins import _decode_each
+    if any(kwargs.get('yin',False) or kwargs.get('yang',False) for kwargs in records):
+      return _decode_each (YinYang, cls, records, out)
+    records = [_without(kwargs,'yin','yang') for kwargs in records]
+    return super(YinYang,cls)._decode_many (records, out=out)
+
 #################################################
 # Mixin for grid cropping.
 #
@@ -370,6 +435,14 @@ class Crop (BufferBase):
     super(Crop,cls)._cmdline_args(parser)
     parser.add_argument('--crop-to-smallest-grid', action='store_true', help=_('Crop grids to the smaller (inner core) domain for LAM outputs.'))
 
+  # The smallest grid is found from all the records, so everything needs to
+  # be processed again when new records are added.
+  def _refresh_context (self):
+    import numpy as np
+    if self._crop_to_smallest_grid:
+      return np.ones(self._nrecs,'bool')
+    return super(Crop,self)._refresh_context()
+
   def __init__ (self, *args, **kwargs):
     """
     crop_to_smallest_grid : bool, optional
@@ -398,15 +471,8 @@ class Crop (BufferBase):
     self._headers['crop_iN'][:] = self._headers['ni']
     self._ignore_atts = self._ignore_atts + ('crop_j0','crop_jN','crop_i0','crop_iN')
 
-    # Run _makevars early to generate grid ids with xycoords mixin.
-    # Silence warnings from makevars, which might not be relevant to the final
-    # state after we make our grid modifications.
-    import fstd2nc
-    streams = fstd2nc.stdout.streams
-    fstd2nc.stdout.streams = ()
-    self._makevars()
-    fstd2nc.stdout.streams = streams
-    gids = self._gids
+    # Get the grid ids of the records (from xycoords mixin).
+    gids = self._grid_ids()
 
     # Find all available grids, group them by their projection parameters.
     # I.e., lump together all grids that only differ in their x/y extent.
@@ -444,21 +510,48 @@ class Crop (BufferBase):
         if np.any(grid['ay'].flatten()[j0:jN] != smallest_grid['ay'].flatten()): continue
         # Able to crop, so update the headers to point to the cropped coordinates.
         submask = (self._headers['ig1'] == grid['tag1']) & (self._headers['ig2'] == grid['tag2']) & (self._headers['ig3'] == grid['tag3'])
-        for key in ('grtyp','ni','nj','ig1','ig2','ig3','ig4'):
-          self._headers[key][submask] = smallest_grid[key]
+        _set_grid (self._headers, submask, smallest_grid)
         self._headers['crop_j0'][submask] = j0
         self._headers['crop_jN'][submask] = jN
         self._headers['crop_i0'][submask] = i0
         self._headers['crop_iN'][submask] = iN
+    self._headers.touch()
 
   # Handle cropping from raw binary array.
   @classmethod
-  def _decode (cls, data, crop_j0=None, crop_jN=None, crop_i0=None, crop_iN=None, **kwargs):
+  def _decode (cls, data, crop_j0=None, crop_jN=None, crop_i0=None, crop_iN=None, out=None, **kwargs):
+    from fstd2nc.mixins import _copy_to
+    if crop_j0 is None and crop_i0 is None:
+      return super(Crop,cls)._decode (data, out=out, **kwargs)
     d = super(Crop,cls)._decode (data, **kwargs)
     if crop_j0 is not None and crop_jN is not None:
       d = d[crop_j0:crop_jN,:]
     if crop_i0 is not None and crop_iN is not None:
       d = d[:,crop_i0:crop_iN]
+    if out is not None:
+      return _copy_to (out, d)
     return d
 
+  # Handle cropping for many records.
+  # Can crop in bulk if all records have the same region.
+  @classmethod
+  def _decode_many (cls, records, out=None):
+    from fstd2nc.mixins import _decode_each, _copy_to
+    keys = ('crop_j0','crop_jN','crop_i0','crop_iN')
+    regions = set(tuple(kwargs.get(k) for k in keys) for kwargs in records)
+    if len(regions) > 1:
+      return _decode_each (Crop, cls, records, out)
+    records = [_without(kwargs,*keys) for kwargs in records]
+    crop_j0, crop_jN, crop_i0, crop_iN = regions.pop() if len(regions) > 0 else (None,)*4
+    if crop_j0 is None and crop_i0 is None:
+      return super(Crop,cls)._decode_many (records, out=out)
+    d = super(Crop,cls)._decode_many (records)
+    if crop_j0 is not None and crop_jN is not None:
+      d = d[:,crop_j0:crop_jN,:]
+    if crop_i0 is not None and crop_iN is not None:
+      d = d[:,:,crop_i0:crop_iN]
+    if out is None:
+      return d
+    return _copy_to (out, d)
+
 
@@ -42,6 +42,38 @@ class Masks (BufferBase):
     super(Masks,cls)._cmdline_args(parser)
     parser.add_argument('--fill-value', type=float, default=1e30, help=_("The fill value to use for masked (missing) data.  Gets stored as '_FillValue' attribute in the metadata.  Default is '%(default)s'."))
 
+  # Keep the mask records, they're needed by the fields that use them.
+  def _protected_headers (self, headers):
+    protected = super(Masks,self)._protected_headers(headers)
+    if 'typvar' not in headers:
+      return protected
+    is_mask = (headers['typvar'] == b'@@')
+    if protected is None:
+      return is_mask
+    return protected | is_mask
+
+  # When new records are added, any data that's still missing its mask (and
+  # any masks that weren't matched to data yet) need to be paired up again.
+  def _refresh_context (self):
+    from collections import OrderedDict
+    import numpy as np
+    from fstd2nc.extra import structured_array
+    context = super(Masks,self)._refresh_context()
+    if 'mask_address' not in self._headers:
+      return context
+    typvar = self._headers['typvar']
+    uses_mask = np.array(typvar,dtype='|S2').view('|S1').reshape(-1,2)[:,1] == b'@'
+    is_mask = (typvar == b'@@')
+    mask_address = self._headers['mask_address']
+    paired = (mask_address != -1)
+    file_id = self._headers['file_id']
+    masks = structured_array(OrderedDict([('file_id',file_id),('address',self._headers['address'])])).data
+    used = structured_array(OrderedDict([('file_id',file_id[paired]),('address',mask_address[paired].astype(masks.dtype['address']))])).data
+    needed = (uses_mask & ~is_mask & ~paired) | (is_mask & ~np.isin(masks,used))
+    if context is None:
+      return needed
+    return context | needed
+
   def __init__ (self, *args, **kwargs):
     """
     fill_value : scalar, optional
@@ -57,6 +89,7 @@ class Masks (BufferBase):
     self._fill_value = kwargs.pop('fill_value',1e30)
     self._decoder_extra_args = self._decoder_extra_args + ('alt_mask',)
     self._ignore_atts = ('mask_record','mask_length','alt_mask') + self._ignore_atts
+    self._default_columns = self._default_columns + (('mask_address',-1),('mask_length',-1))
     super(Masks,self).__init__(*args,**kwargs)
 
     # Check for usage of the alternate masking technique (flag 64).
@@ -141,16 +174,19 @@ class Masks (BufferBase):
 
   # Apply the mask data from raw binary array.
   @classmethod
-  def _decode (cls, data, fill_value, mask=None, alt_mask=False, **kwargs):
+  def _decode (cls, data, fill_value, mask=None, alt_mask=False, out=None, **kwargs):
     import numpy as np
     # Get first field.
-    field1 = super(Masks,cls)._decode(data, **kwargs)
+    field1 = super(Masks,cls)._decode(data, out=out, **kwargs)
     # If this data is encoded by the datyp+64 flag, then mask out the
     # largest value, assuming the mask was generated by (max-min)*1.01
     # or something similar.
     # TODO: Use the proper interface once it's wrapped in rpnpy.
     if alt_mask:
       mx = field1.max()
+      if out is not None:
+        out[out==mx] = fill_value
+        return out
       field1 = np.where(field1==mx, fill_value, field1)
       return field1
     # Is there a mask field available?
@@ -158,4 +194,44 @@ class Masks (BufferBase):
     if mask is None:
       return field1
     field2 = super(Masks,cls)._decode(mask, **kwargs)
+    if out is not None:
+      _apply_mask (out, field2, fill_value)
+      return out
     return ((field1*(field2>0)) + fill_value * (field2==0)).astype(field1.dtype)
+
+  # Apply the mask data for many records at once.
+  @classmethod
+  def _decode_many (cls, records, out=None):
+    import numpy as np
+    fields = []
+    masks = []
+    for kwargs in records:
+      kwargs = dict(kwargs)
+      fill_value = kwargs.pop('fill_value')
+      mask = kwargs.pop('mask',None)
+      alt_mask = kwargs.pop('alt_mask',False)
+      fields.append(kwargs)
+      masks.append((fill_value,mask,alt_mask))
+    field1 = super(Masks,cls)._decode_many(fields, out=out)
+    # Records that are masked out by the datyp+64 flag.
+    for i, (fill_value, mask, alt_mask) in enumerate(masks):
+      if alt_mask:
+        mx = field1[i].max()
+        field1[i] = np.where(field1[i]==mx, fill_value, field1[i])
+    # Records that have a mask field available.
+    ind = [i for i, (fill_value, mask, alt_mask) in enumerate(masks) if mask is not None and not alt_mask]
+    if len(ind) == 0:
+      return field1
+    field2 = super(Masks,cls)._decode_many([dict(fields[i],data=masks[i][1]) for i in ind])
+    for i, f2 in zip(ind, field2):
+      _apply_mask (field1[i], f2, masks[i][0])
+    return field1
+
+# Helper method - apply a mask to the decoded values, in-place.
+# Same as (field*(mask>0)) + fill_value*(mask==0), without the temporary
+# arrays.
+def _apply_mask (field, mask, fill_value):
+  import numpy as np
+  mask = mask.reshape(field.shape)
+  field *= (mask>0)
+  np.add (field, fill_value, out=field, where=(mask==0), casting='unsafe')
@@ -20,6 +20,7 @@
 
 from fstd2nc.stdout import _, info, warn, error
 from fstd2nc.mixins import BufferBase
+from fstd2nc import stats
 
 # Helper function - apply metadata and renames to the variables.
 def apply_metadata (b):
@@ -194,6 +195,10 @@ class netCDF_IO (BufferBase):
       if var.dims.index('time') > 0:
         self._time_unlimited = False
 
+    # The renames and time conversions below don't change the structure of the
+    # variables, so the same object graph can be used for all of them.
+    self._object_graph()
+
     # Generate unique names for output data.
     if self._unique_names:
       self._fix_names()
@@ -217,6 +222,9 @@ class netCDF_IO (BufferBase):
         var.atts.update(units=units, calendar=calendar)
         var.array = np.asarray(date2num(var.array,units=units), dtype='double')
 
+    # Encoding the attributes moves objects into the dependencies, so use a
+    # fresh traversal from here on.
+    self._clear_object_graph()
     for obj in self._iter_objects():
       # Encode the attributes so they're ready for writing to netCDF.
       # Handles things like encoding coordinate objects to a string.
@@ -328,6 +336,11 @@ class netCDF_IO (BufferBase):
 
       var_ids = ['_'.join(var_id) for var_id in var_ids]
 
+      # If the metadata can't tell the variables apart (e.g. for pieces of a
+      # variable that was split by coverage), then use integer suffixes.
+      if len(set(var_ids)) < len(var_list):
+        var_ids = [str(r) for r in range(1,len(var_list)+1)]
+
       warn (_("Multiple definitions of %s.  Adding unique suffixes %s.")%(varname, ', '.join(var_ids)))
 
       # Apply the name changes.
@@ -376,7 +389,7 @@ class netCDF_IO (BufferBase):
     # immediately, bypassing this list.
     io = []
 
-    self._makevars()
+    self._makevars_cached()
 
     # Define the dimensions.
     for axis in self._iter_axes():
@@ -443,34 +456,120 @@ class netCDF_IO (BufferBase):
     # Now, do the actual transcribing of the data.
     # Read/write the data in the same order of records in the RPN file(s) to
     # improve performance.
+    # The records are decoded into reusable buffers, which already have the
+    # type of the netCDF variable.
+    buffers = dict()
     Bar = _ProgressBar if (progress is True and len(io) > 0) else _FakeBar
     bar = Bar(_("Saving netCDF file"), suffix="%(percent)d%% [%(myeta)s]", max=len(io)-1)
     if turbo:
-      from multiprocessing import Pool
-      import numpy as np
-      io = sorted(io)
-      with Pool() as p:
-        raw = p.imap (_quick_load, ((self, r) for r,shape,v,ind in io))
-        raw = bar.iter(raw)
-        for (r,shape,v,ind), stuff in zip(io, raw):
-          data = self._decode (**stuff)
-          v[ind] = data.astype(v.dtype).reshape(shape)
+      from multiprocessing.pool import ThreadPool
+      from multiprocessing import cpu_count
+      # Load and decode the batches in a pool of threads (the decoding is
+      # thread-safe, and librmn releases the GIL).  The netCDF file is only
+      # written from this thread.
+      # Each batch gets its own output array, since many are in flight at
+      # once.
+      batches = _batches(sorted(io), key=lambda item: (item[2],item[1]))
+      batches = ((batch, batch[0][2].dtype) for batch in batches)
+      with ThreadPool() as p:
+        for (batch, dtype), data in _imap_ahead (p, self._load_and_decode_batch, batches, ahead=2*cpu_count()):
+          _write_batch (batch, data)
+          bar.next(len(batch))
         bar.finish()
     else:
-      for r,shape,v,ind in bar.iter(sorted(io)):
-        try:
-          stuff = _quick_load ((self, r))
-          data = self._decode (**stuff)
-          v[ind] = data.astype(v.dtype).reshape(shape)
-        except (IndexError,ValueError):
-          warn(_("Internal problem with the script - unable to get data for '%s'")%v.name)
-          continue
+      for batch in _batches(bar.iter(sorted(io)), key=lambda item: (item[2],item[1])):
+        r, shape, v, ind = batch[0]
+        out = _output_buffer (buffers, len(batch), shape, v.dtype)
+        data = self._load_and_decode_batch (batch, v.dtype, out=out)
+        _write_batch (batch, data)
 
     f.close()
 
   # Alias "to_netcdf" as "write_nc_file" for backwards compatibility.
   write_nc_file = to_netcdf
 
+  # Load and decode a batch of records (from _batches) into the given output
+  # array, or a new array of the given dtype.
+  # If the batch can't be decoded all at once, then the records are decoded
+  # one at a time, so only the problematic records are lost.
+  # Returns the data for each record (None if there was a problem getting
+  # the data).
+  def _load_and_decode_batch (self, batch, dtype, out=None):
+    import numpy as np
+    r, shape, v, ind = batch[0]
+    if out is None:
+      out = np.empty((len(batch),)+shape, dtype=dtype)
+    try:
+      return self._load_and_decode (batch, out)
+    except (IndexError,ValueError):
+      if len(batch) == 1: return [None]
+    data = []
+    for i, item in enumerate(batch):
+      try:
+        data.append(self._load_and_decode ([item], out[i:i+1])[0])
+      except (IndexError,ValueError):
+        data.append(None)
+    return data
+
+  # Helper method - load and decode the records into the output array.
+  def _load_and_decode (self, batch, out):
+    stuff = [_quick_load ((self, r)) for r,shape,v,ind in batch]
+    with stats.span('decode', nrec=len(batch)):
+      return self._decode_many (stuff, out=out)
+
+# Helper method - write a batch of decoded records into the netCDF variables.
+# Records that couldn't be decoded (None) are skipped with a warning.
+def _write_batch (batch, data):
+  with stats.span('write', cat='io', var=batch[0][2].name):
+    for (r,shape,v,ind), d in zip(batch, data):
+      if d is None:
+        warn(_("Internal problem with the script - unable to get data for '%s'")%v.name)
+        continue
+      v[ind] = d
+
+# Helper method - apply a function to the items in a pool of workers, with a
+# limited number of items in flight at once (to limit the memory use).
+# Yields the items along with the results, in the original order.
+def _imap_ahead (pool, func, items, ahead):
+  from collections import deque
+  pending = deque()
+  for item in items:
+    pending.append((item, pool.apply_async(func, item)))
+    if len(pending) > ahead:
+      item, result = pending.popleft()
+      yield item, result.get()
+  while len(pending) > 0:
+    item, result = pending.popleft()
+    yield item, result.get()
+
+# Helper method - group consecutive records for the same variable, so they
+# can be decoded together.
+# The key gives the (variable, record shape) for each item.
+# Batches are limited to 'size' records, and about 'maxvalues' values.
+def _batches (items, key, size=64, maxvalues=2**22):
+  import numpy as np
+  batch = []
+  for item in items:
+    if len(batch) > 0:
+      var, shape = key(item)
+      var0, shape0 = key(batch[0])
+      nvalues = (len(batch)+1) * int(np.prod(shape))
+      if var is not var0 or len(batch) == size or nvalues > maxvalues:
+        yield batch
+        batch = []
+    batch.append(item)
+  if len(batch) > 0:
+    yield batch
+
+# Helper method - get a buffer for decoding n records of the given shape and
+# dtype.  The buffers are re-used between batches.
+def _output_buffer (buffers, n, shape, dtype):
+  import numpy as np
+  key = (shape, np.dtype(dtype).str)
+  if key not in buffers or len(buffers[key]) < n:
+    buffers[key] = np.empty((n,)+shape, dtype=dtype)
+  return buffers[key][:n]
+
 # Internal helper method for delegating the load to a multiprocessing Pool.
 def _quick_load (args):
   import numpy as np
@@ -480,7 +579,7 @@ def _quick_load (args):
   file_id = b._headers['file_id'][r]
   if file_id >= 0:
     filename = b._files[file_id]
-    with open (filename, 'rb') as f:
+    with stats.span('read block', cat='io', record=int(r)), open (filename, 'rb') as f:
       for key, (addr_col,len_col,d_col) in b._decoder_data:
         if d_col in b._headers and b._headers[d_col][r] is not None:
           out[key] = b._headers[d_col][r]
@@ -490,6 +589,7 @@ def _quick_load (args):
           if address >= 0 and length >= 0:
             f.seek (address, 0)
             out[key] = np.fromfile(f,'B',length)
+            stats.count('bytes_read',len(out[key]))
   else:
     for key, (addr_col,len_col,d_col) in b._decoder_data:
       if d_col in b._headers and b._headers[d_col][r] is not None:
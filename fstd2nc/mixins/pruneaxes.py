@@ -27,22 +27,17 @@ from fstd2nc.mixins import BufferBase
 
 class PruneAxes (BufferBase):
   def _makevars (self):
-    from fstd2nc.mixins import _dim_type
-
-    handled_axes = dict()
+    from fstd2nc.mixins import _ObjectGraph, _Registry
 
     super(PruneAxes,self)._makevars()
 
     # Check for identical axes.
-    for axis, varlist in self._iter_axes(varlist=True):
-      if isinstance(axis,_dim_type):
-        key = (axis.name,len(axis))
-      else:
-        key = (axis.name,tuple(axis.array))
+    registry = getattr(self,'_registry',None) or _Registry()
+    graph = _ObjectGraph(self._varlist)
+    for axis, varlist in list(graph.axis_users().values()):
       # Use only one version of the axis.
-      if key in handled_axes:
+      canonical = registry.intern(axis)
+      if canonical is not axis:
         for var in varlist:
-          var.axes[var.dims.index(axis.name)] = handled_axes[key]
-      else:
-        handled_axes[key] = axis
+          graph.replace_axis(var, var.dims.index(axis.name), canonical)
 
@@ -45,14 +45,18 @@ class SelectVars (BufferBase):
     """
     import numpy as np
     vars = kwargs.pop('vars',None)
+    if isinstance(vars,str):
+      vars = vars.replace(',', ' ')
+      vars = vars.split()
+    self._select_vars = vars
+    # Variables that were found when scanning the headers.
+    # (may have been dropped afterwards by other criteria).
+    self._select_found = set()
     super(SelectVars,self).__init__(*args,**kwargs)
 
     if vars is None:
       return
 
-    if isinstance(vars,str):
-      vars = vars.replace(',', ' ')
-      vars = vars.split()
     info (_('Will look for variables: ') + ' '.join(vars))
     select = np.zeros(self._nrecs,dtype='bool')
     missing = []
@@ -60,13 +64,32 @@ class SelectVars (BufferBase):
     names = np.array(names,object)
     for v in vars:
       f = (names == v)
-      if not np.any(f):
+      if not np.any(f) and v not in self._select_found:
         missing.append(v)
       select |= f
-    if len(missing) > 0:
+    # Only check for missing variables when looking at all the records.
+    if len(missing) > 0 and not self._partial:
       warn(_('Unable to find variable(s): ') + ' '.join(missing))
-    if not np.any(select):
+    if not np.any(select) and len(self._select_found) == 0 and not self._partial:
       error(_('Nothing to convert.'))
     # Marked unselected variables.
     self._headers['selected'] = self._headers['selected'] & select
 
+  # Only keep records for the requested variables.
+  def _prefilter_headers (self, headers):
+    import numpy as np
+    keep = super(SelectVars,self)._prefilter_headers(headers)
+    if self._select_vars is None:
+      return keep
+    for key in ('name','nomvar'):
+      if key in headers and key in self._prefilter_columns:
+        names = headers[key]
+        break
+    else:
+      return keep
+    names = np.array(to_string(names),object)
+    select = np.isin(names, list(self._select_vars))
+    self._select_found.update(names[select])
+    if keep is None:
+      return select
+    return keep & select
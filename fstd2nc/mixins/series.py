@@ -89,6 +89,9 @@ class Series (BufferBase):
     self._maybe_meta_records = self._maybe_meta_records + (b'HH',b'SV',b'SH')
     # Add station # as another axis.
     self._outer_axes = ('station_id',) + self._outer_axes
+    # These get modified for timeseries records, so can't be used to select
+    # records ahead of time.
+    self._prefilter_columns = tuple(c for c in self._prefilter_columns if c not in ('ip1','ig1','ig2','ig3','ig4'))
     super(Series,self).__init__(*args,**kwargs)
 
     fields = self._headers
@@ -116,13 +119,12 @@ class Series (BufferBase):
     # Overwrite the original ig1,ig2,ig3,ig4 values, which aren't actually grid
     # identifiers in this case (they're just the lat/lon coordinates of each
     # station?)
-    fields['ig1'][is_series] = 0
-    fields['ig2'][is_series] = 0
-    fields['ig3'][is_series] = 0
-    fields['ig4'][is_series] = 0
+    # Note: use new arrays, to keep the original headers from the files intact.
+    for key in ('ig1','ig2','ig3','ig4'):
+      fields[key] = np.where(is_series, 0, fields[key])
     # Do not treat the ip1 value any further - it's not really vertical level.
     # Set it to 0 to indicate a degenerate vertical axis.
-    fields['ip1'][is_series] = 0
+    fields['ip1'] = np.where(is_series, 0, fields['ip1'])
 
   def _makevars (self):
     from fstd2nc.mixins import _var_type, _axis_type, _dim_type
@@ -271,7 +273,7 @@ class Series (BufferBase):
         key = (id(time),id(forecast))
         if key not in known_squashed_forecasts:
           time0 = time.array[0]
-          # Convert pandas times (if using pandas for processing the headers)
+          # Make sure the reference time has a consistent resolution.
           time0 = np.datetime64(time0,'s')
           # Calculate the date of validity
           forecast_timedelta = np.array(forecast.array*3600,'timedelta64[s]')
@@ -72,6 +72,16 @@ class VCoords (BufferBase):
     parser.add_argument('--momentum-levels', '--mlev', action='store_true', help=_("Only convert data that's on 'momentum' vertical levels."))
     parser.add_argument('--vertical-velocity-levels', '--wlev', action='store_true', help=_("Only convert data that's on 'vertical velocity' levels."))
 
+  # The vertical coordinate records are needed for processing any new
+  # records that get added.
+  def _refresh_context (self):
+    import numpy as np
+    context = super(VCoords,self)._refresh_context()
+    is_vcoord = np.isin(self._headers['nomvar'], (b'HY  ',b'!!  '))
+    if context is None:
+      return is_vcoord
+    return context | is_vcoord
+
   def __init__ (self, *args, **kwargs):
     """
     strict_vcoord_match : bool, optional
@@ -684,15 +694,19 @@ class VCoords (BufferBase):
         if np.all(decoded['kind'] == self._headers['kind'][valid_records]): continue
         if np.any(var.record_id<0):
           warn (_("Having trouble treating %s diagnostic level as model level - splitting into a separate field.")%var.name)
-          self._headers['kind'][valid_records] = decoded['kind']
-          self._headers['level'][valid_records] = decoded['level']
           rerun = True
         # For single height level (no vertical structure), reset the level
         # type.
-        if var.record_id.size == 1:
-          self._headers['kind'][valid_records] = decoded['kind']
-          self._headers['level'][valid_records] = decoded['level']
+        elif var.record_id.size == 1:
           rerun = True
+        else:
+          continue
+        kind = np.array(self._headers['kind'])
+        level = np.array(self._headers['level'])
+        kind[valid_records] = decoded['kind']
+        level[valid_records] = decoded['level']
+        self._headers['kind'] = kind
+        self._headers['level'] = level
 
     if rerun:
       raise ValueError
@@ -451,22 +451,123 @@ class XYCoords (BufferBase):
   # Need this for manual lookup of 'X' grids, since ezqkdef doesn't support
   # them?
   def _find_coord (self, var, coordname):
+    return self._find_coord_atts (var.atts, coordname, var.name)
+  # Same as above, but using the grid attributes directly.
+  def _find_coord_atts (self, atts, coordname, name):
     from fstd2nc.mixins.fstd import dtype_fst2numpy
     # Special case for series data - match any of the lat/lon grids.
-    if var.atts['grtyp'] in ('+','Y'):
+    if atts['grtyp'] in ('+','Y'):
       header = self._fstlir (nomvar=coordname)
       # Make sure this actually matches a grid of the correct shape.
-      if header['ni'] != var.atts['ni'] or header['nj'] != var.atts['nj']:
+      if header['ni'] != atts['ni'] or header['nj'] != atts['nj']:
         header = None
     else:
-      header = self._fstlir (nomvar=coordname, ip1=var.atts['ig1'],
-                             ip2=var.atts['ig2'], ip3=var.atts['ig3'])
+      header = self._fstlir (nomvar=coordname, ip1=atts['ig1'],
+                             ip2=atts['ig2'], ip3=atts['ig3'])
     if header is not None:
       # Override output dtype
       dtype = dtype_fst2numpy(int(header['datyp']),int(header['nbits']))
       header['d'] = header['d'][:,:,None].view(dtype)
       return header
-    raise KeyError("Unable to find matching '%s' for '%s'"%(coordname,var.name))
+    raise KeyError("Unable to find matching '%s' for '%s'"%(coordname,name))
+
+  # Helper method - for '#' grids, get the attributes of the full parent grid.
+  # Other grids are returned as-is.
+  def _parent_grid_atts (self, atts):
+    import numpy as np
+    atts = atts.copy()
+    if atts['grtyp'] != '#': return atts
+    match = (self._headers['ip1'] == atts['ig1']) & (self._headers['ip2'] == atts['ig2'])
+    match_nj = np.where(match & (self._headers['nomvar'] == b'^^  '))[0]
+    match_ni = np.where(match & (self._headers['nomvar'] == b'>>  '))[0]
+    if len(match_nj) >= 1 and len(match_ni) >= 1:
+      atts['nj'] = int(self._headers['nj'][match_nj[0]])
+      atts['ni'] = int(self._headers['ni'][match_ni[0]])
+      atts['ig3'] = 1
+      atts['ig4'] = 1
+    return atts
+
+  # Helper method - define a 'Z' or '#' grid from its '>>' and '^^' records.
+  # Avoid readGrid, because it requires its own access to the files(s), which
+  # may not be readily available on disk.
+  def _gdef_fmem (self, atts, name):
+    from rpnpy.librmn.all import ezgdef_fmem
+    ref = self._find_coord_atts(atts,b'>>  ',name)
+    grd = atts.copy()
+    grd['grref'] = ref['grtyp']
+    grd['ig1'] = int(ref['ig1'])
+    grd['ig2'] = int(ref['ig2'])
+    grd['ig3'] = int(ref['ig3'])
+    grd['ig4'] = int(ref['ig4'])
+    grd['ax'] = ref['d'].squeeze()
+    grd['ay'] = self._find_coord_atts(atts,b'^^  ',name)['d'].squeeze()
+    return ezgdef_fmem(grd)
+
+  # Helper method - define a 'U' supergrid from its '^>' record.
+  # (U grids aren't yet supported by in-memory ezqkdef).
+  def _gdef_supergrid (self, atts, name):
+    from rpnpy.librmn.all import cxgaig, ezgdef_fmem, ezgdef_supergrid
+    ref = self._find_coord_atts(atts,b'^>  ',name)
+    data = ref['d'].flatten()
+    nsubgrids = int(data[2])
+    subgrids = []
+    subdata = data[5:]
+    for i in range(nsubgrids):
+      sub_ni = int(subdata[0])
+      sub_nj = int(subdata[1])
+      # Loosely based on steps in Lire_enrUvercode1 of librmn.
+      sub_ig1, sub_ig2, sub_ig3, sub_ig4 = cxgaig('E',*subdata[6:10])
+      sub_ax = subdata[10:10+sub_ni]
+      sub_ay = subdata[10+sub_ni:10+sub_ni+sub_nj]
+      subgrids.append(ezgdef_fmem(sub_ni, sub_nj, 'Z', 'E', sub_ig1, sub_ig2, sub_ig3, sub_ig4, sub_ax, sub_ay))
+      subdata = subdata[10+sub_ni+sub_nj:]
+    return ezgdef_supergrid(int(atts['ni']), int(atts['nj']), 'U', 'F', 1, subgrids)
+
+  # Get the librmn grid id for each record, without running the whole
+  # _makevars chain.
+  # Each distinct grid is only defined once, and the grid ids are then
+  # mapped back to the records.
+  # Only grids that go through ezqkdef / ezgdef_fmem are resolved, other
+  # records get a grid id of -1.
+  # The grid types to resolve can be restricted with the grtyps argument.
+  def _grid_ids (self, grtyps=None):
+    from fstd2nc.mixins import _group_records
+    from rpnpy.librmn.all import ezqkdef, EzscintError, RMNError
+    import numpy as np
+    gids = np.empty(self._nrecs,dtype=int)
+    gids[:] = -1
+    headers = self._headers
+    direct = [g.encode() for g in self._direct_grids]
+    grtyp = np.char.strip(headers['grtyp'])
+    valid = (headers['selected'] == True) & (headers['ismeta'] == False) & ~np.isin(grtyp, direct)
+    if grtyps is not None:
+      valid &= np.isin(grtyp, [g.encode() for g in grtyps])
+    rec_ids = np.where(valid)[0]
+    if len(rec_ids) == 0: return gids
+    keys = ('grtyp','ni','nj','ig1','ig2','ig3','ig4')
+    columns = [headers[k][rec_ids] for k in keys]
+    # For '#' grid records, ignore ni,nj,ig3,ig4
+    # (they are different for each tile).
+    tiled = (grtyp[rec_ids] == b'#')
+    if np.any(tiled):
+      for i in (1,2,5,6):
+        columns[i] = np.where(tiled,0,columns[i])
+    for group in _group_records(columns):
+      rec = rec_ids[group[0]]
+      atts = dict((k,int(headers[k][rec])) for k in keys[1:])
+      atts['grtyp'] = str(headers['grtyp'][rec].decode()).strip()
+      name = str(headers['nomvar'][rec].decode()).strip()
+      try:
+        if atts['grtyp'] in ('Z','#'):
+          gid = self._gdef_fmem(self._parent_grid_atts(atts), name)
+        elif atts['grtyp'] == 'U':
+          gid = self._gdef_supergrid(atts, name)
+        else:
+          gid = ezqkdef (atts['ni'], atts['nj'], atts['grtyp'], atts['ig1'], atts['ig2'], atts['ig3'], atts['ig4'])
+      except (TypeError,EzscintError,KeyError,RMNError,ValueError):
+        continue
+      gids[rec_ids[group]] = gid
+    return gids
 
 
   # Add horizontal coordinate info to the data.
@@ -474,7 +575,7 @@ class XYCoords (BufferBase):
     from fstd2nc.mixins import _iter_type, _chunk_type, _var_type, _axis_type, _dim_type
     from collections import OrderedDict
     from rpnpy.librmn.interp import ezqkdef, EzscintError, ezget_nsubgrids
-    from rpnpy.librmn.all import cxgaig, ezgdef_fmem, ezgdef_supergrid, ezqkdef, decodeGrid, RMNError
+    from rpnpy.librmn.all import ezqkdef, decodeGrid, RMNError
     import numpy as np
 
     # Save a copy of librmn grid ids, which might be useful for other mixins.
@@ -531,32 +632,12 @@ class XYCoords (BufferBase):
 
         # Check if GridMap recognizes this grid.
         if grtyp not in self._direct_grids:
-          atts = var.atts.copy()
           # For '#' grid, extract full coordinates of parent grid.
-          if grtyp == '#':
-            match = (self._headers['ip1'] == atts['ig1']) & (self._headers['ip2'] == atts['ig2'])
-            match_nj = np.where(match & (self._headers['nomvar'] == b'^^  '))[0]
-            match_ni = np.where(match & (self._headers['nomvar'] == b'>>  '))[0]
-            if len(match_nj) >= 1 and len(match_ni) >= 1:
-              atts['nj'] = int(self._headers['nj'][match_nj[0]])
-              atts['ni'] = int(self._headers['ni'][match_ni[0]])
-              atts['ig3'] = 1
-              atts['ig4'] = 1
+          atts = self._parent_grid_atts(var.atts)
           try:
             # Get grid object from librmn.
-            # Avoid readGrid, because it requires its own access to the
-            # files(s), which may not be readily available on disk.
             if grtyp in ('Z','#'):
-              ref = self._find_coord(var,b'>>  ')
-              grd = atts.copy()
-              grd['grref'] = ref['grtyp']
-              grd['ig1'] = int(ref['ig1'])
-              grd['ig2'] = int(ref['ig2'])
-              grd['ig3'] = int(ref['ig3'])
-              grd['ig4'] = int(ref['ig4'])
-              grd['ax'] = ref['d'].squeeze()
-              grd['ay'] = self._find_coord(var,b'^^  ')['d'].squeeze()
-              grd = ezgdef_fmem(grd)
+              grd = self._gdef_fmem(atts, var.name)
             else:
               grd = ezqkdef (ni, nj, grtyp, ig1, ig2, ig3, ig4)
             gids[key] = grd
@@ -588,25 +669,8 @@ class XYCoords (BufferBase):
               lonarray = self._find_coord(var,b'>>  ')['d'].squeeze(axis=2)
             # Handle ezqkdef grids.
             else:
-              ###
-              # U grids aren't yet supported by in-memory ezqkdef
-              # (requires ext
               if grtyp == 'U':
-                ref = self._find_coord(var,b'^>  ')
-                data = ref['d'].flatten()
-                nsubgrids = int(data[2])
-                subgrids = []
-                subdata = data[5:]
-                for i in range(nsubgrids):
-                  sub_ni = int(subdata[0])
-                  sub_nj = int(subdata[1])
-                  # Loosely based on steps in Lire_enrUvercode1 of librmn.
-                  sub_ig1, sub_ig2, sub_ig3, sub_ig4 = cxgaig('E',*subdata[6:10])
-                  sub_ax = subdata[10:10+sub_ni]
-                  sub_ay = subdata[10+sub_ni:10+sub_ni+sub_nj]
-                  subgrids.append(ezgdef_fmem(sub_ni, sub_nj, 'Z', 'E', sub_ig1, sub_ig2, sub_ig3, sub_ig4, sub_ax, sub_ay))
-                  subdata = subdata[10+sub_ni+sub_nj:]
-                gdid = ezgdef_supergrid(ni, nj, 'U', 'F', 1, subgrids)
+                gdid = self._gdef_supergrid(var.atts, var.name)
               else:
                 #TODO: check if this case still gets triggered?
                 # GridMap grids (N,S,A,B,L,G,Z,E) are already handled.
@@ -0,0 +1,276 @@
+###############################################################################
+# Copyright 2017-2023 - Climate Research Division
+#                       Environment and Climate Change Canada
+#
+# This file is part of the "fstd2nc" package.
+#
+# "fstd2nc" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "fstd2nc" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with "fstd2nc".  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+######################################################################
+# Instrumentation of the conversion process.
+# Collects the time spent in each mixin (for __init__, _makevars, _decode
+# and _decode_many), along with some counters (records decoded, bytes read,
+# cache hits / misses).
+#
+# This is disabled by default.  Use enable() to turn it on, then
+# report() (or Buffer.stats()) to get the results.
+# When disabled, the mixin methods are left untouched, and the counters
+# only cost a check of the 'enabled' flag.
+#
+# Note: work done in other processes is not included (e.g. dask with a
+# process-based scheduler).
+#
+# There is also a tracer, which records spans of time (reading,
+# decoding, interpolating, writing) along with the process and thread
+# ids.  Use start_trace() to turn it on, then write_trace() to save the
+# spans in Chrome trace-event format (viewable in about://tracing or
+# https://ui.perfetto.dev).
+######################################################################
+
+# Module-level variable to indicate if statistics are being collected.
+enabled = False
+
+# Methods that are timed for each mixin.
+_methods = ('__init__','_makevars','_decode','_decode_many')
+
+from threading import Lock, local
+_lock = Lock()
+_local = local()
+del Lock, local
+
+# Collected statistics.
+_timings = {}
+_counters = {}
+
+# Original methods, replaced while the instrumentation is enabled.
+_patched = []
+
+# Module-level variable to indicate if spans are being traced.
+tracing = False
+
+# Collected trace events.
+_events = []
+
+# Increase a counter.
+def count (name, n=1):
+  if not enabled: return
+  with _lock:
+    _counters[name] = _counters.get(name,0) + n
+
+# Add timing information for a method.
+def _record (key, wall, cpu, self_wall, self_cpu):
+  with _lock:
+    t = _timings.get(key)
+    if t is None:
+      t = _timings[key] = [0, 0.0, 0.0, 0.0, 0.0]
+    t[0] += 1
+    t[1] += wall
+    t[2] += cpu
+    t[3] += self_wall
+    t[4] += self_cpu
+
+# Wrap a method to record its timing.
+# The time spent in other timed methods (e.g. through super()) is removed
+# from the "self" time, so each mixin is only charged for its own work.
+def _wrap (key, method, func):
+  from functools import wraps
+  from time import perf_counter, thread_time
+  @wraps(func)
+  def timed (*args, **kwargs):
+    stack = getattr(_local,'stack',None)
+    if stack is None:
+      stack = _local.stack = []
+    stack.append([0.0,0.0])
+    wall0 = perf_counter()
+    cpu0 = thread_time()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      wall = perf_counter() - wall0
+      cpu = thread_time() - cpu0
+      child_wall, child_cpu = stack.pop()
+      if len(stack) > 0:
+        stack[-1][0] += wall
+        stack[-1][1] += cpu
+      elif method == '_decode':
+        count('records_decoded')
+      elif method == '_decode_many':
+        records = args[1] if len(args) > 1 else kwargs.get('records',())
+        count('records_decoded', len(records))
+      _record (key, wall, cpu, wall-child_wall, cpu-child_cpu)
+  timed._fstd2nc_timed = True
+  return timed
+
+def enable (buffer_type=None):
+  """
+  Start collecting statistics for the given type of Buffer (by default,
+  fstd2nc.Buffer).
+  """
+  global enabled
+  if buffer_type is None:
+    from fstd2nc import Buffer as buffer_type
+  with _lock:
+    for cls in buffer_type.__mro__:
+      for method in _methods:
+        if method not in cls.__dict__: continue
+        original = cls.__dict__[method]
+        if isinstance(original,(classmethod,staticmethod)):
+          func = original.__func__
+        else:
+          func = original
+        # Skip built-in methods (e.g. object.__init__).
+        if not hasattr(func,'__code__'): continue
+        if getattr(func,'_fstd2nc_timed',False): continue
+        timed = _wrap(cls.__name__+'.'+method, method, func)
+        if isinstance(original,classmethod):
+          timed = classmethod(timed)
+        elif isinstance(original,staticmethod):
+          timed = staticmethod(timed)
+        setattr(cls, method, timed)
+        _patched.append((cls,method,original))
+    enabled = True
+
+def disable ():
+  """
+  Stop collecting statistics.  The results so far are kept.
+  """
+  global enabled
+  with _lock:
+    while len(_patched) > 0:
+      cls, method, original = _patched.pop()
+      setattr(cls, method, original)
+    enabled = False
+
+def reset ():
+  """
+  Clear the statistics collected so far.
+  """
+  with _lock:
+    _timings.clear()
+    _counters.clear()
+    del _events[:]
+
+def report ():
+  """
+  Get the statistics collected so far, as a dictionary.
+  Times are in seconds.  For each mixin method, 'wall' and 'cpu' include the
+  time spent in the mixins further down the chain, 'self_wall' and
+  'self_cpu' only include the time spent in that mixin.
+  """
+  with _lock:
+    timings = dict()
+    for key, (calls, wall, cpu, self_wall, self_cpu) in sorted(_timings.items(), key=lambda item: -item[1][3]):
+      timings[key] = dict(calls=calls, wall=wall, cpu=cpu, self_wall=self_wall, self_cpu=self_cpu)
+    return dict(enabled=enabled, timings=timings, counters=dict(sorted(_counters.items())))
+
+def write_report (filename):
+  """
+  Write the statistics to a JSON file.
+  """
+  import json
+  with open(filename,'w') as f:
+    json.dump(report(), f, indent=2)
+
+
+#################################################
+# Tracing.
+
+# Time span for the tracer.
+class _Span (object):
+  __slots__ = ('name','cat','args','start')
+  def __init__ (self, name, cat, args):
+    self.name = name
+    self.cat = cat
+    self.args = args
+  def __enter__ (self):
+    from time import perf_counter
+    self.start = perf_counter()
+    return self
+  def __exit__ (self, *exc_info):
+    from time import perf_counter
+    from os import getpid
+    from threading import get_ident
+    end = perf_counter()
+    event = dict(name=self.name, cat=self.cat, ph='X', ts=self.start*1E6, dur=(end-self.start)*1E6, pid=getpid(), tid=get_ident())
+    if len(self.args) > 0:
+      event['args'] = self.args
+    with _lock:
+      _events.append(event)
+
+# Placeholder span, for when tracing is turned off.
+class _NoSpan (object):
+  __slots__ = ()
+  def __enter__ (self):
+    return self
+  def __exit__ (self, *exc_info):
+    pass
+_nospan = _NoSpan()
+
+def span (name, cat='fstd2nc', **args):
+  """
+  Context manager for tracing a span of time.
+  Extra arguments are attached to the event.  Does nothing unless tracing
+  was turned on with start_trace().
+  """
+  if not tracing: return _nospan
+  return _Span(name, cat, args)
+
+# Context manager for acquiring a lock, tracing the time spent waiting
+# for it.
+class acquire (object):
+  __slots__ = ('lock',)
+  def __init__ (self, lock):
+    self.lock = lock
+  def __enter__ (self):
+    if tracing:
+      with span('wait for lock', cat='lock'):
+        self.lock.acquire()
+    else:
+      self.lock.acquire()
+    return self
+  def __exit__ (self, *exc_info):
+    self.lock.release()
+
+def start_trace ():
+  """
+  Start tracing the conversion.
+  Spans from worker threads are included (e.g. for the --turbo option, or
+  for dask with a thread-based scheduler).
+  """
+  global tracing
+  tracing = True
+
+def stop_trace ():
+  """
+  Stop tracing.  The events so far are kept.
+  """
+  global tracing
+  tracing = False
+
+def write_trace (filename):
+  """
+  Write the traced events to a file, in Chrome trace-event format.
+  """
+  import json
+  from os import getpid
+  with _lock:
+    events = list(_events)
+  # Label the processes.
+  pids = sorted(set(e['pid'] for e in events) | set([getpid()]))
+  for pid in pids:
+    name = 'fstd2nc' if pid == getpid() else 'fstd2nc worker'
+    events.append(dict(name='process_name', ph='M', pid=pid, tid=0, args=dict(name=name)))
+  with open(filename,'w') as f:
+    json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
@@ -46,7 +46,7 @@ setup (
   setup_requires = ['pip >= 8.1'],
   install_requires = ['numpy >= 1.13.0, != 1.15.3','netcdf4','fstd2nc-deps >= 0.20200304.0','progress'],
   extras_require = {
-    'manyfiles': ['pandas'],
+    'manyfiles': [],  # No longer needed, kept for compatibility.
     'array': ['xarray>=0.10.3','dask','toolz'],
     'iris': ['iris>=2.0','xarray>=0.10.3','dask','toolz'],
     'pygeode': ['pygeode>=1.2.2','xarray>=0.10.3','dask','toolz'],
@@ -0,0 +1,99 @@
+###############################################################################
+# Copyright 2017-2023 - Climate Research Division
+#                       Environment and Climate Change Canada
+#
+# This file is part of the "fstd2nc" package.
+#
+# "fstd2nc" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "fstd2nc" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with "fstd2nc".  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+import numpy as np
+import pytest
+
+# Pack a string into 6-bit characters (the inverse of extra._decode_chars).
+def _pack_chars (s, n):
+  v = 0
+  for c in s.ljust(n)[:n]:
+    v = (v<<6) | ((ord(c)-32) & 0x3f)
+  return v
+
+# Write a minimal FST file, with uncompressed 32-bit IEEE (datyp 5) records.
+# Each record is a dictionary with 'nomvar' and 'data' (2D array), and
+# optionally other header parameters.
+# All records go in a single directory page.
+def write_fst (filename, records):
+  pagewords = 8+256*18
+  offset = 208 + pagewords*4
+  entries = []
+  blocks = []
+  for rec in records:
+    data = np.asarray(rec['data'],'float32')
+    nj, ni = data.shape
+    payload = data.flatten().astype('>f4').view('>u4')
+    # Record header is 20 words, and the length is in 8-byte units.
+    nwords = 20 + len(payload)
+    nwords += nwords % 2
+    ig2 = rec.get('ig2',0)
+    etiket = rec.get('etiket','')
+    e = np.zeros(18,'>u4')
+    e[0] = (rec.get('deleted',0)<<31) | (nwords//2)
+    e[1] = offset//8 + 1
+    e[2] = (rec.get('deet',0)<<8) | 32
+    e[3] = (ni<<8) | ord(rec.get('grtyp','X'))
+    e[4] = (nj<<8) | 5
+    e[5] = (1<<12)
+    e[6] = (rec.get('npas',0)<<6)
+    e[7] = (rec.get('ig4',0)<<8) | ((ig2>>16)&255)
+    e[8] = (rec.get('ig1',0)<<8) | ((ig2>>8)&255)
+    e[9] = (rec.get('ig3',0)<<8) | (ig2&255)
+    e[10] = _pack_chars(etiket[:5],5)<<2
+    e[11] = _pack_chars(etiket[5:10],5)<<2
+    e[12] = ((_pack_chars(etiket[10:12],2)<<12) | _pack_chars(rec.get('typvar','P'),2))<<8
+    e[13] = _pack_chars(rec['nomvar'],4)<<8
+    e[14] = rec.get('ip1',0)<<4
+    e[15] = rec.get('ip2',0)<<4
+    e[16] = rec.get('ip3',0)<<4
+    e[17] = rec.get('stamp',0)
+    block = np.zeros(nwords,'>u4')
+    block[:18] = e
+    block[20:20+len(payload)] = payload
+    entries.append(e)
+    blocks.append(block)
+    offset += nwords*4
+  page = np.zeros(pagewords,'>u4')
+  page[5] = len(entries)
+  if len(entries) > 0:
+    page[8:8+18*len(entries)] = np.concatenate(entries)
+  header = np.zeros(208,'B')
+  header[12:16] = np.frombuffer(b'STDR','B')
+  with open(filename,'wb') as f:
+    f.write(header.tobytes())
+    f.write(page.tobytes())
+    for block in blocks:
+      f.write(block.tobytes())
+
+@pytest.fixture
+def fst_records ():
+  rng = np.random.default_rng(0)
+  records = []
+  for nomvar in ('TT','HU'):
+    for ip1 in (12000, 11950):
+      records.append(dict(nomvar=nomvar, ip1=ip1, etiket='TESTETIKET', data=rng.random((3,4))))
+  return records
+
+@pytest.fixture
+def fst_file (tmp_path, fst_records):
+  filename = str(tmp_path/'test.fst')
+  write_fst (filename, fst_records)
+  return filename
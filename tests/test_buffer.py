@@ -0,0 +1,361 @@
+###############################################################################
+# Copyright 2017-2023 - Climate Research Division
+#                       Environment and Climate Change Canada
+#
+# This file is part of the "fstd2nc" package.
+#
+# "fstd2nc" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "fstd2nc" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with "fstd2nc".  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+import numpy as np
+import pytest
+
+pytest.importorskip('fstd2nc')
+pytest.importorskip('rpnpy.librmn')
+
+def test_makevars (fst_file, fst_records):
+  import fstd2nc
+  b = fstd2nc.Buffer(fst_file)
+  b._makevars()
+  names = sorted(var.name for var in b._varlist)
+  assert names == ['HU','TT']
+  for i, rec in enumerate(fst_records):
+    values = b._read_record(i)
+    assert values.dtype == np.dtype('float32') and values.dtype.isnative
+    assert np.array_equal(values, np.float32(rec['data']))
+
+@pytest.mark.parametrize('turbo', [False, True])
+def test_to_netcdf (fst_file, fst_records, tmp_path, turbo):
+  netCDF4 = pytest.importorskip('netCDF4')
+  import fstd2nc
+  outfile = str(tmp_path/'out.nc')
+  fstd2nc.Buffer(fst_file).to_netcdf(outfile, turbo=turbo)
+  with netCDF4.Dataset(outfile) as f:
+    for name in ('TT','HU'):
+      expected = [rec['data'] for rec in fst_records if rec['nomvar'] == name]
+      # Levels may come out in a different order, so compare sorted by mean.
+      actual = sorted(f.variables[name][:], key=np.mean)
+      expected = sorted(expected, key=np.mean)
+      assert np.allclose(actual, expected)
+
+def test_refresh (tmp_path, fst_records):
+  from conftest import write_fst
+  import fstd2nc
+  filename = str(tmp_path/'growing.fst')
+  write_fst (filename, fst_records[:2])
+  b = fstd2nc.Buffer(filename)
+  assert b._nrecs == 2
+  assert not b.refresh()
+  write_fst (filename, fst_records)
+  assert b.refresh()
+  assert b._nrecs == 4
+  b._makevars()
+  assert sorted(var.name for var in b._varlist) == ['HU','TT']
+  for i, rec in enumerate(fst_records):
+    assert np.array_equal(b._read_record(i), np.float32(rec['data']))
+
+# Only the new records (and the records they depend on) get processed by
+# refresh(), and the result is the same as re-opening the file.
+def test_refresh_incremental (tmp_path, monkeypatch):
+  from conftest import write_fst
+  import fstd2nc
+  from fstd2nc.mixins import BufferBase
+  records = []
+  for ip2 in range(3):
+    for nomvar in ('TT','HU'):
+      records.append(dict(nomvar=nomvar, ip1=12000, ip2=ip2, data=np.full((3,4),ip2,'float32')))
+    # Masked field, with the mask following the data.
+    records.append(dict(nomvar='PR', typvar='P@', ip2=ip2, data=np.full((3,4),ip2,'float32')))
+    records.append(dict(nomvar='PR', typvar='@@', ip2=ip2, data=np.ones((3,4),'float32')))
+  filename = str(tmp_path/'growing.fst')
+  # Split the masked field from its mask.
+  write_fst (filename, records[:3])
+  b = fstd2nc.Buffer(filename, vars=['TT','PR'])
+  processed = []
+  init = BufferBase.__init__
+  def counted (self, *args, **kwargs):
+    init(self, *args, **kwargs)
+    processed.append(self._nrecs)
+  monkeypatch.setattr(BufferBase, '__init__', counted)
+  for n in (6, len(records)):
+    write_fst (filename, records[:n])
+    processed.clear()
+    assert b.refresh()
+    expected = fstd2nc.Buffer(filename, vars=['TT','PR'])
+    # The unmatched masked field is processed again, along with new records.
+    assert processed[0] < b._nrecs
+    assert sorted(b._headers.keys()) == sorted(expected._headers.keys())
+    for key in expected._headers.keys():
+      assert np.array_equal(np.ma.getmaskarray(b._headers[key]), np.ma.getmaskarray(expected._headers[key])), key
+      assert np.all(np.ma.filled(b._headers[key] == expected._headers[key], True)), key
+  assert np.count_nonzero(b._headers['mask_address'] >= 0) == 3
+  b._makevars()
+  expected._makevars()
+  assert [var.name for var in b._varlist] == [var.name for var in expected._varlist]
+
+def test_index (fst_file, fst_records, tmp_path):
+  import fstd2nc
+  index = str(tmp_path/'test.idx')
+  b = fstd2nc.Buffer(fst_file, vars=['TT'])
+  b.save_index(index)
+  # The index can be read without unpickling anything.
+  with np.load(index, allow_pickle=False) as f:
+    assert 'meta' in f
+    for key in f.files:
+      f[key]
+  b2 = fstd2nc.Buffer.load_index(index, vars=['TT'], serial=True)
+  assert b2._nrecs == b._nrecs
+  b2._makevars()
+  assert [var.name for var in b2._varlist] == ['TT']
+  assert np.array_equal(b2._read_record(0), np.float32(fst_records[0]['data']))
+  assert not b2.refresh()
+  # Options must match.
+  with pytest.raises(Exception, match='different options: vars'):
+    fstd2nc.Buffer.load_index(index, vars=['HU'])
+  with pytest.raises(Exception, match='different options: vars'):
+    fstd2nc.Buffer.load_index(index)
+
+# The Buffer is restored as it was after initializing, without going
+# through the initialization again.
+def test_index_state (tmp_path, monkeypatch):
+  from conftest import write_fst
+  import fstd2nc
+  filename = str(tmp_path/'test.fst')
+  records = []
+  for ip2 in range(2):
+    for nomvar in ('TT','HU'):
+      records.append(dict(nomvar=nomvar, ip1=12000, ip2=ip2, data=np.full((3,4),ip2,'float32')))
+    records.append(dict(nomvar='PR', typvar='P@', ip2=ip2, data=np.full((3,4),ip2,'float32')))
+    records.append(dict(nomvar='PR', typvar='@@', ip2=ip2, data=np.ones((3,4),'float32')))
+  records.append(dict(nomvar='!!', ip1=1, ip2=2, data=np.zeros((3,4),'float32')))
+  write_fst (filename, records)
+  index = str(tmp_path/'test.idx')
+  b = fstd2nc.Buffer(filename, vars=['TT','PR'])
+  b.save_index(index)
+  def no_init (self, *args, **kwargs):
+    raise AssertionError("Buffer was initialized again")
+  monkeypatch.setattr(fstd2nc.Buffer, '__init__', no_init)
+  b2 = fstd2nc.Buffer.load_index(index, vars=['TT','PR'])
+  # Same header table, including how the columns are stored.
+  assert list(b2._headers.keys()) == list(b._headers.keys())
+  for key in b._headers.keys():
+    assert type(b2._headers._columns[key]) is type(b._headers._columns[key]), key
+    assert np.array_equal(np.ma.getmaskarray(b2._headers[key]), np.ma.getmaskarray(b._headers[key])), key
+    assert np.all(np.ma.filled(b2._headers[key] == b._headers[key], True)), key
+  # Same state from the mixins.
+  assert list(b2._vrecs.keys()) == list(b._vrecs.keys())
+  assert b2._meta_records == b._meta_records
+  assert b2._decoder_data == b._decoder_data
+  assert b2._select_vars == b._select_vars
+  b._makevars()
+  b2._makevars()
+  assert [var.name for var in b2._varlist] == [var.name for var in b._varlist]
+  for i in range(b._nrecs):
+    if b._headers['selected'][i]:
+      assert np.array_equal(b2._read_record(i), b._read_record(i))
+
+def test_index_positional_args (fst_file, tmp_path):
+  import fstd2nc
+  index = str(tmp_path/'test.idx')
+  # Positional options are matched to their names.
+  fstd2nc.Buffer(fst_file, False, True, internal_metadata=True).save_index(index)
+  with pytest.raises(Exception, match='different options: internal_metadata'):
+    fstd2nc.Buffer.load_index(index)
+  b = fstd2nc.Buffer.load_index(index, serial=False, internal_metadata=True)
+  assert b._nrecs == 4
+
+def test_index_stale (fst_file, fst_records, tmp_path):
+  from conftest import write_fst
+  import fstd2nc
+  index = str(tmp_path/'test.idx')
+  fstd2nc.Buffer(fst_file).save_index(index)
+  write_fst (fst_file, fst_records[:2])
+  with pytest.raises(Exception, match='has changed'):
+    fstd2nc.Buffer.load_index(index)
+
+@pytest.mark.parametrize('turbo', [False, True])
+def test_stats_to_netcdf (fst_file, fst_records, tmp_path, turbo):
+  pytest.importorskip('netCDF4')
+  import fstd2nc
+  from fstd2nc import stats
+  stats.reset()
+  stats.enable()
+  try:
+    fstd2nc.Buffer(fst_file).to_netcdf(str(tmp_path/'out.nc'), turbo=turbo)
+    report = stats.report()
+  finally:
+    stats.disable()
+    stats.reset()
+  # The records are decoded in batches, which must show up in the report.
+  calls = [t['calls'] for key, t in report['timings'].items() if key.endswith('._decode_many')]
+  assert len(calls) > 0 and min(calls) > 0
+  assert report['counters']['records_decoded'] == len(fst_records)
+
+# A record that can't be read only loses that record, not the whole batch.
+@pytest.mark.parametrize('turbo', [False, True])
+def test_to_netcdf_bad_record (fst_file, fst_records, tmp_path, monkeypatch, turbo):
+  netCDF4 = pytest.importorskip('netCDF4')
+  import fstd2nc
+  from fstd2nc.mixins import netcdf
+  b = fstd2nc.Buffer(fst_file)
+  bad = 1
+  quick_load = netcdf._quick_load
+  def broken_load (args):
+    if args[1] == bad:
+      raise ValueError("Bad record")
+    return quick_load(args)
+  monkeypatch.setattr(netcdf, '_quick_load', broken_load)
+  outfile = str(tmp_path/'out.nc')
+  with pytest.warns(UserWarning) as record:
+    b.to_netcdf(outfile, turbo=turbo)
+  messages = [str(w.message) for w in record if 'unable to get data' in str(w.message)]
+  assert messages == ["Internal problem with the script - unable to get data for '%s'"%fst_records[bad]['nomvar']]
+  with netCDF4.Dataset(outfile) as f:
+    nvalid = 0
+    for rec in fst_records:
+      levels = f.variables[rec['nomvar']][:].reshape(-1,3,4)
+      found = [np.allclose(level, rec['data']) for level in levels if not np.ma.is_masked(level)]
+      nvalid += any(found)
+  assert nvalid == len(fst_records) - 1
+
+# The variables are only generated again when the headers change, and
+# otherwise match what _makevars() gives.
+def test_makevars_cached (fst_file, monkeypatch):
+  import fstd2nc
+  b = fstd2nc.Buffer(fst_file)
+  calls = []
+  makevars = type(b)._makevars
+  def counted (self):
+    calls.append(1)
+    return makevars(self)
+  monkeypatch.setattr(type(b), '_makevars', counted)
+  def summary ():
+    return [(var.name, var.shape) for var in b._varlist]
+  b._makevars_cached()
+  first = summary()
+  b._makevars_cached()
+  assert len(calls) == 1
+  b._makevars()
+  assert summary() == first
+  b._makevars_cached()
+  assert len(calls) == 3
+  # Assigning a column invalidates the variables.
+  selected = b._headers['selected'] & (b._headers['nomvar'] == b'TT  ')
+  b._headers['selected'] = selected
+  b._makevars_cached()
+  assert len(calls) == 4
+  assert [name for name, shape in summary()] == ['TT']
+  # In-place changes are only picked up after touch().
+  b._headers['selected'][:] = True
+  b._makevars_cached()
+  assert len(calls) == 4
+  b._headers.touch()
+  b._makevars_cached()
+  assert len(calls) == 5
+  assert summary() == first
+
+def test_trace_span (tmp_path):
+  import json, os, threading
+  from fstd2nc import stats
+  stats.reset()
+  # Nothing is recorded unless tracing is on.
+  with stats.span('ignored'):
+    pass
+  stats.start_trace()
+  try:
+    with stats.span('outer', cat='test', n=2):
+      with stats.span('inner'):
+        pass
+    lock = threading.Lock()
+    with stats.acquire(lock):
+      assert lock.locked()
+    assert not lock.locked()
+  finally:
+    stats.stop_trace()
+  with stats.span('ignored'):
+    pass
+  tracefile = str(tmp_path/'trace.json')
+  stats.write_trace(tracefile)
+  stats.reset()
+  with open(tracefile) as f:
+    trace = json.load(f)
+  events = trace['traceEvents']
+  assert [e['name'] for e in events] == ['inner', 'outer', 'wait for lock', 'process_name']
+  inner, outer, wait, meta = events
+  assert outer['ph'] == 'X' and outer['cat'] == 'test' and outer['args'] == {'n':2}
+  assert inner['cat'] == 'fstd2nc' and 'args' not in inner
+  assert wait['cat'] == 'lock'
+  for e in (inner, outer, wait):
+    assert e['pid'] == os.getpid() and e['tid'] == threading.get_ident()
+    assert e['dur'] >= 0
+  # Spans are nested.
+  assert outer['ts'] <= inner['ts']
+  assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+  assert meta == dict(name='process_name', ph='M', pid=os.getpid(), tid=0, args=dict(name='fstd2nc'))
+
+@pytest.mark.parametrize('turbo', [False, True])
+def test_trace_to_netcdf (fst_file, fst_records, tmp_path, turbo):
+  pytest.importorskip('netCDF4')
+  import json
+  import fstd2nc
+  from fstd2nc import stats
+  stats.reset()
+  stats.start_trace()
+  try:
+    fstd2nc.Buffer(fst_file).to_netcdf(str(tmp_path/'out.nc'), turbo=turbo)
+  finally:
+    stats.stop_trace()
+  tracefile = str(tmp_path/'trace.json')
+  stats.write_trace(tracefile)
+  stats.reset()
+  with open(tracefile) as f:
+    events = json.load(f)['traceEvents']
+  spans = [e for e in events if e['ph'] == 'X']
+  reads = [e for e in spans if e['name'] == 'read block']
+  assert sorted(e['args']['record'] for e in reads) == list(range(len(fst_records)))
+  assert all(e['cat'] == 'io' for e in reads)
+  decoded = sum(e['args']['nrec'] for e in spans if e['name'] == 'decode')
+  assert decoded == len(fst_records)
+  assert sorted(e['args']['var'] for e in spans if e['name'] == 'write') == ['HU','TT']
+  assert [e['name'] for e in events if e['ph'] == 'M'] == ['process_name']
+
+# The trace shouldn't change the output of the conversion.
+def test_trace_file_cmdline (fst_file, fst_records, tmp_path, monkeypatch):
+  netCDF4 = pytest.importorskip('netCDF4')
+  import json, sys
+  import fstd2nc
+  from fstd2nc import stats
+  from fstd2nc.__main__ import _fstd2nc_cmdline
+  # Restore the global state that's changed by the command-line version.
+  monkeypatch.setattr(fstd2nc.stdout, '_python', fstd2nc.stdout._python)
+  monkeypatch.setattr(fstd2nc.stdout, 'streams', fstd2nc.stdout.streams)
+  monkeypatch.setattr(stats, 'tracing', False)
+  stats.reset()
+  outfiles = []
+  for extra in ([], ['--trace-file', str(tmp_path/'trace.json')]):
+    outfile = str(tmp_path/('out%d.nc'%len(outfiles)))
+    monkeypatch.setattr(sys, 'argv', ['fstd2nc', fst_file, outfile, '--no-history', '--quiet']+extra)
+    _fstd2nc_cmdline()
+    outfiles.append(outfile)
+    # Tracing is only turned on with --trace-file.
+    assert stats.tracing == (len(extra) > 0)
+  stats.reset()
+  with open(str(tmp_path/'trace.json')) as f:
+    events = json.load(f)['traceEvents']
+  names = set(e['name'] for e in events)
+  assert set(['read block','decode','write','process_name']) <= names
+  with netCDF4.Dataset(outfiles[0]) as f0, netCDF4.Dataset(outfiles[1]) as f1:
+    assert list(f0.variables) == list(f1.variables)
+    for name in f0.variables:
+      assert np.array_equal(f0.variables[name][:], f1.variables[name][:])
@@ -0,0 +1,176 @@
+###############################################################################
+# Copyright 2017-2023 - Climate Research Division
+#                       Environment and Climate Change Canada
+#
+# This file is part of the "fstd2nc" package.
+#
+# "fstd2nc" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "fstd2nc" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with "fstd2nc".  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+import numpy as np
+import pytest
+
+# Note: rpnpy may only be reachable through the bundled fstd2nc_deps paths,
+# which are set up when fstd2nc is imported.
+pytest.importorskip('fstd2nc')
+pytest.importorskip('rpnpy.librmn')
+
+# Original reader for the raw headers, which seeks to each directory page.
+def _seek_raw_headers (filename):
+  raw = []
+  with open(filename,'rb') as f:
+    pageaddr = 27
+    while pageaddr > 0:
+      f.seek(pageaddr*8-8, 0)
+      page = np.fromfile(f, '>i4', 8+256*18)
+      nent = page[5]
+      raw.append(page[8:].reshape(256,9,2)[:nent].view('B').flatten())
+      pageaddr = page[4]
+  return np.concatenate(raw).reshape(-1,72)
+
+def test_raw_headers (fst_file):
+  from fstd2nc.extra import raw_headers
+  assert np.array_equal(raw_headers(fst_file), _seek_raw_headers(fst_file))
+
+def test_raw_headers_since (fst_file):
+  from fstd2nc.extra import raw_headers_since
+  raw, position = raw_headers_since(fst_file, 0)
+  assert np.array_equal(raw, _seek_raw_headers(fst_file))
+
+def test_decode_headers (fst_file, fst_records):
+  from fstd2nc.extra import raw_headers, decode_headers
+  headers = decode_headers(raw_headers(fst_file))
+  assert list(headers['nomvar']) == [r['nomvar'].ljust(4).encode() for r in fst_records]
+  assert list(headers['ip1']) == [r['ip1'] for r in fst_records]
+  assert list(headers['ni']) == [4]*len(fst_records)
+  assert list(headers['nj']) == [3]*len(fst_records)
+  assert list(headers['datyp']) == [5]*len(fst_records)
+  assert list(headers['etiket']) == [b'TESTETIKET  ']*len(fst_records)
+
+# Add the record header (20 words) to some encoded data.
+def _add_header (words, ni, nj, nbits, datyp):
+  header = np.zeros(20,'>u4')
+  header[2] = nbits
+  header[3] = ni<<8
+  header[4] = (nj<<8) | datyp
+  header[5] = 1<<12
+  words = np.asarray(words,'uint32').astype('>u4')
+  return np.concatenate([header, words]).astype('>u4').view('>i4')
+
+# Build an encoded record for packed integers.
+# Signed integers (datyp 4) are stored with an offset of 2**(nbits-1).
+def _integer_record (values, nbits, datyp):
+  nj, ni = values.shape
+  offset = 2**(nbits-1) if datyp == 4 else 0
+  bits = ''.join(format(int(v)+offset, '0%db'%nbits) for v in values.flatten())
+  bits += '0' * (-len(bits) % 64)
+  words = [int(bits[i:i+32],2) for i in range(0,len(bits),32)]
+  return _add_header (words, ni, nj, nbits, datyp)
+
+# Build encoded records for packed floats, using the librmn packers.
+def _float_record (values, nbits, datyp):
+  import ctypes as ct
+  import numpy.ctypeslib as npc
+  from fstd2nc.extra import librmn
+  nj, ni = values.shape
+  n = ni*nj
+  values = np.ascontiguousarray(values, 'float32').reshape(-1)
+  words = np.zeros(4+n+4,'int32')
+  if datyp == 1:
+    librmn.compact_float(values.view('int32'), words, words[3:], n, nbits, 24, 1, 1, 0, ct.byref(ct.c_double(0)))
+  else:
+    librmn.c_float_packer.argtypes = (npc.ndpointer(dtype='float32'), ct.c_int, npc.ndpointer(dtype='int32'), npc.ndpointer(dtype='int32'), ct.c_int)
+    librmn.c_float_packer(values, nbits, words, words[3:], n)
+  return _add_header (words.view('uint32'), ni, nj, nbits, datyp)
+
+# Decode with librmn only.
+def _librmn_decode (data):
+  from fstd2nc import extra
+  data = data.view('>i4')
+  datyp, nbits, ni, nj, nk = extra._encoding(data)
+  check = extra._numpy_check
+  extra._numpy_check = extra._NumpyCheck()
+  extra._numpy_check._ok[(datyp,nbits)] = False
+  try:
+    return extra.decode(data)
+  finally:
+    extra._numpy_check = check
+
+@pytest.mark.parametrize('datyp,nbits', [(2,12),(2,32),(4,1),(4,7),(4,16),(4,32)])
+def test_decode_integers_threaded (datyp, nbits):
+  from multiprocessing.pool import ThreadPool
+  from fstd2nc import extra
+  rng = np.random.default_rng(datyp*100+nbits)
+  if datyp == 4:
+    lo, hi = -2**(nbits-1), 2**(nbits-1)
+  else:
+    lo, hi = 0, 2**nbits
+  fields = [rng.integers(lo, hi, size=(5,7)) for i in range(32)]
+  records = [_integer_record(f, nbits, datyp) for f in fields]
+  extra._numpy_check.reset()
+  with ThreadPool(4) as p:
+    decoded = p.map(lambda r: extra.decode(r, out=np.empty((5,7),'int64')), records)
+  assert extra._numpy_check.status((datyp,nbits)) is True
+  for f, d in zip(fields, decoded):
+    assert np.array_equal(f, d)
+
+# The packed floats should be bit-for-bit the same as from librmn.
+@pytest.mark.parametrize('datyp,nbits', [(1,1),(1,8),(1,12),(1,16),(1,24),(1,31),(1,32),(6,8),(6,12),(6,16)])
+def test_decode_floats (datyp, nbits):
+  from fstd2nc import extra
+  rng = np.random.default_rng(datyp*100+nbits)
+  fields = [rng.normal(rng.normal()*100, 10**rng.uniform(-5,5), size=(9,11)) for i in range(50)]
+  fields += [np.round(rng.uniform(0,1000,(9,11))), np.full((9,11),3.25), np.zeros((9,11))]
+  records = [_float_record(f, nbits, datyp) for f in fields]
+  for r in records:
+    extra._numpy_check.reset()
+    decoded = extra.decode(r)
+    assert extra._numpy_check.status((datyp,nbits)) is True
+    expected = _librmn_decode(r)
+    assert decoded.dtype == expected.dtype
+    assert np.array_equal(decoded.view('int32'), expected.view('int32'))
+
+# Records that the numpy version can't handle go to librmn.
+def test_decode_floats_denormal ():
+  from fstd2nc import extra
+  values = np.float32([[1e-40, 2e-40, -3e-40]])
+  r = _float_record(values, 16, 1)
+  extra._numpy_check.reset()
+  decoded = extra.decode(r)
+  assert extra._numpy_check.status((1,16)) is None
+  assert np.array_equal(decoded.view('int32'), _librmn_decode(r).view('int32'))
+
+# Read the encoded data for each record of a file.
+def _read_records (filename):
+  from fstd2nc.extra import raw_headers, decode_headers
+  headers = decode_headers(raw_headers(filename))
+  with open(filename,'rb') as f:
+    for swa, lng in zip(headers['swa'], headers['lng']):
+      f.seek(int(swa)*8-8)
+      yield np.fromfile(f,'B',int(lng)*4)
+
+def test_decode_ieee (fst_file, fst_records):
+  from fstd2nc.extra import decode
+  for data, rec in zip(_read_records(fst_file), fst_records):
+    values = decode(data)
+    assert values.dtype == np.dtype('float32')
+    assert values.dtype.isnative
+    assert np.array_equal(values, np.float32(rec['data']))
+    view = decode(data, view=True)
+    assert view.dtype == np.dtype('>f4')
+    assert np.shares_memory(view, data)
+    assert np.array_equal(view, values)
+    out = np.empty((3,4),'float64')
+    assert decode(data, out=out) is out
+    assert np.array_equal(out, values)
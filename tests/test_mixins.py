@@ -0,0 +1,413 @@
+###############################################################################
+# Copyright 2017-2023 - Climate Research Division
+#                       Environment and Climate Change Canada
+#
+# This file is part of the "fstd2nc" package.
+#
+# "fstd2nc" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "fstd2nc" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with "fstd2nc".  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+import numpy as np
+import pytest
+
+pytest.importorskip('fstd2nc')
+pytest.importorskip('rpnpy.librmn')
+
+def test_column_builder_packed (fst_file):
+  from fstd2nc.extra import raw_headers, decode_headers
+  from fstd2nc.mixins import _ColumnBuilder
+  expected = decode_headers(raw_headers(fst_file))
+  builder = _ColumnBuilder()
+  for index in ([0,1], [2,3]):
+    headers = decode_headers(raw_headers(fst_file)).select(index)
+    headers['file_id'] = np.zeros(len(index),'int32')
+    builder.append(headers)
+    # Nothing should get decoded while collecting the records.
+    assert list(headers._columns.keys()) == ['file_id']
+  headers = builder.finish()
+  assert list(headers['file_id']) == [0,0,0,0]
+  for key in expected.keys():
+    assert np.array_equal(headers[key], expected[key])
+
+def test_column_builder_arrays ():
+  from fstd2nc.mixins import _ColumnBuilder
+  builder = _ColumnBuilder()
+  for i in range(10):
+    builder.append({'a':np.arange(3)+3*i, 'b':i})
+  columns = builder.finish()
+  assert np.array_equal(columns['a'], np.arange(30))
+  assert np.array_equal(columns['b'], np.repeat(np.arange(10),3))
+
+def test_header_table_compact ():
+  from fstd2nc.mixins import _HeaderTable
+  n = 100
+  table = _HeaderTable()
+  table['nomvar'] = np.array([b'TT  ',b'HU  ']*(n//2))
+  table['ip1'] = np.arange(n,dtype='int32')
+  table['address'] = np.arange(n,dtype='int64')*1000
+  table['dateo'] = np.zeros(n,'int32')
+  table.compact(keep=('address',))
+  # Columns to keep are not touched.
+  assert type(table._columns['address']) is np.ndarray
+  table['address'][0] = 1
+  # Compacted columns are read-only, but can be replaced.
+  assert list(table['nomvar'][:2]) == [b'TT  ',b'HU  ']
+  assert table['ip1'].dtype == 'int32'
+  assert table['dateo'].dtype == 'int32'
+  with pytest.raises(ValueError):
+    table['ip1'][0] = 5
+  version = table.version
+  ip1 = table['ip1'].copy()
+  ip1[0] = 5
+  table['ip1'] = ip1
+  assert table['ip1'][0] == 5
+  assert table.version > version
+
+def test_header_table_lazy (fst_file):
+  from fstd2nc.extra import raw_headers, decode_headers
+  from fstd2nc.mixins import _HeaderTable, _LazyColumn
+  expected = dict(decode_headers(raw_headers(fst_file)))
+  headers = decode_headers(raw_headers(fst_file))
+  table = _HeaderTable(headers)
+  # Nothing is decoded until the columns are accessed.
+  assert len(headers._columns) == 0
+  assert all(isinstance(column,_LazyColumn) for column in table._columns.values())
+  assert np.array_equal(table['nomvar'], expected['nomvar'])
+  assert type(table._columns['nomvar']) is np.ndarray
+  assert isinstance(table._columns['ip1'], _LazyColumn)
+  assert table.value('ip1',2) == expected['ip1'][2]
+  # Columns decoded after compacting are compacted too.
+  table.compact()
+  assert isinstance(table._columns['dateo'], _LazyColumn)
+  assert np.array_equal(table['dateo'], expected['dateo'])
+  assert not isinstance(table._columns['dateo'], (_LazyColumn,np.ndarray))
+  for key in expected.keys():
+    assert np.array_equal(table[key], expected[key])
+  assert len(headers._columns) == 0
+
+def test_hot_columns (fst_file):
+  import fstd2nc
+  b = fstd2nc.Buffer(fst_file)
+  for key in b._hot_columns():
+    if key in b._headers:
+      assert type(b._headers._columns[key]) is np.ndarray
+
+def test_walk_directory (tmp_path):
+  import os
+  from fstd2nc.mixins import _walk_directory
+  for d in ('a','a/b','c'):
+    os.makedirs(str(tmp_path/d))
+  for f in ('x','a/y','a/b/z','c/w'):
+    (tmp_path/f).write_bytes(b'')
+  expected = [str(tmp_path/f) for f in ('x','a/y','a/b/z','c/w')]
+  assert list(_walk_directory(str(tmp_path), 4)) == expected
+  assert list(_walk_directory(str(tmp_path), 1)) == expected
+
+def test_serial_walk (tmp_path, fst_records, monkeypatch):
+  from conftest import write_fst
+  import multiprocessing.pool
+  import fstd2nc
+  write_fst (str(tmp_path/'a.fst'), fst_records[:2])
+  write_fst (str(tmp_path/'b.fst'), fst_records[2:])
+  def no_threads (*args, **kwargs):
+    raise AssertionError("Thread pool used in serial mode")
+  monkeypatch.setattr(multiprocessing.pool, 'ThreadPool', no_threads)
+  b = fstd2nc.Buffer(str(tmp_path), serial=True)
+  assert b._nrecs == 4
+
+# Ragged array outputs can't be stacked into a regular array.
+def test_vectorize_ragged ():
+  import numpy as np
+  from fstd2nc.mixins import vectorize
+  @vectorize
+  def f (x):
+    return np.arange(x)
+  result = f(np.array([2,3,2]))
+  assert result.dtype == object and result.shape == (3,)
+  assert [list(r) for r in result] == [[0,1],[0,1,2],[0,1]]
+
+# Compare with the per-variable check that was used before (np.ma.compressed
+# and len(set(v)) for each group of records).
+@pytest.mark.parametrize('dtype', ['int32', 'S4'])
+def test_consistent_values (dtype):
+  from fstd2nc.mixins import _consistent_values
+  rng = np.random.default_rng(42)
+  ngroups = 30
+  group_ids = np.sort(rng.integers(0, ngroups-1, 300))
+  # Every third group has a constant value, the rest are random.
+  values = np.where(group_ids%3 == 0, group_ids, rng.integers(0, 3, 300))
+  values = values.astype(dtype)
+  column = np.ma.array(values, mask=rng.random(300) < 0.2)
+  # Fully masked group.
+  column[group_ids == 1] = np.ma.masked
+  ok, first = _consistent_values(column, group_ids, ngroups)
+  for g in range(ngroups):
+    v = np.ma.compressed(column[group_ids == g])
+    expected = len(v) > 0 and len(set(v)) == 1
+    assert ok[g] == expected, g
+    if expected:
+      assert np.ma.getdata(column)[first[g]] == v[0]
+
+def test_consistent_attributes (tmp_path):
+  from conftest import write_fst
+  import fstd2nc
+  filename = str(tmp_path/'test.fst')
+  write_fst (filename, [
+    dict(nomvar='TT', ip1=12000, deet=300, data=np.zeros((3,4))),
+    dict(nomvar='TT', ip1=11950, deet=600, data=np.zeros((3,4))),
+    dict(nomvar='HU', ip1=12000, deet=300, data=np.zeros((3,4))),
+    dict(nomvar='HU', ip1=11950, deet=300, data=np.zeros((3,4))),
+  ])
+  b = fstd2nc.Buffer(filename, internal_metadata=True)
+  b._makevars()
+  atts = dict((var.name,var.atts) for var in b._varlist)
+  assert atts['HU']['deet'] == 300
+  assert 'deet' not in atts['TT']
+  assert atts['TT']['nomvar'] == 'TT'
+
+# The grid ids from _grid_ids() should match the ones _makevars() finds,
+# without having to run _makevars() first.
+def test_grid_ids (tmp_path, monkeypatch):
+  from conftest import write_fst
+  import fstd2nc
+  import rpnpy.librmn.all as rmn
+  filename = str(tmp_path/'test.fst')
+  ig = rmn.cxgaig('L', -10., 20., 1., 1.)
+  zig = rmn.cxgaig('E', 0., 180., 0., 270.)
+  records = []
+  for ip1 in (12000, 11950):
+    records.append(dict(nomvar='TT', ip1=ip1, grtyp='L', ig1=ig[0], ig2=ig[1], ig3=ig[2], ig4=ig[3], data=np.zeros((3,4))))
+    records.append(dict(nomvar='UU', ip1=ip1, grtyp='Z', ig1=100, ig2=200, ig3=0, data=np.zeros((5,6))))
+  for nomvar, data in (('>>',np.arange(6.)[None,:]+10), ('^^',np.arange(5.)[:,None]+1)):
+    records.append(dict(nomvar=nomvar, ip1=100, ip2=200, grtyp='E', ig1=zig[0], ig2=zig[1], ig3=zig[2], ig4=zig[3], data=data))
+  write_fst (filename, records)
+  b = fstd2nc.Buffer(filename)
+  def no_makevars (*args, **kwargs):
+    raise AssertionError("_makevars called")
+  with monkeypatch.context() as m:
+    m.setattr(type(b), '_makevars', no_makevars)
+    gids = b._grid_ids()
+    zgids = b._grid_ids(('Z',))
+  b._makevars()
+  assert np.array_equal(gids, b._gids)
+  # Only the TT and UU records have a grid.
+  assert list(gids[4:]) == [-1, -1]
+  assert gids[0] == gids[2] and gids[1] == gids[3] and gids[0] != gids[1]
+  # Filtering on grid type leaves the other records unresolved.
+  assert np.array_equal(zgids, np.where(np.arange(6)%2==1, gids, -1))
+
+# Recursive walk through the variables, as done before the object graph.
+def _walk_objects (obj, handled):
+  from fstd2nc.mixins import _iter_type, _chunk_type, _var_type, _axis_type, _dim_type
+  if id(obj) in handled:
+    return
+  if isinstance(obj,(_iter_type,_chunk_type,_var_type,_axis_type,_dim_type)):
+    yield obj
+    handled.add(id(obj))
+  if isinstance(obj,list):
+    for var in obj:
+      for o in _walk_objects(var,handled):
+        yield o
+    return
+  if isinstance(obj,dict):
+    for key,value in obj.items():
+      for o in _walk_objects(key,handled):
+        yield o
+      for o in _walk_objects(value,handled):
+        yield o
+    return
+  for n in ('axes','atts','deps'):
+    if hasattr(obj,n):
+      for o in _walk_objects(getattr(obj,n),handled):
+        yield o
+
+# Axes and their users should be in order of first appearance.
+def _check_axis_users (graph, objects):
+  users = dict()
+  for var in objects:
+    for axis in getattr(var,'axes',()):
+      users.setdefault(id(axis),(axis,[]))[1].append(var)
+  assert list(graph.axis_users().keys()) == list(users.keys())
+  for key, (axis, varlist) in users.items():
+    assert graph.axis_users()[key][0] is axis
+    assert [id(v) for v in graph.axis_users()[key][1]] == [id(v) for v in varlist]
+
+def test_object_graph (tmp_path):
+  from conftest import write_fst
+  import fstd2nc
+  from fstd2nc.mixins import _ObjectGraph
+  import rpnpy.librmn.all as rmn
+  filename = str(tmp_path/'test.fst')
+  ig = rmn.cxgaig('L', -10., 20., 1., 1.)
+  records = []
+  for nomvar in ('TT','HU'):
+    for ip2 in (0, 6):
+      for ip1 in (12000, 11950):
+        records.append(dict(nomvar=nomvar, ip1=ip1, ip2=ip2, grtyp='L', ig1=ig[0], ig2=ig[1], ig3=ig[2], ig4=ig[3], data=np.zeros((3,4))))
+  records.append(dict(nomvar='P0', ip2=0, grtyp='L', ig1=ig[0], ig2=ig[1], ig3=ig[2], ig4=ig[3], data=np.zeros((3,4))))
+  write_fst (filename, records)
+  b = fstd2nc.Buffer(filename)
+  b._makevars()
+  graph = _ObjectGraph(b._varlist)
+  expected = list(_walk_objects(b._varlist,set()))
+  assert len(expected) > len(b._varlist)
+  assert [id(o) for o in graph.objects] == [id(o) for o in expected]
+  assert [id(o) for o in b._iter_objects()] == [id(o) for o in expected]
+  _check_axis_users (graph, expected)
+  # Swap out an axis in one of the variables.
+  var = [v for v in b._varlist if v.name == 'TT'][0]
+  i = var.dims.index('level')
+  old = var.axes[i]
+  new = type(old)(old.name, dict(old.atts), old.array.copy())
+  graph.replace_axis(var, i, new)
+  assert var.axes[i] is new
+  expected = list(_walk_objects(b._varlist,set()))
+  assert [id(o) for o in graph.objects] == [id(o) for o in expected]
+  assert any(o is new for o in graph.objects)
+  _check_axis_users (graph, expected)
+  assert [id(v) for v in graph.axis_users()[id(new)][1]] == [id(var), id(new)]
+  assert all(v is not var for v in graph.axis_users()[id(old)][1])
+
+def test_registry ():
+  from fstd2nc.mixins import _Registry, _axis_type, _var_type, _dim_type
+  registry = _Registry()
+  level = _axis_type('level', {}, np.array([1000.,850.,500.]))
+  assert registry.intern(level) is level
+  # Same name and values.
+  assert registry.intern(_axis_type('level', {'units':'hPa'}, np.array([1000.,850.,500.]))) is level
+  # Different values, name or dtype.
+  for other in (_axis_type('level', {}, np.array([1000.,850.])),
+                _axis_type('level', {}, np.array([1000.,850.,250.])),
+                _axis_type('pres', {}, np.array([1000.,850.,500.])),
+                _axis_type('level', {}, np.array([1000.,850.,500.],dtype='float32'))):
+    assert registry.intern(other) is other
+  # Object arrays.
+  names = _axis_type('station', {}, np.array(['a','bc'],dtype=object))
+  assert registry.intern(names) is names
+  assert registry.intern(_axis_type('station', {}, np.array(['a','bc'],dtype=object))) is names
+  # Coordinates also have to be on the same axes.
+  x = _axis_type('x', {}, np.arange(3.))
+  y = _axis_type('y', {}, np.arange(3.))
+  lat = _var_type('lat', {}, [x], np.ones(3))
+  assert registry.intern(lat) is lat
+  assert registry.intern(_var_type('lat', {}, [x], np.ones(3))) is lat
+  other = _var_type('lat', {}, [y], np.ones(3))
+  assert registry.intern(other) is other
+  # Dimensions without values.
+  dim = _dim_type('i', 5)
+  assert registry.intern(dim) is dim
+  assert registry.intern(_dim_type('i', 5)) is dim
+  assert registry.intern(_dim_type('i', 6)) is not dim
+
+# A registered object that was modified afterwards should no longer be
+# matched.
+def test_registry_modified ():
+  from fstd2nc.mixins import _Registry, _axis_type
+  registry = _Registry()
+  level = _axis_type('level', {}, np.array([1000.,850.,500.]))
+  registry.intern(level)
+  level.array[:] = [1.,2.,3.]
+  other = _axis_type('level', {}, np.array([1000.,850.,500.]))
+  assert registry.intern(other) is other
+  assert registry.intern(_axis_type('level', {}, np.array([1000.,850.,500.]))) is other
+
+# If two different objects end up with the same key, the contents are
+# compared before using the registered one.
+def test_registry_collision (monkeypatch):
+  from fstd2nc.mixins import _Registry, _axis_type
+  monkeypatch.setattr(_Registry, '_key', staticmethod(lambda obj: 'key'))
+  registry = _Registry()
+  a = _axis_type('level', {}, np.array([1.,2.,3.]))
+  b = _axis_type('level', {}, np.array([4.,5.,6.]))
+  assert registry.intern(a) is a
+  assert registry.intern(b) is b
+  assert registry.intern(_axis_type('level', {}, np.array([4.,5.,6.]))) is b
+
+# Compare the axes after _makevars with the check that was used before
+# (name and values as tuples).
+def test_registry_axes (tmp_path):
+  from conftest import write_fst
+  import fstd2nc
+  filename = str(tmp_path/'test.fst')
+  records = []
+  for nomvar, levels in (('TT',(12000,11950)), ('HU',(12000,11950)), ('UU',(12000,11900))):
+    for ip1 in levels:
+      records.append(dict(nomvar=nomvar, ip1=ip1, data=np.zeros((3,4))))
+  write_fst (filename, records)
+  b = fstd2nc.Buffer(filename)
+  b._makevars()
+  axes = [axis for axis in b._iter_axes() if hasattr(axis,'array')]
+  keys = [(axis.name, tuple(np.asarray(axis.array).tolist())) for axis in axes]
+  assert len(keys) == len(set(keys))
+  var = dict((v.name,v) for v in b._varlist)
+  assert list(map(id,var['TT'].axes)) == list(map(id,var['HU'].axes))
+  assert var['TT'].axes[0] is not var['UU'].axes[0]
+  assert list(map(id,var['TT'].axes[1:])) == list(map(id,var['UU'].axes[1:]))
+
+def test_split_coverage ():
+  from fstd2nc.mixins import _split_coverage
+  # Full coverage stays in one piece.
+  record_id = np.arange(6).reshape(2,3)
+  pieces = _split_coverage(record_id)
+  assert len(pieces) == 1
+  assert [list(ind) for ind in pieces[0]] == [[0,1],[0,1,2]]
+  # 3D output at the first and last time, surface output in between.
+  record_id = np.full((7,3), -1)
+  record_id[:,2] = np.arange(7)
+  record_id[[0,6],:2] = [[7,8],[9,10]]
+  pieces = _split_coverage(record_id)
+  assert [[list(ind) for ind in piece] for piece in pieces] == [
+    [[0,6],[0,1,2]],
+    [[1,2,3,4,5],[2]],
+  ]
+  # Every record ends up in exactly one piece, with nothing missing.
+  found = np.concatenate([record_id[np.ix_(*piece)].flatten() for piece in pieces])
+  assert sorted(found) == list(range(11))
+  # Too many pieces needed.
+  assert len(_split_coverage(record_id, max_pieces=1)) == 1
+  # Scattered records that can't be split without leaving holes.
+  record_id = np.array([[0,-1],[-1,1]])
+  pieces = _split_coverage(record_id)
+  found = np.concatenate([record_id[np.ix_(*piece)].flatten() for piece in pieces])
+  assert sorted(found[found>=0]) == [0,1]
+
+def test_split_partial_coverage (tmp_path):
+  from conftest import write_fst
+  import fstd2nc
+  import rpnpy.librmn.all as rmn
+  filename = str(tmp_path/'test.fst')
+  stamp = rmn.newdate(rmn.NEWDATE_PRINT2STAMP, 20200101, 0)
+  records = []
+  for hour in range(7):
+    levels = (12000,11950,11900) if hour%6 == 0 else (12000,)
+    for ip1 in levels:
+      records.append(dict(nomvar='TT', ip1=ip1, ip2=hour, npas=hour, deet=3600, stamp=rmn.incdatr(stamp,float(hour)), data=np.zeros((3,4))))
+  write_fst (filename, records)
+  # Default is to keep everything in one variable.
+  b = fstd2nc.Buffer(filename)
+  b._makevars()
+  assert len(b._varlist) == 1
+  full = b._varlist[0]
+  assert full.dims[:2] == ('time','level')
+  assert np.count_nonzero(full.record_id < 0) == 10
+  # Split into a 3D and a surface piece.
+  b = fstd2nc.Buffer(filename, split_partial_coverage=True)
+  b._makevars()
+  assert [var.name for var in b._varlist] == ['TT_1', 'TT_2']
+  for var, (times, levels) in zip(b._varlist, [([0,6],[0,1,2]), ([1,2,3,4,5],[2])]):
+    assert np.all(var.record_id >= 0)
+    assert np.array_equal(var.record_id, full.record_id[np.ix_(times,levels)])
+    assert np.array_equal(var.getaxis(var.dims[1]).array, full.getaxis('level').array[levels])
+    assert len(var.getaxis(var.dims[0])) == len(times)
+    assert var.dims[2:] == full.dims[2:]